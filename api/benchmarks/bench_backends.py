@@ -0,0 +1,118 @@
+"""
+Compare inference backends (labear_api.backend) on a set of held-out clips: agreement of the
+predictions with the float model, per-clip latency and the memory the process needs. Every
+backend runs in its own process so the RSS numbers don't include the other backends. The
+int8 backend is calibrated on --calibration, which should not hold the clips compared on.
+
+    poetry run python benchmarks/bench_backends.py --calibration clips/calibration clips/held_out/*.wav
+    poetry run python benchmarks/bench_backends.py --model data/<user>/<model>.pt clips/held_out/*.wav
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from labear_api.backend import BACKENDS
+
+
+def rss_mb() -> float:
+    """Current resident set size, from /proc where available (Linux, like fly.io)"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # Peak, in KB on Linux
+
+
+def run_backend(backend, clips, model_path, repeats):
+    """Load the model for one backend and classify every clip, returning the measurements as a dict"""
+    import torch
+    from speechbrain.inference.classifiers import EncoderClassifier
+    from labear_api import audio
+    from labear_api import backend as backends
+
+    torch.set_num_threads(1) # The fly.io VM has one shared CPU
+    baseline = rss_mb()
+    start = time.perf_counter()
+    if model_path:
+        classifier = torch.load(model_path)
+    else:
+        classifier = EncoderClassifier.from_hparams(source="speechbrain/urbansound8k_ecapa", savedir="models/gurbansound8k_ecapa")
+    classifier = backends.prepare(classifier.eval(), backend) # int8 includes the calibration
+    load_time = time.perf_counter() - start
+    model_rss = rss_mb() - baseline
+
+    sample_rate = classifier.audio_normalizer.sample_rate
+    results = {"backend": backend, "load_s": load_time, "model_rss_mb": model_rss, "clips": {}}
+    timings = []
+    with torch.no_grad():
+        for clip in clips:
+            signal, sr = audio.decode(Path(clip).read_bytes(), Path(clip).suffix.lstrip("."), sample_rate)
+            waveform = classifier.audio_normalizer(signal, sr).unsqueeze(0)
+            classifier.mods.classifier(classifier.encode_batch(waveform)) # Warm up
+            for _ in range(repeats):
+                start = time.perf_counter()
+                probs = classifier.mods.classifier(classifier.encode_batch(waveform)).squeeze()
+                timings.append(time.perf_counter() - start)
+            results["clips"][clip] = probs.tolist()
+    timings.sort()
+    results["median_ms"] = statistics.median(timings) * 1000
+    results["p95_ms"] = timings[int(0.95 * (len(timings) - 1))] * 1000
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results
+
+
+def parity(reference, results):
+    """Share of clips with the same top-1 class as the reference, and the largest probability difference"""
+    same, max_diff = 0, 0.0
+    for clip, probs in results["clips"].items():
+        ref = reference["clips"][clip]
+        same += probs.index(max(probs)) == ref.index(max(ref))
+        max_diff = max(max_diff, max(abs(a - b) for a, b in zip(probs, ref)))
+    return same / len(results["clips"]), max_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark inference backends")
+    parser.add_argument("clips", nargs="+", help="Held-out clips to classify")
+    parser.add_argument("-m", "--model", type=str, default=None, help="Fine-tuned model (.pt) instead of the pretrained classifier")
+    parser.add_argument("-b", "--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("-r", "--repeats", type=int, default=10, help="Timed runs per clip (default: 10)")
+    parser.add_argument("-c", "--calibration", type=str, default=None, help="Folder of clips to calibrate int8 on (CALIBRATION_DIR)")
+    parser.add_argument("-o", "--output", type=Path, default=None, help="Write all results to this JSON file")
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        json.dump(run_backend(args.worker, args.clips, args.model, args.repeats), sys.stdout)
+        return
+
+    env = {**os.environ, "CALIBRATION_DIR": args.calibration} if args.calibration else None
+    runs = {}
+    for backend in ["float"] + [backend for backend in args.backends if backend != "float"]:
+        command = [sys.executable, __file__, "--worker", backend, "-r", str(args.repeats), *args.clips]
+        if args.model:
+            command += ["-m", args.model]
+        runs[backend] = json.loads(subprocess.run(command, check=True, capture_output=True, text=True, env=env).stdout)
+
+    print(f"{'backend':<10}{'load s':>8}{'model MB':>10}{'peak MB':>10}{'median ms':>11}{'p95 ms':>9}{'top-1 agree':>13}{'max diff':>10}")
+    for backend, results in runs.items():
+        agreement, max_diff = parity(runs["float"], results)
+        results["top1_agreement"], results["max_prob_diff"] = agreement, max_diff
+        print(f"{backend:<10}{results['load_s']:>8.2f}{results['model_rss_mb']:>10.1f}{results['peak_rss_mb']:>10.1f}"
+              f"{results['median_ms']:>11.2f}{results['p95_ms']:>9.2f}{agreement:>12.1%}{max_diff:>10.4f}")
+    if args.output:
+        args.output.write_text(json.dumps(runs, indent=2))
+
+
+if __name__ == "__main__":
+    main()
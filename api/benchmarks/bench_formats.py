@@ -0,0 +1,96 @@
+"""
+Compare upload formats for Pi recordings: bytes on the wire, the CPU time the recorder spends
+encoding a window and the time the API spends decoding it to a tensor. Uses the recorder's
+own settings (48 kHz int16) and a 5 second window. Without files a synthetic clip of tones
+over noise is used.
+
+    poetry run python benchmarks/bench_formats.py recording.wav
+"""
+
+import argparse
+import io
+import statistics
+import time
+import wave
+from pathlib import Path
+
+import numpy as np
+import soundfile
+
+from labear_api import audio
+
+MIC_RATE = 48000
+WINDOW_SECONDS = 5
+# Same table as client/rpi/recorder.py
+UPLOAD_FORMATS = {
+    "wav": ("WAV", "PCM_16", "wav"),
+    "flac": ("FLAC", "PCM_16", "flac"),
+    "opus": ("OGG", "OPUS", "opus"),
+}
+
+
+def synthetic_window(seconds=WINDOW_SECONDS, rate=MIC_RATE):
+    """A few tones switching on and off over background noise, as int16 [frames, 1]"""
+    rng = np.random.default_rng(0)
+    t = np.arange(seconds * rate) / rate
+    signal = 0.02 * rng.standard_normal(len(t))
+    for freq, start in [(440, 0.5), (1200, 1.5), (3000, 3.0)]:
+        signal += 0.2 * np.sin(2 * np.pi * freq * t) * ((t > start) & (t < start + 1.0))
+    return (np.clip(signal, -1, 1) * 32767).astype(np.int16).reshape(-1, 1)
+
+
+def read_window(path, seconds=WINDOW_SECONDS):
+    samples, rate = soundfile.read(path, dtype="int16", always_2d=True)
+    if rate != MIC_RATE:
+        print(f"{path.name} is {rate} Hz, the Pi records at {MIC_RATE} Hz")
+    return samples[:seconds * rate, :1]
+
+
+def encode(window, upload_format):
+    if upload_format == "wav": # What recorder.encode_wav does
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wave_file:
+            wave_file.setnchannels(window.shape[1])
+            wave_file.setsampwidth(2)
+            wave_file.setframerate(MIC_RATE)
+            wave_file.writeframes(window.tobytes())
+        return buffer.getvalue()
+    container, subtype, _ = UPLOAD_FORMATS[upload_format]
+    buffer = io.BytesIO()
+    soundfile.write(buffer, window, MIC_RATE, format=container, subtype=subtype)
+    return buffer.getvalue()
+
+
+def time_it(func, repeats, clock=time.perf_counter):
+    timings = []
+    for _ in range(repeats):
+        start = clock()
+        result = func()
+        timings.append(clock() - start)
+    return statistics.median(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark upload formats for Pi recordings")
+    parser.add_argument("files", nargs="*", type=Path, help="Recordings to use instead of a synthetic clip")
+    parser.add_argument("-r", "--repeats", type=int, default=20, help="Encodes and decodes per format (default: 20)")
+    parser.add_argument("-sr", "--sample-rate", type=int, default=audio.DEFAULT_SAMPLE_RATE,
+                        help="Sample rate the API decodes to (default: 16000)")
+    args = parser.parse_args()
+
+    clips = [(path.name, read_window(path)) for path in args.files] or [("synthetic", synthetic_window())]
+    print(f"{'clip':<24}{'format':<8}{'bytes':>10}{'ratio':>8}{'encode cpu ms':>15}{'decode ms':>12}")
+    for name, window in clips:
+        raw_size = None
+        for upload_format, (_, _, extension) in UPLOAD_FORMATS.items():
+            # Client side cost is CPU time, the Pi is not doing anything else meanwhile
+            encode_time, data = time_it(lambda: encode(window, upload_format), args.repeats, time.process_time)
+            audio.decode(data, extension, args.sample_rate) # Warm up
+            decode_time, _ = time_it(lambda: audio.decode(data, extension, args.sample_rate), args.repeats)
+            raw_size = raw_size or len(data)
+            print(f"{name:<24}{upload_format:<8}{len(data):>10}{raw_size / len(data):>7.1f}x"
+                  f"{encode_time * 1000:>15.2f}{decode_time * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Compare the in-memory decode path (labear_api.audio.decode) with the pydub + temp file path
+ear.load_audio used before. Both produce a tensor at the classifier's sample rate.
+
+    poetry run python benchmarks/bench_load_audio.py labear_api/test_submit.wav recording.m4a
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import torchaudio
+from pydub import AudioSegment
+
+from labear_api import audio
+
+
+def load_audio_pydub(data, format, sample_rate):
+    """The previous ear.load_audio: decode, trim, re-encode to a temp WAV and decode again."""
+    with tempfile.TemporaryFile() as tp:
+        with tempfile.SpooledTemporaryFile() as upload:
+            upload.write(data)
+            upload.seek(0)
+            segment = AudioSegment.from_file(upload, format=format)
+        segment = segment[500:]
+        segment.export(tp, format='wav')
+        signal, sr = torchaudio.load(tp, channels_first=False)
+    # The classifier's audio normalizer resampled afterwards, so count that too
+    return torchaudio.functional.resample(signal.T, sr, sample_rate).T, sample_rate
+
+
+def load_audio_memory(data, format, sample_rate):
+    return audio.decode(data, format, sample_rate)
+
+
+def time_it(func, data, format, sample_rate, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        signal, _ = func(data, format, sample_rate)
+        timings.append(time.perf_counter() - start)
+    return timings, signal
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ear.load_audio decode paths")
+    parser.add_argument("files", nargs="+", type=Path, help="Audio files to decode")
+    parser.add_argument("-r", "--repeats", type=int, default=20, help="Decodes per file and path (default: 20)")
+    parser.add_argument("-sr", "--sample-rate", type=int, default=audio.DEFAULT_SAMPLE_RATE,
+                        help="Target sample rate (default: 16000)")
+    args = parser.parse_args()
+
+    print(f"{'file':<30}{'path':<10}{'median ms':>12}{'mean ms':>12}{'samples':>12}")
+    for path in args.files:
+        data = path.read_bytes()
+        format = path.suffix.lstrip(".")
+        results = {}
+        for name, func in [("pydub", load_audio_pydub), ("memory", load_audio_memory)]:
+            func(data, format, args.sample_rate) # Warm up caches and the ffmpeg binary
+            timings, signal = time_it(func, data, format, args.sample_rate, args.repeats)
+            results[name] = statistics.median(timings)
+            print(f"{path.name:<30}{name:<10}{results[name]*1000:>12.2f}"
+                  f"{statistics.mean(timings)*1000:>12.2f}{signal.shape[0]:>12}")
+        print(f"{path.name:<30}{'speedup':<10}{results['pydub'] / results['memory']:>11.1f}x")
+
+
+if __name__ == "__main__":
+    main()
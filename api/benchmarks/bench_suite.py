@@ -0,0 +1,217 @@
+"""
+Benchmark suite that runs entirely on this machine. Storage is a local directory (or
+fake-gcs-server with --gcs, to include the Google client) and InfluxDB is replaced by
+benchmarks/influx_stub.py, so no request leaves the machine and runs are comparable. It times the building blocks of a request (audio decoding,
+predictions with the pretrained and a fine-tuned model, loading a user's model cold and
+warm, queueing dashboard records), then starts the API and load tests /monitor and /learn
+(see load_test.py). Everything is written to one JSON file.
+
+    poetry run python benchmarks/bench_suite.py -o bench-$(git rev-parse --short HEAD).json
+    docker compose -f benchmarks/compose-bench.yaml up -d gcs
+    poetry run python benchmarks/bench_suite.py --gcs http://localhost:4443 -o bench-gcs.json
+    poetry run python benchmarks/bench_suite.py --compare bench-old.json bench-new.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import requests
+
+import influx_stub
+import load_test
+
+BENCH_USER = "bench_finetuned" # Gets a fine-tuned model in the fake bucket
+DEFAULT_USER = "bench_default" # Has no model, so predictions use the pretrained classifier
+BENCH_CATS = ["bench_a", "bench_b", "bench_c"]
+API_PORT = 8765
+
+
+def time_it(func, repeats, setup=None):
+    """Median, p95 and mean of `repeats` calls of func in ms. setup runs untimed before every call"""
+    timings = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        "median_ms": statistics.median(timings) * 1000,
+        "p95_ms": timings[int(0.95 * (len(timings) - 1))] * 1000,
+        "mean_ms": statistics.mean(timings) * 1000,
+        "runs": repeats,
+    }
+
+
+def local_environment(gcs_host=None):
+    """Point the API at the local stand-ins. Must run before labear_api is imported"""
+    influx = influx_stub.serve()
+    if gcs_host:
+        os.environ["STORAGE_BACKEND"] = "gcs"
+        os.environ["STORAGE_EMULATOR_HOST"] = gcs_host
+    else:
+        os.environ["STORAGE_BACKEND"] = "local" # Shared with the API process through the directory
+        os.environ["STORAGE_ROOT"] = tempfile.mkdtemp(prefix="labear-bench-storage-")
+    os.environ["INFLUX_HOST"] = f"http://127.0.0.1:{influx.server_port}"
+    os.environ.setdefault("INFLUX_DB", "bench") # The stub takes any token
+    os.environ["SPOOL_DIR"] = tempfile.mkdtemp(prefix="labear-bench-spool-")
+    os.environ["REVALIDATE_INTERVAL"] = "0"
+    return influx
+
+
+def seed_bucket():
+    """Publish a fine-tuned model for BENCH_USER, creating the bucket first on fake-gcs-server"""
+    import torch
+    from speechbrain.inference.classifiers import EncoderClassifier
+    from labear_api.manifest import publish_model, GC_BUCKET_NAME
+    from labear_api.storage import GCSStorage, get_storage
+
+    storage = get_storage()
+    if isinstance(storage, GCSStorage):
+        from google.api_core.exceptions import Conflict
+        try:
+            storage.client.create_bucket(GC_BUCKET_NAME)
+        except Conflict:
+            pass
+    # Same head replacement as notebooks/train.ipynb, with random weights
+    classifier = EncoderClassifier.from_hparams(source="speechbrain/urbansound8k_ecapa", savedir="models/gurbansound8k_ecapa")
+    classifier.mods.classifier.weight = torch.nn.Parameter(torch.FloatTensor(len(BENCH_CATS), 192))
+    torch.nn.init.xavier_uniform_(classifier.mods.classifier.weight)
+    with tempfile.TemporaryDirectory() as folder:
+        classifier_file, classes_file = Path(folder) / f"{BENCH_USER}_bench.pt", Path(folder) / f"{BENCH_USER}_cats.json"
+        torch.save(classifier, classifier_file)
+        classes_file.write_text(json.dumps({"cats": BENCH_CATS}))
+        publish_model(BENCH_USER, classifier_file, classes_file)
+
+
+def micro_benchmarks(clip: Path, repeats: int) -> dict:
+    from labear_api import ear
+    from labear_api.brain import Brains, CLASSIFIER_PATH
+    from labear_api.main import Metrics, DASHBOARD_MONITOR
+
+    data = clip.read_bytes()
+    format = clip.suffix.lstrip(".")
+    sample_rate = ear.default_classifier.audio_normalizer.sample_rate
+    results = {}
+    results["load_audio"] = time_it(lambda: ear.load_audio(io.BytesIO(data), format, sample_rate), repeats)
+    for name, user in [("default", DEFAULT_USER), ("finetuned", BENCH_USER)]:
+        predict = lambda: ear.predict(user, io.BytesIO(data), format)
+        predict() # Loads the user's model
+        results[f"predict_{name}"] = time_it(predict, repeats, setup=ear.embeddings.clear)
+        results[f"predict_{name}_cached_embedding"] = time_it(predict, repeats)
+
+    def cold_start():
+        shutil.rmtree(CLASSIFIER_PATH / BENCH_USER, ignore_errors=True)
+        cold_start.brains = Brains()
+    cold_start()
+    results["brains_cold"] = time_it(lambda: cold_start.brains.user_data(BENCH_USER), max(1, repeats // 5), setup=cold_start)
+    results["brains_warm"] = time_it(lambda: cold_start.brains.user_data(BENCH_USER), repeats)
+
+    metrics = Metrics() # Not started, so this measures what a request pays to queue a record
+    response = {
+        "request_info": {"user_id": BENCH_USER, "class_id": "bench", "time_stamp": round(time.time() * 1000),
+                         "suppressed": 0, "queue_depth": 0, "files": [{"size": len(data), "name": clip.name}]},
+        "prediction": {"probabilities": {cat: 1 / len(BENCH_CATS) for cat in BENCH_CATS}},
+    }
+    results["post_records"] = time_it(lambda: metrics.post_records(response, DASHBOARD_MONITOR), repeats * 100)
+    return results
+
+
+def start_api(port):
+    """Run the API in its own process (so its RSS is its own) and wait until it is ready"""
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "labear_api.main:app", "--port", str(port)], env=os.environ.copy())
+    deadline = time.monotonic() + 300
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/ready", timeout=1).ok:
+                return server
+        except requests.RequestException:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError(f"API exited with {server.returncode} before it was ready")
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("API was not ready after 300s")
+
+
+def load_tests(clip: Path, concurrency: int, duration: float) -> list:
+    server = start_api(API_PORT)
+    try:
+        return [load_test.run(f"http://127.0.0.1:{API_PORT}", clip, endpoint, concurrency, duration, BENCH_USER, server.pid)
+                for endpoint in load_test.ENDPOINTS]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def environment() -> dict:
+    import torch
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    return {
+        "time": round(time.time()),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def compare(old_file: Path, new_file: Path):
+    """Print the median latency of every microbenchmark and the load test numbers side by side"""
+    old, new = json.loads(old_file.read_text()), json.loads(new_file.read_text())
+    print(f"{'benchmark':<40}{'old':>12}{'new':>12}{'change':>10}")
+    for name, result in new["micro"].items():
+        if name in old["micro"]:
+            before, after = old["micro"][name]["median_ms"], result["median_ms"]
+            print(f"{name + ' median ms':<40}{before:>12.3f}{after:>12.3f}{after / before - 1:>+10.1%}")
+    old_load = {result["endpoint"]: result for result in old.get("load", [])}
+    for result in new.get("load", []):
+        for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "server_peak_rss_mb"):
+            before, after = old_load.get(result["endpoint"], {}).get(key), result.get(key)
+            if before and after:
+                print(f"{result['endpoint'] + ' ' + key:<40}{before:>12.3f}{after:>12.3f}{after / before - 1:>+10.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local benchmark suite for the labear API")
+    parser.add_argument("--clip", type=Path, default=Path("labear_api/test_submit.wav"), help="Clip used by every benchmark")
+    parser.add_argument("--gcs", type=str, default=None, help="fake-gcs-server URL, e.g. http://localhost:4443 (default: local storage)")
+    parser.add_argument("-r", "--repeats", type=int, default=20, help="Runs per microbenchmark (default: 20)")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Load test clients (default: 8)")
+    parser.add_argument("-d", "--duration", type=float, default=30, help="Seconds per load tested endpoint, 0 skips the load test (default: 30)")
+    parser.add_argument("-o", "--output", type=Path, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--compare", nargs=2, type=Path, metavar=("OLD", "NEW"), help="Compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    influx = local_environment(args.gcs)
+    seed_bucket()
+    results = {"environment": environment(), "micro": micro_benchmarks(args.clip, args.repeats)}
+    if args.duration > 0:
+        results["load"] = load_tests(args.clip, args.concurrency, args.duration)
+    results["influx_stub"] = dict(influx_stub.WriteHandler.counts)
+    influx.shutdown()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Cold start of the API. Starts a fresh production server (python -m labear_api.server, as in
+the Docker image) and measures how long it takes until it answers / (the server is up), until
+/ready passes (models loaded and warm) and until the first /monitor request succeeds, which is
+what a Raspberry Pi waking a stopped fly.io machine waits for. Once every request has
+succeeded it also sums the RSS and PSS (resident memory with shared pages split between the
+processes sharing them) of the server and its workers, so --no-mmap shows what the workers
+sharing the pretrained weights saves. Storage and InfluxDB are the local stand-ins of
+bench_suite.py.
+
+    poetry run python benchmarks/cold_start.py -n 5 -o cold_start.json
+    poetry run python benchmarks/cold_start.py --workers 2
+    poetry run python benchmarks/cold_start.py --workers 2 --no-mmap # Every worker with its own copy of the weights
+    poetry run python benchmarks/cold_start.py --uvicorn # A single uvicorn process, for comparison
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+import bench_suite
+
+TIMEOUT = 300 # Seconds before a run is given up
+POLL_INTERVAL = 0.05
+
+
+def wait_for(check, start, server):
+    """Seconds from start until check() is true, calling it until then"""
+    while time.perf_counter() - start < TIMEOUT:
+        try:
+            if check():
+                return time.perf_counter() - start
+        except requests.RequestException:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError(f"API exited with {server.returncode}")
+        time.sleep(POLL_INTERVAL)
+    raise RuntimeError(f"API did not respond within {TIMEOUT}s")
+
+
+def memory_mb(pid: int) -> dict:
+    """Summed RSS and PSS of a process and its descendants, from /proc (Linux, like fly.io)"""
+    pids, totals = [pid], {"rss_mb": 0.0, "pss_mb": 0.0}
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as rollup:
+                for line in rollup:
+                    key, _, value = line.partition(":")
+                    if key in ("Rss", "Pss"):
+                        totals[f"{key.lower()}_mb"] += int(value.split()[0]) / 1024
+            for task in Path(f"/proc/{pid}/task").iterdir():
+                pids += [int(child) for child in (task / "children").read_text().split()]
+        except FileNotFoundError: # Exited meanwhile
+            continue
+    return totals
+
+
+def server_command(port: int, workers: int, uvicorn: bool = False, mmap: bool = True):
+    """Command and environment starting the API on port"""
+    env = {**os.environ, "MMAP_WEIGHTS": "1" if mmap else "0"} # labear_api.ear reads it
+    if uvicorn:
+        return [sys.executable, "-m", "uvicorn", "labear_api.main:app", "--port", str(port)], env
+    env.update({"BIND": f"127.0.0.1:{port}", "WEB_CONCURRENCY": str(workers)}) # labear_api.server reads these
+    return [sys.executable, "-m", "labear_api.server"], env
+
+
+def run(port: int, clip: Path, command: list, env: dict, workers: int = 1) -> dict:
+    """Start the API once and time its first responses"""
+    url = f"http://127.0.0.1:{port}"
+    data = {"user_id": bench_suite.DEFAULT_USER, "class_id": "cold_start"}
+    content = clip.read_bytes()
+
+    def root():
+        with requests.Session() as session:
+            return wait_for(lambda: session.get(url + "/", timeout=1, allow_redirects=False).status_code < 400, start, server)
+
+    def ready():
+        with requests.Session() as session:
+            return wait_for(lambda: session.get(url + "/ready", timeout=1).ok, start, server)
+
+    def monitor():
+        with requests.Session() as session:
+            post = lambda: session.post(url + "/monitor", files=[("files", (clip.name, content))],
+                                        data={**data, "time_stamp": round(time.time() * 1000)}, timeout=TIMEOUT)
+            seconds = wait_for(lambda: post().ok, start, server)
+            # Every worker gets requests, so all of them have loaded the models before memory is measured
+            for _ in range(4 * workers):
+                post()
+            return seconds
+
+    start = time.perf_counter()
+    server = subprocess.Popen(command, env=env)
+    try:
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            checks = {name: pool.submit(check) for name, check in [("root_s", root), ("ready_s", ready), ("first_monitor_s", monitor)]}
+            results = {name: future.result() for name, future in checks.items()}
+        return {**results, **memory_mb(server.pid)}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the API's cold start")
+    parser.add_argument("--clip", type=Path, default=Path("labear_api/test_submit.wav"), help="Clip posted to /monitor")
+    parser.add_argument("--gcs", type=str, default=None, help="fake-gcs-server URL (default: local storage)")
+    parser.add_argument("-n", "--runs", type=int, default=3, help="Cold starts to measure (default: 3)")
+    parser.add_argument("-p", "--port", type=int, default=bench_suite.API_PORT)
+    parser.add_argument("-w", "--workers", type=int, default=1, help="gunicorn workers (default: 1, like the fly.io VM)")
+    parser.add_argument("--uvicorn", action="store_true", help="Start a single uvicorn process instead of the production server")
+    parser.add_argument("--no-mmap", action="store_true", help="Load a private copy of the pretrained weights in every worker")
+    parser.add_argument("-o", "--output", type=Path, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    influx = bench_suite.local_environment(args.gcs)
+    command, env = server_command(args.port, args.workers, args.uvicorn, mmap=not args.no_mmap)
+    runs = []
+    for n in range(args.runs):
+        runs.append(run(args.port, args.clip, command, env, 1 if args.uvicorn else args.workers))
+        print(f"Run {n + 1}: " + ", ".join(f"{name} {value:.2f}" for name, value in runs[-1].items()))
+    influx.shutdown()
+
+    results = {"runs": runs, "median": {name: statistics.median(run[name] for run in runs) for name in runs[0]}}
+    print(json.dumps(results["median"]))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
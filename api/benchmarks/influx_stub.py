@@ -0,0 +1,63 @@
+"""
+Stand-in for the InfluxDB write API in benchmarks. Accepts line protocol writes on any path,
+counts requests and points, and answers 204 like InfluxDB does. Runs on its own (see
+compose-bench.yaml) or inside another script with serve(). GET returns the counts as JSON.
+
+    python benchmarks/influx_stub.py --port 8086
+"""
+
+import argparse
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class WriteHandler(BaseHTTPRequestHandler):
+    counts = {"requests": 0, "points": 0, "bytes": 0}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        points = sum(1 for line in body.splitlines() if line.strip())
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts["points"] += points
+            self.counts["bytes"] += len(body)
+        self.send_response(204)
+        self.end_headers()
+
+    def do_GET(self):
+        with self.lock:
+            body = json.dumps(self.counts).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # One line per write would swamp the benchmark output
+
+
+def serve(host="127.0.0.1", port=0):
+    """Start the stub on a background thread. Port 0 picks a free port, see server.server_port"""
+    server = ThreadingHTTPServer((host, port), WriteHandler)
+    threading.Thread(target=server.serve_forever, name="influx-stub", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="InfluxDB write API stub")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8086)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), WriteHandler)
+    print(f"Influx stub listening on {args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
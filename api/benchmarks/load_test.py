@@ -0,0 +1,111 @@
+"""
+Concurrent load generator for a running API. Posts a clip to /monitor and/or /learn from a
+number of concurrent clients for a fixed time and reports latency percentiles, throughput,
+errors and, given the server's pid, its peak RSS. Results can be written as JSON.
+
+    poetry run python benchmarks/load_test.py http://127.0.0.1:8000 labear_api/test_submit.wav -c 8 -d 30 --pid <pid>
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+ENDPOINTS = ("monitor", "learn")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def peak_rss_mb(pid):
+    """Peak resident set size of a process (VmHWM), Linux only"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        return None
+
+
+def client(url, clip, data, stop, latencies, statuses, lock):
+    """One client posting back to back over a kept-alive connection until stop is set"""
+    name, content = clip
+    with requests.Session() as session:
+        n = 0
+        while not stop.is_set():
+            n += 1
+            form = {**data, "time_stamp": round(time.time() * 1000)}
+            start = time.perf_counter()
+            try:
+                status = session.post(url, files=[("files", (name, content))], data=form, timeout=60).status_code
+            except requests.RequestException as err:
+                status = type(err).__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[status] += 1
+                if status in (200, 202):
+                    latencies.append(elapsed)
+
+
+def run(server, clip_path, endpoint="monitor", concurrency=8, duration=30.0, user="bench", pid=None):
+    """Load one endpoint and return the measurements as a dict"""
+    clip = (Path(clip_path).name, Path(clip_path).read_bytes())
+    url = f"{server.rstrip('/')}/{endpoint}"
+    data = {"user_id": user, "class_id": "load_test"}
+    latencies, statuses, lock, stop = [], Counter(), threading.Lock(), threading.Event()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client, url, clip, data, stop, latencies, statuses, lock)
+        time.sleep(duration)
+        stop.set()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "duration_s": elapsed,
+        "requests": sum(statuses.values()),
+        "ok": len(latencies),
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+        "p95_ms": percentile(latencies, 0.95) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else None,
+        "server_peak_rss_mb": peak_rss_mb(pid) if pid else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the labear API")
+    parser.add_argument("server", type=str, help="Base URL of the API, e.g. http://127.0.0.1:8000")
+    parser.add_argument("clip", type=Path, help="Audio file every request uploads")
+    parser.add_argument("-e", "--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Concurrent clients (default: 8)")
+    parser.add_argument("-d", "--duration", type=float, default=30, help="Seconds per endpoint (default: 30)")
+    parser.add_argument("-u", "--user", type=str, default="bench", help="user_id sent with every request")
+    parser.add_argument("--pid", type=int, default=None, help="Server process id, to report its peak RSS")
+    parser.add_argument("-o", "--output", type=Path, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = [run(args.server, args.clip, endpoint, args.concurrency, args.duration, args.user, args.pid)
+               for endpoint in args.endpoints]
+    for result in results:
+        print(json.dumps(result))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
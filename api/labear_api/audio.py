@@ -0,0 +1,148 @@
+"""
+In-memory audio decoding. Uploads are turned into float tensors straight from the request
+buffer: WAV is parsed in place with numpy, FLAC and Ogg/Opus are decoded by libsndfile and
+everything else goes through a single ffmpeg pass that writes raw float samples to a pipe.
+No temporary files are involved.
+"""
+
+import io
+import os
+import struct
+import subprocess
+
+import numpy as np
+import soundfile
+import torch
+import torchaudio
+
+# Constants
+FFMPEG = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+DEFAULT_SAMPLE_RATE = 16000 # What the urbansound8k ECAPA models were trained on
+TRIM_SECONDS = 0.5 # Blank signal at the beginning of recordings
+SNDFILE_FORMATS = {"flac", "ogg", "oga", "opus"} # Compressed formats the Pi recorder sends
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# (format tag, bits per sample) -> (numpy dtype, scale to [-1, 1], offset), matching torchaudio.load normalisation
+PCM_TYPES = {
+    (WAVE_FORMAT_PCM, 8): (np.uint8, 1 / 128, -128),
+    (WAVE_FORMAT_PCM, 16): (np.int16, 1 / 2**15, 0),
+    (WAVE_FORMAT_PCM, 32): (np.int32, 1 / 2**31, 0),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): (np.float32, 1, 0),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): (np.float64, 1, 0),
+}
+
+
+def decode(data, format: str, sample_rate: int = DEFAULT_SAMPLE_RATE, trim: float = TRIM_SECONDS):
+    """
+    Decode an uploaded file held in memory into a float32 tensor shaped [time, channels]
+    (like torchaudio.load(..., channels_first=False)) at the requested sample rate.
+    The first `trim` seconds are dropped.
+    """
+    if is_wav(data):
+        signal, sr = decode_wav(data)
+    elif format.lower() in SNDFILE_FORMATS:
+        signal, sr = decode_sndfile(data, format, sample_rate)
+    else:
+        signal, sr = decode_ffmpeg(data, format, sample_rate)
+    signal = signal[int(trim * sr):]
+    if sample_rate and sr != sample_rate:
+        signal = torchaudio.functional.resample(signal.T, sr, sample_rate).T
+        sr = sample_rate
+    return signal, sr
+
+
+def is_wav(data) -> bool:
+    header = bytes(memoryview(data)[:12])
+    return header[:4] == b"RIFF" and header[8:12] == b"WAVE"
+
+
+def decode_wav(data):
+    """Parse a RIFF/WAVE buffer without copying the sample data until it is converted to float."""
+    view = memoryview(data)
+    if not is_wav(view):
+        raise ValueError("Not a RIFF/WAVE file")
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        size, = struct.unpack_from("<I", view, offset + 4)
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            tag, channels, rate, _, _, bits = struct.unpack_from("<HHIIHH", view, body)
+            if tag == WAVE_FORMAT_EXTENSIBLE and size >= 40:
+                tag, = struct.unpack_from("<H", view, body + 24) # Sub format GUID starts with the real tag
+            fmt = (tag, channels, rate, bits)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("WAV data chunk found before fmt chunk")
+            # Streaming writers leave the size unset, and truncated uploads are read as far as they go
+            if size in (0, 0xFFFFFFFF) or body + size > len(view):
+                size = len(view) - body
+            tag, channels, rate, bits = fmt
+            return decode_pcm(view[body:body + size], channels, tag, bits), rate
+        offset = body + size + (size & 1) # Chunks are word aligned
+    raise ValueError("WAV file has no data chunk")
+
+
+def decode_pcm(buffer, channels: int = 1, tag: int = WAVE_FORMAT_PCM, bits: int = 16):
+    """Interpret raw interleaved samples as a float32 tensor shaped [time, channels]."""
+    view = memoryview(buffer).cast("B")
+    frame_bytes = channels * bits // 8
+    view = view[:len(view) - len(view) % frame_bytes] # Drop any incomplete trailing frame
+    if (tag, bits) == (WAVE_FORMAT_PCM, 24):
+        packed = np.frombuffer(view, dtype=np.uint8).reshape(-1, 3)
+        samples = (packed[:, 0].astype(np.int32) | packed[:, 1].astype(np.int32) << 8 | packed[:, 2].astype(np.int32) << 16)
+        samples = (samples << 8 >> 8).astype(np.float32) / 2**23 # Sign extend from 24 bits
+    elif (tag, bits) in PCM_TYPES:
+        dtype, scale, shift = PCM_TYPES[(tag, bits)]
+        samples = np.frombuffer(view, dtype=dtype).astype(np.float32)
+        if shift:
+            samples += shift
+        if scale != 1:
+            samples *= scale
+    else:
+        raise ValueError(f"Unsupported WAV sample format (tag {tag:#06x}, {bits} bits)")
+    return torch.from_numpy(samples.reshape(-1, channels))
+
+
+def decode_sndfile(data, format: str, sample_rate: int = DEFAULT_SAMPLE_RATE):
+    """Decode FLAC or Ogg (Vorbis/Opus) in process with libsndfile, falling back to ffmpeg if it can't."""
+    try:
+        samples, sr = soundfile.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    except (RuntimeError, TypeError): # Older libsndfile builds without Opus support
+        return decode_ffmpeg(data, format, sample_rate)
+    return torch.from_numpy(samples), sr
+
+
+def decode_ffmpeg(data, format: str, sample_rate: int = DEFAULT_SAMPLE_RATE):
+    """
+    Decode any format ffmpeg understands in one pass, downmixed to mono and resampled by
+    ffmpeg itself. MP4/M4A recordings keep their index at the end of the file, so the input
+    is handed over as an in-memory file ffmpeg can seek in, rather than as a pipe.
+    """
+    sample_rate = sample_rate or DEFAULT_SAMPLE_RATE
+    command = [FFMPEG, "-nostdin", "-hide_banner", "-loglevel", "error", "-i", None,
+               "-vn", "-ac", "1", "-ar", str(sample_rate), "-f", "f32le", "-acodec", "pcm_f32le", "pipe:1"]
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create(f"upload.{format}")
+        try:
+            with open(fd, "wb", closefd=False) as memory_file:
+                memory_file.write(data)
+            command[6] = f"/dev/fd/{fd}"
+            result = subprocess.run(command, pass_fds=(fd,), capture_output=True)
+        finally:
+            os.close(fd)
+    else:
+        command[6] = "pipe:0"
+        result = subprocess.run(command, input=bytes(data), capture_output=True)
+    if result.returncode != 0:
+        raise ValueError(f"ffmpeg could not decode {format} audio: {result.stderr.decode(errors='replace').strip()}")
+    samples = np.frombuffer(result.stdout, dtype=np.float32)
+    return torch.from_numpy(samples.copy()).unsqueeze(-1), sample_rate # stdout is read only
+
+
+if __name__ == "__main__":
+    print("Running main")
@@ -0,0 +1,103 @@
+"""
+Inference backends. "float" runs the models as trained. "int8" statically quantizes the
+Conv1d layers of the ECAPA encoder, which hold nearly all of its weights and compute: the
+weights are stored as int8 per output channel and the activations going into each layer are
+quantized with a scale calibrated once on a few clips. Feature extraction, batch norms,
+pooling and the classification heads stay in float.
+"""
+
+import functools
+import os
+from pathlib import Path
+
+import torch
+from loguru import logger
+
+from labear_api import audio
+
+# Constants
+BACKENDS = ("float", "int8")
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "float")
+CALIBRATION_DIR = os.environ.get("CALIBRATION_DIR", "") # Recordings the int8 activation scales are calibrated on
+DEFAULT_CALIBRATION_CLIP = Path(__file__).parent / "test_submit.wav" # Used without CALIBRATION_DIR
+CALIBRATION_SECONDS = 1.0 # Clips are calibrated on in windows of this length, like short uploads
+
+if INFERENCE_BACKEND not in BACKENDS:
+    raise ValueError(f"INFERENCE_BACKEND must be one of {BACKENDS}, got {INFERENCE_BACKEND!r}")
+
+
+class QuantizedConv(torch.nn.Module):
+    """A Conv1d run in int8 between a quantize and a dequantize step, so its neighbours stay float."""
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = torch.ao.quantization.QuantStub()
+        self.conv = conv
+        self.dequant = torch.ao.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def prepare(classifier, backend: str = INFERENCE_BACKEND):
+    """Convert a freshly loaded EncoderClassifier for the backend, in place."""
+    if backend == "float":
+        return classifier
+    sample_rate = classifier.audio_normalizer.sample_rate
+    waveforms = calibration_waveforms(sample_rate)
+
+    def calibrate():
+        for waveform in waveforms:
+            classifier.encode_batch(classifier.audio_normalizer(waveform, sample_rate).unsqueeze(0))
+
+    classifier.eval()
+    quantize_encoder(classifier.mods.embedding_model, calibrate)
+    return classifier
+
+
+def quantize_encoder(encoder, calibrate):
+    """
+    Quantize every Conv1d of an encoder in place. calibrate() runs representative inputs
+    through the model while observers record the range of the activations.
+    """
+    qconfig = torch.ao.quantization.get_default_qconfig(torch.backends.quantized.engine)
+    convs = 0
+    for module in list(encoder.modules()):
+        for name, child in list(module.named_children()):
+            if type(child) is torch.nn.Conv1d:
+                wrapper = QuantizedConv(child)
+                wrapper.qconfig = qconfig # Only the wrapped layers get observers and are converted
+                setattr(module, name, wrapper)
+                convs += 1
+    torch.ao.quantization.prepare(encoder, inplace=True)
+    with torch.no_grad():
+        calibrate()
+    torch.ao.quantization.convert(encoder, inplace=True)
+    logger.info(f"Quantized {convs} Conv1d layers to int8")
+    return encoder
+
+
+@functools.cache
+def calibration_waveforms(sample_rate: int) -> tuple:
+    """Windows of the calibration recordings as [time, channels] tensors at sample_rate."""
+    clips = sorted(Path(CALIBRATION_DIR).iterdir()) if CALIBRATION_DIR else [DEFAULT_CALIBRATION_CLIP]
+    window = int(CALIBRATION_SECONDS * sample_rate)
+    waveforms = []
+    for clip in clips:
+        try:
+            signal, _ = audio.decode(clip.read_bytes(), clip.suffix.lstrip("."), sample_rate)
+        except (ValueError, OSError) as err:
+            logger.warning(f"Skipping calibration clip {clip}: {err}")
+            continue
+        waveforms += [signal[start:start + window] for start in range(0, max(len(signal) - window, 0) + 1, window)]
+    if not waveforms:
+        raise ValueError(f"No calibration clips could be read from {CALIBRATION_DIR or DEFAULT_CALIBRATION_CLIP}")
+    return tuple(waveforms)
+
+
+def encoder_name(name: str, backend: str = INFERENCE_BACKEND) -> str:
+    """Embedding cache key of an encoder run on the backend, so int8 and float embeddings are kept apart."""
+    return name if backend == "float" else f"{name}:{backend}"
+
+
+if __name__ == "__main__":
+    print("Running main")
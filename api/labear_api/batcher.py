@@ -0,0 +1,87 @@
+"""
+Micro-batching for encoder inference. Concurrent requests for the same classifier are
+collected over a short window and run through the encoder as one padded batch. Users whose
+heads run on the shared pretrained encoder all join the same batch; the heads themselves
+are tiny and run per request on the embeddings (see labear_api.ear).
+"""
+
+import os
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+import torch
+from loguru import logger
+
+from labear_api.tracing import stage
+
+# Constants
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW_MS", 20)) / 1000 # Seconds the first request waits for company
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 16)) # A full batch runs without waiting out the window
+
+
+@dataclass
+class Batch:
+    items: list = field(default_factory=list) # (waveform, future) per queued signal
+    full: threading.Event = field(default_factory=threading.Event)
+
+
+@dataclass
+class Batcher:
+    window: float = BATCH_WINDOW
+    max_size: int = BATCH_MAX_SIZE
+    open_batches: dict = field(default_factory=dict, init=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def embed(self, classifier, waveforms: list):
+        """
+        Return the encoder's embedding for each waveform. The first caller for a classifier
+        leads the batch: it waits for the window to pass (or the batch to fill), runs the
+        forward pass for everyone queued and hands each caller its own rows.
+        """
+        futures = [Future() for _ in waveforms]
+        with self.lock:
+            batch = self.open_batches.get(classifier)
+            leader = batch is None
+            if leader:
+                batch = self.open_batches[classifier] = Batch()
+            batch.items.extend(zip(waveforms, futures))
+            if len(batch.items) >= self.max_size:
+                self._close(classifier, batch)
+
+        if leader:
+            batch.full.wait(self.window)
+            with self.lock:
+                self._close(classifier, batch)
+            self._run(classifier, batch.items)
+        return [future.result() for future in futures]
+
+    def _close(self, classifier, batch: Batch):
+        """Stop new requests joining the batch."""
+        if self.open_batches.get(classifier) is batch:
+            del self.open_batches[classifier]
+        batch.full.set()
+
+    def _run(self, classifier, items: list):
+        """Pad the queued waveforms into one batch and resolve every caller's future."""
+        try: # Everything that can raise, so no caller is left waiting on its future
+            waveforms = [waveform for waveform, _ in items]
+            lengths = torch.tensor([waveform.shape[0] for waveform in waveforms], dtype=torch.float)
+            batch = torch.nn.utils.rnn.pad_sequence(waveforms, batch_first=True)
+            rel_length = lengths / lengths.max()
+            with torch.no_grad():
+                with stage("encode_batch"):
+                    emb = classifier.eval().encode_batch(batch, rel_length)
+            for (_, future), embedding in zip(items, emb):
+                future.set_result(embedding.squeeze(0))
+        except Exception as err:
+            logger.error(f"Batched inference failed for {len(items)} signals: {err}")
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(err)
+        else:
+            logger.debug(f"Ran batch of {len(items)} signals (max length {int(lengths.max())})")
+
+
+if __name__ == "__main__":
+    print("Running main")
@@ -1,73 +1,234 @@
-from cloudpathlib import GSPath, GSClient
 from pathlib import Path
 from loguru import logger
 from torch import load
 import json
+import os
+import threading
+import time
+from collections import Counter
 from dataclasses import dataclass, field
-from labear_api.cloud_connect import storage_client_gc
+from labear_api import backend
+from labear_api.manifest import read_manifest
+from labear_api.model_cache import ModelCache, model_size
+from labear_api.storage import Storage, get_storage, file_md5, write_atomic
+from labear_api.tracing import stage
 
 # Constants
 CLASSIFIER_PATH = Path("data/")
 GC_BUCKET_NAME = "data_labear"
 GC_USERS = "users"
-STORAGE_CLIENT = storage_client_gc()
-
-client = GSClient(storage_client=STORAGE_CLIENT)
+MANIFEST_TTL = int(os.environ.get("MANIFEST_TTL", 300)) # Seconds before a user's manifest is read again
+REVALIDATE_INTERVAL = int(os.environ.get("REVALIDATE_INTERVAL", 60)) # Seconds between checks for new user models, 0 disables
+PRELOAD_USERS = [user for user in os.environ.get("PRELOAD_USERS", "").split(",") if user] # Always loaded at startup
+PRELOAD_TOP_N = int(os.environ.get("PRELOAD_TOP_N", 5)) # Busiest users from earlier runs also loaded at startup
+TRAFFIC_FILE = CLASSIFIER_PATH / "traffic.json"
+SHARED_BACKBONE = os.environ.get("SHARED_BACKBONE", "0") == "1" # Keep only the users' heads and run them on the pretrained encoder
+BACKBONE_TOLERANCE = 1e-3 # Largest difference to the pretrained encoder's weights and statistics a shared-backbone model may have
 
 @dataclass
 class Brains:
-    fine_tuned_classifiers: dict = field(default_factory=dict)
-    gc_users_path: GSPath = field(init=False)
+    fine_tuned_classifiers: ModelCache = field(default_factory=ModelCache)
+    backbone: dict = None # State dicts of the pretrained encoder's modules, see backbone_state()
+    shared_backbone: bool = SHARED_BACKBONE
+    storage: Storage = field(default_factory=get_storage) # Where user models and manifests are read from (see labear_api.storage)
+    load_lock: threading.Lock = field(default_factory=threading.Lock, init=False) # user_data() is called from inference threads
+    manifests: dict = field(default_factory=dict, init=False) # user -> (time read, manifest)
+    stop_revalidation: threading.Event = field(default_factory=threading.Event, init=False)
+    traffic: Counter = field(default_factory=Counter, init=False) # Monitoring requests per user, carried over between runs
 
     def __post_init__(self) -> None:
-        # Initialize the GSPath object
-        self.gc_users_path = GSPath(f"gs://{GC_BUCKET_NAME}/{GC_USERS}", client=client)
+        self.load_traffic()
+
+    def manifest(self, user: str) -> dict:
+        """
+        Return the user's model manifest (see labear_api.manifest), read at most once per 
+        MANIFEST_TTL seconds. Users without a manifest get one built from a folder listing, 
+        which is cached the same way.
+        """
+        read_at, manifest = self.manifests.get(user, (None, None))
+        if read_at is None or time.monotonic() - read_at > MANIFEST_TTL:
+            with stage("manifest"):
+                manifest = read_manifest(user, storage=self.storage) or self.manifest_from_listing(user)
+            self.manifests[user] = (time.monotonic(), manifest)
+        return manifest
+
+    def manifest_from_listing(self, user: str) -> dict:
+        """Build a manifest for a user folder that predates manifests by finding the latest files."""
+        prefix = f"{GC_USERS}/{user}/"
+        files = self.storage.list(GC_BUCKET_NAME, prefix, recursive=False) # Not the recordings below it
+        manifest = {}
+        for file_type, file_extension in [('classifier', '.pt'), ('classes', '.json')]:
+            candidates = [blob for blob in files if blob.name.endswith(file_extension)]
+            if not candidates:
+                continue
+            latest = max(candidates, key=lambda blob: blob.updated or 0)
+            blob = self.storage.info(GC_BUCKET_NAME, latest.name) # Listings may leave out the checksum
+            if blob:
+                manifest[file_type] = {'name': blob.name[len(prefix):], 'generation': blob.generation, 'md5': blob.md5}
+        return manifest
+
+    def has_model(self, user: str) -> bool:
+        """Whether the user's manifest names a fine-tuned classifier."""
+        return bool(self.manifest(user).get('classifier'))
 
-    def load_classifier(self, user: str):
+    def load_classifier(self, user: str, manifest: dict = None):
         """Attempt to load a fine-tuned classifier for a user."""
-        user_path = self.gc_users_path / user
-        classifier_name = self.get_latest_file_in_folder(user_path, file_extension=".pt")
-        if classifier_name:
-            return self._load_user_file(user, classifier_name, 'classifier')
+        entry = (manifest or self.manifest(user)).get('classifier')
+        if entry:
+            return self._load_user_file(user, entry['name'], 'classifier', entry.get('md5'))
         else:
             logger.info(f"No classifier available for user: {user}. Reverting to default classifier.")
             return None
 
-    def load_classes(self, user: str):
+    def load_classes(self, user: str, manifest: dict = None):
         """Load classes for a user from the user's 'cats.json' file."""
-        user_path = self.gc_users_path / user
-        class_name = self.get_latest_file_in_folder(user_path, file_extension=".json")
-        return self._load_user_file(user, class_name, 'classes') or {}
-
-    def brain(self, user: str):
-        """Return the classifier and classes for a user."""
-        # Lazy loading of classifiers and classes if not already loaded
-        if user not in self.fine_tuned_classifiers:
-            logger.info(f"Loading model and classes for user: {user}")
-            classifier = self.load_classifier(user)
-            if classifier is None:
-                return None, None
-            classes = self.load_classes(user)
-            self.fine_tuned_classifiers[user] = {'classifier': classifier, 'classes': classes}
+        entry = (manifest or self.manifest(user)).get('classes', {})
+        return self._load_user_file(user, entry.get('name'), 'classes', entry.get('md5')) or {}
 
+    def user_data(self, user: str):
+        """
+        Return the user's cache entry ({'classifier', 'head', 'classes', 'manifest'}), loading it 
+        if needed, or None for users without a fine-tuned model. 'classifier' is None for users 
+        whose head runs on the shared backbone.
+        """
+        # Users without a fine-tuned model are known from their manifest, which is cached for
+        # MANIFEST_TTL, so they neither count as cache misses nor wait for the load lock
+        if user not in self.fine_tuned_classifiers and not self.has_model(user):
+            return None
+        # Lazy loading of classifiers and classes if not already loaded (or evicted since)
         user_data = self.fine_tuned_classifiers.get(user)
-        return user_data['classifier'], user_data['classes']['cats']
+        if user_data is None:
+            with self.load_lock:
+                user_data = self.fine_tuned_classifiers.peek(user) # Another thread may have loaded it meanwhile
+                if user_data is None:
+                    logger.info(f"Loading model and classes for user: {user}")
+                    user_data = self.load_user(user, self.manifest(user))
+        return user_data
+
+    def load_user(self, user: str, manifest: dict):
+        """Load the classifier and classes named in a manifest and put them in the cache."""
+        user_data = self.fetch_user(user, manifest)
+        if user_data is not None:
+            self.cache_user(user, user_data)
+        return user_data
+
+    def fetch_user(self, user: str, manifest: dict):
+        """Download and load the classifier and classes named in a manifest, without caching them."""
+        model = self.load_classifier(user, manifest)
+        if model is None:
+            return None
+        classifier, head = split_head(model)
+        if classifier is not None and self.shared_backbone and self.backbone is not None:
+            drift = backbone_drift(classifier, self.backbone)
+            if drift <= BACKBONE_TOLERANCE:
+                classifier = None # Only the head is kept, the full copy is freed
+            else:
+                logger.warning(f"Encoder of {user}'s model differs from the pretrained one by {drift:.2g}, keeping the full model")
+        if classifier is not None:
+            classifier = backend.prepare(classifier) # After the comparison, which needs the float weights
+        classes = self.load_classes(user, manifest)
+        return {'classifier': classifier, 'head': head, 'classes': classes, 'manifest': manifest}
+
+    def cache_user(self, user: str, user_data: dict):
+        # Replacing the entry is atomic, requests already holding the old classifier finish with it
+        classifier = user_data['classifier']
+        self.fine_tuned_classifiers.put(user, user_data, model_size(user_data['head'] if classifier is None else classifier))
+
+    def revalidate(self):
+        """Reload cached users whose manifest points at a newer model than the one in memory."""
+        for user in self.fine_tuned_classifiers.keys():
+            try:
+                self.revalidate_user(user)
+            except Exception as err: # One user's storage error does not hold up the others
+                logger.error(f"Revalidating model for {user} failed, keeping the current one: {err}")
+
+    def revalidate_user(self, user: str):
+        """
+        Reload a cached user whose manifest changed. The new model is downloaded and loaded
+        without holding load_lock, so requests loading other users are not held up; the lock
+        is only taken to swap it in.
+        """
+        user_data = self.fine_tuned_classifiers.peek(user)
+        if user_data is None:
+            return # Evicted since the keys were listed
+        self.manifests.pop(user, None)
+        manifest = self.manifest(user)
+        current = model_version(user_data['manifest'])
+        if model_version(manifest) == current:
+            return
+        logger.info(f"New model for user {user}: {model_version(manifest)}, reloading")
+        reloaded = self.fetch_user(user, manifest)
+        if reloaded is None:
+            logger.warning(f"Manifest for {user} has no classifier, keeping the current one")
+            return
+        with self.load_lock: # Not at the same time as a request loading this user
+            user_data = self.fine_tuned_classifiers.peek(user)
+            if user_data is None or model_version(user_data['manifest']) != current:
+                return # Evicted or replaced meanwhile, the next request loads the latest model
+            self.cache_user(user, reloaded)
+
+    def start_revalidation(self, interval: int = REVALIDATE_INTERVAL):
+        """Check for new user models every `interval` seconds on a background thread."""
+        if interval <= 0:
+            return
+        def run():
+            while not self.stop_revalidation.wait(interval):
+                try:
+                    self.revalidate()
+                    self.save_traffic()
+                except Exception as err:
+                    logger.error(f"Model revalidation failed: {err}")
+        self.stop_revalidation.clear()
+        threading.Thread(target=run, name="brains-revalidate", daemon=True).start()
+
+    def count_request(self, user: str):
+        """Count a monitoring request, so the busiest users are preloaded next time."""
+        self.traffic[user] += 1
 
-    def _load_user_file(self, user: str, filename: str, file_type: str):
+    def preload_users(self) -> list:
+        """Users worth loading before the first request: PRELOAD_USERS and the busiest users seen recently."""
+        busiest = [user for user, _ in self.traffic.most_common(PRELOAD_TOP_N)]
+        return list(dict.fromkeys(PRELOAD_USERS + busiest))
+
+    def load_traffic(self):
+        """Read request counts from earlier runs, halved so that older traffic fades out."""
+        try:
+            with open(TRAFFIC_FILE, 'r') as file:
+                counts = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return
+        self.traffic.update({user: count // 2 for user, count in counts.items() if count > 1})
+
+    def save_traffic(self):
+        # Replaced in one rename, every gunicorn worker saves its own counts
+        counts = json.dumps(dict(self.traffic)).encode()
+        write_atomic(TRAFFIC_FILE, lambda file: file.write(counts))
+
+    def _load_user_file(self, user: str, filename: str, file_type: str, md5: str = None):
         """Helper function to load a user's file from cloud or local storage."""
-        user_file_path = self.gc_users_path / user / filename
+        if filename is None:
+            logger.info(f"{file_type} not found for user: {user}")
+            return None
+        blob_name = f"{GC_USERS}/{user}/{filename}"
         local_path = CLASSIFIER_PATH / user / filename
 
-        # Try downloading directly from cloud
+        # A local copy that does not match the manifest checksum is stale
+        if local_path.exists() and md5 and file_md5(local_path) != md5:
+            logger.info(f"Local {file_type} {local_path} does not match manifest, downloading again")
+            local_path.unlink()
+
+        # Try downloading directly from storage
         if not local_path.exists():
             try:
-                logger.info(f"Downloading {file_type} from GCS: {user_file_path}")
-                user_file_path.download_to(local_path)
+                logger.info(f"Downloading {file_type} from storage: {GC_BUCKET_NAME}/{blob_name}")
+                with stage("download", file=file_type):
+                    self.storage.download(GC_BUCKET_NAME, blob_name, local_path, md5)
             except FileNotFoundError:
                 logger.info(f"{file_type} not found for user: {user}")
                 return None
 
-        return self._load_local_file(local_path, file_type)
+        with stage("load", file=file_type):
+            return self._load_local_file(local_path, file_type)
 
     def _load_local_file(self, path: Path, file_type: str):
         """Helper function to load a local file based on its type (classifier or classes)."""
@@ -77,14 +238,49 @@ class Brains:
             with open(path, 'r') as file:
                 return json.load(file)
 
-    def get_latest_file_in_folder(self, path: GSPath, file_extension: str):
-        """Retrieve the latest file in a folder with the given file extension."""
-        files = [f for f in path.glob(f"*{file_extension}") if f.is_file()]
-        if files:
-            # Sort files by modification time
-            latest_file = max(files, key=lambda f: f.stat().st_mtime)
-            return latest_file.name
-        return None
+
+def split_head(model):
+    """
+    (classifier, classification head) of a loaded model file. The file is either a whole 
+    fine-tuned EncoderClassifier or just its trained head, which then has no classifier.
+    """
+    if not hasattr(model, 'mods'):
+        return None, model.eval()
+    return model, model.mods.classifier.eval()
+
+
+def backbone_state(classifier) -> dict:
+    """
+    The state dicts of everything but the head of the pretrained EncoderClassifier, taken 
+    before the inference backend converts it. They hold the same tensors as the model, so 
+    they cost no memory of their own until the backend replaces the model's weights.
+    """
+    return {name: module.state_dict() for name, module in classifier.mods.items() if name != 'classifier'}
+
+
+def backbone_drift(classifier, backbone: dict) -> float:
+    """
+    Largest difference between the weights and statistics of everything but the head of an 
+    EncoderClassifier and the pretrained ones in backbone_state(). Training in train() mode 
+    moves the encoder's batch norm statistics even when only the head is optimised.
+    """
+    drift = 0.0
+    for name, state in backbone.items():
+        if name not in classifier.mods:
+            continue
+        theirs = classifier.mods[name].state_dict()
+        for key, ours in state.items():
+            if key not in theirs or theirs[key].shape != ours.shape or not ours.is_floating_point():
+                continue
+            drift = max(drift, (theirs[key] - ours).abs().max().item())
+    return drift
+
+
+def model_version(manifest: dict):
+    """The parts of a manifest that identify which model files it refers to."""
+    return tuple((entry.get('name'), entry.get('generation'), entry.get('md5'))
+                 for entry in (manifest.get('classifier', {}), manifest.get('classes', {})))
+
      
 if __name__ == "__main__":
     print("Running main")
@@ -1,14 +1,19 @@
-from google.cloud import storage
-from google.cloud.storage import transfer_manager
-from google.oauth2 import service_account
 import os
 import json
 from loguru import logger
 
+from labear_api.storage import get_storage
+from labear_api.tracing import stage
+
+# The Google libraries are imported when first needed: they add seconds to the API's start
+# and are not used at all with the local storage backend.
 
 PROJECT = 'labear'
+UPLOAD_WORKERS = 8
 
 def storage_client_gc():
+    from google.cloud import storage
+    from google.oauth2 import service_account
 
     # GOOGLE_APPLICATION_CREDENTIALS is added to secrets in fly.io which are loaded
     # as environment variables in the fly-machine at runtime.
@@ -25,8 +30,6 @@ def storage_client_gc():
     
     return storage_client
 
-STORAGE_CLIENT = storage_client_gc()
-
 def upload_many_from_files(
     bucket,
     files,
@@ -35,8 +38,9 @@ def upload_many_from_files(
     blob_constructor_kwargs=None,
     *,
     additional_blob_attributes=None,
+    max_workers=UPLOAD_WORKERS,
 ):
-
+    from google.cloud.storage import transfer_manager
     if blob_constructor_kwargs is None:
         blob_constructor_kwargs = {}
     if additional_blob_attributes is None:
@@ -58,13 +62,13 @@ def upload_many_from_files(
         deadline=None,
         raise_exception=False,
         worker_type=transfer_manager.THREAD, # "thread" for smallish files, "process" for large files
-        max_workers=transfer_manager.DEFAULT_MAX_WORKERS,
+        max_workers=max_workers,
     )
 
-def upload_many(bucket_name, files, workers=8):
-    bucket = STORAGE_CLIENT.bucket(bucket_name)
-
-    results = upload_many_from_files(bucket, files)
+def upload_many(bucket_name, files, blob_name_prefix="", workers=UPLOAD_WORKERS):
+    """Uploads files (objects with .filename and .file) in parallel, returns None or an exception per file."""
+    with stage("upload_many"):
+        results = get_storage().upload_many(bucket_name, files, blob_name_prefix=blob_name_prefix, workers=workers)
 
     for file, result in zip(files, results):
     #    # The results list is either `None` or an exception for each filename in
@@ -72,15 +76,15 @@ def upload_many(bucket_name, files, workers=8):
         if isinstance(result, Exception):
             logger.info(f"Failed to upload {file.filename} due to exception: {result}")
         else:
-            logger.info(f"Uploaded {file.filename} to {bucket.name}.")
+            logger.info(f"Uploaded {file.filename} to {bucket_name}.")
+    return results
 
 def upload_blob(bucket_name, file_obj, destination_folder_name, destination_file_name):
     """Uploads a file to the bucket."""
     # Create the full GCS path (including the folder and file name)
     gcs_file_path = os.path.join(destination_folder_name, destination_file_name)
-    bucket = STORAGE_CLIENT.bucket(bucket_name)
-    blob = bucket.blob(gcs_file_path)
-    blob.upload_from_file(file_obj, rewind=True)
+    with stage("upload"):
+        get_storage().write(bucket_name, gcs_file_path, file_obj)
 
     logger.info(
         f"File {destination_file_name} uploaded to {destination_folder_name}."
@@ -88,10 +92,8 @@ def upload_blob(bucket_name, file_obj, destination_folder_name, destination_file
 
 def download_blob(bucket_name, source_blob_name, destination_file_name):
     """Downloads a blob from the bucket."""
-    
-    bucket = STORAGE_CLIENT.bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(destination_file_name)
+    with stage("download"):
+        get_storage().download(bucket_name, source_blob_name, destination_file_name)
 
     logger.info(
         "Downloaded storage object {} from bucket {} to local file {}.".format(
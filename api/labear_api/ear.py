@@ -2,60 +2,168 @@
 An ear is a thing that hears and classifies. This module handles inference for our audio model for classifying sounds. 
 """
 
+import os
+from pathlib import Path
 from typing import BinaryIO
 
+from loguru import logger
 from speechbrain.inference.classifiers import EncoderClassifier
-import torchaudio
 import torch
-import tempfile
-from pydub import AudioSegment
-from labear_api.brain import Brains
+from labear_api import audio, backend
+from labear_api.brain import Brains, backbone_state, model_version
+from labear_api.batcher import Batcher
+from labear_api.embeddings import EmbeddingCache, content_key, encoder_key
+from labear_api.model_cache import share_weights
+from labear_api.predictions import aggregate, is_silent, labelled, silence_result
+from labear_api.tracing import stage
 
-default_classifier = EncoderClassifier.from_hparams(source="speechbrain/urbansound8k_ecapa", savedir="models/gurbansound8k_ecapa")    
+DEFAULT_ENCODER = backend.encoder_name("urbansound8k_ecapa") # Embedding cache key of the pretrained encoder
+TRACED_FORMATS = {"wav", "m4a", "mp3", "aac", "webm", *audio.SNDFILE_FORMATS} # Other formats are traced as "other"
+PRETRAINED_DIR = os.environ.get("PRETRAINED_DIR", "models/gurbansound8k_ecapa") # On the volume, a restart does not fetch it again
+MMAP_WEIGHTS = os.environ.get("MMAP_WEIGHTS", "1") == "1" # Map the pretrained weights from a file all gunicorn workers share
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0)) # Set per worker by labear_api.server, 0 leaves torch's default
 
-brains = Brains()
+if TORCH_THREADS:
+    torch.set_num_threads(TORCH_THREADS)
+default_classifier = EncoderClassifier.from_hparams(source="speechbrain/urbansound8k_ecapa", savedir=PRETRAINED_DIR)
+if MMAP_WEIGHTS:
+    share_weights(default_classifier.mods, Path(PRETRAINED_DIR) / "shared_weights.pt")
+EMBEDDING_SIZE = default_classifier.mods.classifier.weight.shape[-1] # 192 for ECAPA-TDNN, every head takes this many features
 
-def load_audio(file: BinaryIO, format: str):
+brains = Brains(backbone=backbone_state(default_classifier)) # The float weights user models are compared with
+default_classifier = backend.prepare(default_classifier)
+batcher = Batcher()
+embeddings = EmbeddingCache()
+
+def load_audio(file: BinaryIO, format: str, sample_rate: int = None):
+    """
+    Decode an uploaded binary file object into a [time, channels] tensor, like 
+    EncoderClassifier.load_audio. Decoding, trimming and resampling all happen in memory 
+    (see labear_api.audio).
+    """
+    with stage("decode", format=format.lower() if format.lower() in TRACED_FORMATS else "other"):
+        return audio.decode(file.read(), format, sample_rate)
+
+def warm_up(users: list = ()):
     """
-    This implementation copies EncoderClassifier.load_audio, but accepts a binary file 
-    object instead of a file path.
+    Load the given users' models and run a second of silence through every classifier, so 
+    the first real request does not pay for downloads, kernel selection and allocations.
     """
-    signal, sr = None, None
-            
-    with tempfile.TemporaryFile() as tp:
-        audio = AudioSegment.from_file(file, format=format)
-        audio = audio[500:] # Remove first 0.5 second to omit blank signal at beginning of recording
-        audio.export(tp, format='wav')
-        
-        signal, sr = torchaudio.load(tp, channels_first=False)
-    return signal, sr
+    classifiers = {id(default_classifier): default_classifier}
+    for user in users:
+        classifier, *_ = user_classifier(user)
+        classifiers[id(classifier)] = classifier # Users sharing the backbone add nothing to warm up
+    for classifier in classifiers.values():
+        silence = torch.zeros(classifier.audio_normalizer.sample_rate)
+        batcher.embed(classifier, [silence])
+    logger.info(f"Warmed up {len(classifiers)} classifiers for {len(users)} users")
 
 def predict(user: str, in_file: BinaryIO, format: str):
     """
     This implemetation copies EncoderClassifier.classify_file, but accepts a binary file 
-    object instead of a file path.
-    """
-    pretrained_only = False
-    classifier, cats = brains.brain(user) # gets a specific brain (classifier) associated with user
-    if classifier is None:
-        classifier = default_classifier
-        pretrained_only = True
-    signal, sr = load_audio(in_file, format)
-    waveform = classifier.audio_normalizer(signal, sr)
-    batch = waveform.unsqueeze(0)
-    rel_length = torch.tensor([1.0])
-    emb = classifier.eval().encode_batch(batch, rel_length)
-    probs = classifier.eval().mods.classifier(emb).squeeze()
-    score, index = torch.max(probs, dim=-1)
-    if pretrained_only:
-        prediction = classifier.hparams.label_encoder.decode_torch(torch.tensor([index]))
-        # Build a dictionary like {classname: probability} from tensor of probabilities
-        # using the classifier's index to label dict 
-        probabilities = {classifier.hparams.label_encoder.ind2lab[i]: prob for i, prob in enumerate(probs.tolist())}
-    else:
-        prediction = [cats[index]]
-        probabilities = {cats[i]: prob for i, prob in enumerate(probs.tolist())}
-    return probabilities, prediction, score
+    object instead of a file path. Concurrent calls for the same classifier share one 
+    forward pass (see labear_api.batcher).
+    """
+    return predict_many(user, [(in_file, format)])[0]
+
+def predict_many(user: str, in_files: list):
+    """
+    Classify several (binary file object, format) pairs for a user as one batch. Returns 
+    (probabilities, prediction, score) for each file, in order.
+    """
+    classifier, head, cats, encoder = user_classifier(user)
+    signals = [load_audio(in_file, format, classifier.audio_normalizer.sample_rate) for in_file, format in in_files]
+    return classify(classifier, head, cats, signals, encoder)
+
+def predict_signals(user: str, signals: list):
+    """Classify already decoded (signal, sample rate) pairs, e.g. windows of a stream."""
+    classifier, head, cats, encoder = user_classifier(user)
+    return classify(classifier, head, cats, signals, encoder)
+
+def embed_files(user: str, in_files: list):
+    """
+    The encoder key and an embedding for each (binary file object, format) pair, from the 
+    encoder the user's predictions would use. Pass both to score_embedding.
+    """
+    classifier, _, _, encoder = user_classifier(user)
+    sample_rate = classifier.audio_normalizer.sample_rate
+    waveforms = [classifier.audio_normalizer(*load_audio(in_file, format, sample_rate)) for in_file, format in in_files]
+    return encoder, embed(classifier, waveforms, encoder)
+
+def score_embedding(users: list, embedding, encoder: str):
+    """
+    Run one embedding (a tensor or list of floats) through the classification heads of several 
+    users. Users whose model has a different encoder get None: the embedding means nothing to 
+    their head.
+    """
+    embedding = torch.as_tensor(embedding)
+    results = {}
+    for user in users:
+        _, head, cats, user_encoder = user_classifier(user)
+        results[user] = labelled(head_probabilities(head, embedding.unsqueeze(0))[0], cats) if user_encoder == encoder else None
+    return results
+
+def user_classifier(user: str):
+    """
+    The classifier whose encoder the user's audio goes through, the head scoring its 
+    embeddings, the class names and the encoder key (which embeddings in the cache the head 
+    can use). Users without a fine-tuned model get the pretrained classifier and its labels, 
+    users whose head runs on the shared backbone get the pretrained encoder and their own head.
+    """
+    user_data = brains.user_data(user) # gets a specific brain (classifier) associated with user
+    if user_data is None:
+        # Use the pretrained classifier's index to label dict
+        ind2lab = default_classifier.hparams.label_encoder.ind2lab
+        cats = [ind2lab[i] for i in range(len(ind2lab))]
+        return default_classifier, default_classifier.mods.classifier, cats, DEFAULT_ENCODER
+    if user_data['classifier'] is None:
+        return default_classifier, user_data['head'], user_data['classes']['cats'], DEFAULT_ENCODER
+    # A full fine-tuned model has its own encoder, embeddings are only shared with the same version of it
+    encoder = backend.encoder_name(encoder_key(user, *model_version(user_data['manifest'])))
+    return user_data['classifier'], user_data['head'], user_data['classes']['cats'], encoder
+
+def classify(classifier, head, cats: list, signals: list, encoder: str = None):
+    """
+    Classify (signal, sample rate) pairs in one batch. Signals below SILENCE_RMS are reported 
+    as silence straight away without running the model.
+    """
+    results = [silence_result() if is_silent(signal) else None for signal, _ in signals]
+    waveforms = [classifier.audio_normalizer(signal, sr) for (signal, sr), result in zip(signals, results) if result is None]
+    if not waveforms:
+        return results
+    batch = iter(head_probabilities(head, torch.stack(embed(classifier, waveforms, encoder))))
+    for n, result in enumerate(results):
+        if result is None:
+            results[n] = labelled(next(batch), cats)
+    return results
+
+def embed(classifier, waveforms: list, encoder: str = None) -> list:
+    """
+    The classifier's embedding of each normalised waveform. With an encoder key, embeddings 
+    of audio seen before come from the cache and only the rest go through the encoder.
+    """
+    if encoder is None:
+        with stage("embed", model=model_label(classifier)):
+            return batcher.embed(classifier, waveforms)
+    keys = [content_key(encoder, waveform) for waveform in waveforms]
+    found = [embeddings.get(key) for key in keys]
+    missing = [i for i, embedding in enumerate(found) if embedding is None]
+    if missing:
+        with stage("embed", model=model_label(classifier)):
+            computed = batcher.embed(classifier, [waveforms[i] for i in missing])
+        for i, embedding in zip(missing, computed):
+            embeddings.put(keys[i], embedding)
+            found[i] = embedding
+    return found
+
+def head_probabilities(head, emb):
+    """Class probabilities [batch, classes] from a classification head for embeddings [batch, dim]."""
+    with torch.no_grad(), stage("head", model=model_label(head)):
+        return head(emb.unsqueeze(1)).squeeze(1)
+
+def model_label(model) -> str:
+    """Tracing label telling the pretrained classifier (or its head) from fine-tuned ones."""
+    return "pretrained" if model is default_classifier or model is default_classifier.mods.classifier else "finetuned"
 
 if __name__ == "__main__":
     print("Running main")
\ No newline at end of file
@@ -0,0 +1,119 @@
+"""
+A cache of ECAPA embeddings keyed by the content of the audio they were computed from.
+Retried uploads and debug traffic send the same clip more than once, and the encoder is
+by far the most expensive part of a prediction, so a repeated clip only costs a hash and
+a run through the (tiny) classification head. Entries are kept in a byte-bounded LRU and
+can be written to disk on shutdown and read back on the next start.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import torch
+from loguru import logger
+
+from labear_api.storage import write_atomic
+
+# Constants
+EMBEDDING_CACHE_BYTES = int(os.environ.get("EMBEDDING_CACHE_MB", 16)) * 2**20 # An ECAPA embedding is 768 bytes
+EMBEDDING_CACHE_FILE = os.environ.get("EMBEDDING_CACHE_FILE", "") # e.g. data/embeddings.pt, empty keeps the cache in memory only
+
+
+def encoder_key(*parts) -> str:
+    """Short stable key for an encoder, e.g. from a user and their model version."""
+    return hashlib.blake2b(repr(parts).encode(), digest_size=8).hexdigest()
+
+
+def content_key(encoder: str, waveform) -> str:
+    """Cache key for a normalised waveform run through the encoder identified by `encoder`."""
+    digest = hashlib.blake2b(waveform.contiguous().numpy().tobytes(), digest_size=16)
+    digest.update(str(waveform.shape).encode())
+    return f"{encoder}:{digest.hexdigest()}"
+
+
+@dataclass
+class EmbeddingCache:
+    budget: int = EMBEDDING_CACHE_BYTES
+    path: str = EMBEDDING_CACHE_FILE
+    entries: OrderedDict = field(default_factory=OrderedDict, init=False) # Least recently used first
+    size: int = field(default=0, init=False) # Bytes held
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    evictions: int = field(default=0, init=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def get(self, key: str):
+        """Return the cached embedding for key (marking it recently used), or None."""
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, key: str, embedding):
+        embedding = embedding.detach().clone() # Don't keep the whole batch alive through a view
+        with self.lock:
+            if key in self.entries:
+                self.size -= nbytes(self.entries.pop(key))
+            self.entries[key] = embedding
+            self.size += nbytes(embedding)
+            while self.size > self.budget and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= nbytes(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "budget": self.budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def load(self):
+        """Read embeddings saved by an earlier run, if persisting is enabled."""
+        if not self.path or not Path(self.path).exists():
+            return
+        try:
+            saved = torch.load(self.path)
+        except Exception as err:
+            logger.error(f"Could not read embedding cache {self.path}: {err}")
+            return
+        for key, embedding in saved.items(): # Saved least recently used first
+            self.put(key, embedding)
+        logger.info(f"Loaded {len(saved)} cached embeddings from {self.path}")
+
+    def save(self):
+        """
+        Write the embeddings to disk. Every gunicorn worker saves on shutdown, so the file is
+        replaced in one rename and a reader never sees a partly written one.
+        """
+        if not self.path:
+            return
+        with self.lock:
+            saved = dict(self.entries)
+        write_atomic(self.path, lambda file: torch.save(saved, file))
+        logger.info(f"Saved {len(saved)} cached embeddings to {self.path}")
+
+
+def nbytes(tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+if __name__ == "__main__":
+    print("Running main")
@@ -0,0 +1,60 @@
+"""
+A bounded thread pool for CPU-bound inference, so a slow decode or forward pass does not
+hold up the event loop (and every other connection) while it runs.
+"""
+
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from loguru import logger
+
+# Constants
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 8)) # Also bounds how many requests can share a batch
+INFERENCE_QUEUE_DEPTH = int(os.environ.get("INFERENCE_QUEUE_DEPTH", 32)) # Jobs allowed to wait for a free worker
+INFERENCE_RETRY_AFTER = int(os.environ.get("INFERENCE_RETRY_AFTER", 2)) # Seconds, sent with 503 when the queue is full
+
+
+class QueueFull(Exception):
+    """Raised when the executor has no room for another job."""
+
+
+@dataclass
+class InferenceExecutor:
+    workers: int = INFERENCE_WORKERS
+    queue_depth: int = INFERENCE_QUEUE_DEPTH
+    pending: int = field(default=0, init=False) # Jobs running or waiting in the pool
+
+    def __post_init__(self) -> None:
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self.lock = threading.Lock()
+
+    async def run(self, func, *args):
+        """Run func(*args) on the pool and await the result. Raises QueueFull if the queue is at capacity."""
+        with self.lock:
+            if self.pending >= self.workers + self.queue_depth:
+                logger.warning(f"Inference queue full ({self.pending} jobs pending)")
+                raise QueueFull()
+            self.pending += 1
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context() # Stages timed in the worker count towards the request's Server-Timing
+        return await loop.run_in_executor(self.pool, context.run, self._call, func, args)
+
+    def _call(self, func, args):
+        # Released in the worker rather than by the awaiting coroutine, so a client that
+        # disconnects mid-request does not free a slot that is still busy.
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    print("Running main")
@@ -1,15 +1,23 @@
+import asyncio
+from contextlib import asynccontextmanager
 from typing import List
 
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse
 import os
-from dataclasses import dataclass
-from influxdb_client_3 import InfluxDBClient3, Point
-from influxdb_client import InfluxDBClient
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
 from loguru import logger
+from pydantic import BaseModel
 
-import labear_api.ear as ear
-from labear_api.cloud_connect import upload_blob
+# Only light modules are imported here. torch, speechbrain and the models (labear_api.ear) are
+# loaded by a background task after startup, so / and the health checks answer straight away.
+from labear_api import tracing
+from labear_api.uploader import Uploader
+from labear_api.executor import InferenceExecutor, QueueFull, INFERENCE_RETRY_AFTER
 
 # Cloud data
 BUCKET = "data_labear"
@@ -20,17 +28,33 @@ GC_USERS = "users"
 #API 
 URL = "http://127.0.0.1:8000"
 LEARN = "/learn"
+LEARN_STATUS = LEARN + "/{job_id}"
 MONITOR = "/monitor"
+MONITOR_STREAM = MONITOR + "/stream"
+EMBED = "/embed"
+SCORE = "/score"
+STATS = "/stats"
+METRICS = "/metrics"
+READY = "/ready"
+STREAM_MAX_WINDOW = 60 # Seconds, longer windows would make every stream hold minutes of audio
+STREAM_MAX_CHANNELS = 8
+POLICY_VIOLATION = 1008 # Websocket close code for unusable stream parameters
 URL_LEARN = URL + LEARN
 URL_MON = URL + MONITOR
 
 # DASHBOARD
-TOKEN = os.environ['INFLUX_DB']
+TOKEN = os.environ.get('INFLUX_DB') # Without it, dashboard records are not written
 DEV = "Dev team"
-HOST = "https://us-east-1-1.aws.cloud2.influxdata.com"
+HOST = os.environ.get("INFLUX_HOST", "https://us-east-1-1.aws.cloud2.influxdata.com") # Benchmarks point this at a local stub
 DATA_BASE = "metrics"
 DASHBOARD_LEARN = LEARN.split('/')[-1]
 DASHBOARD_MONITOR = MONITOR.split('/')[-1]
+METRICS_QUEUE_SIZE = int(os.environ.get("METRICS_QUEUE_SIZE", 10000)) # Oldest records are dropped beyond this
+METRICS_BATCH_SIZE = int(os.environ.get("METRICS_BATCH_SIZE", 500))
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5)) # Seconds
+METRICS_RETRIES = 5
+METRICS_BACKOFF = 0.5 # Seconds, doubled for every retry
+METRICS_BACKOFF_CAP = 30
 
 
 @dataclass
@@ -39,9 +63,19 @@ class Metrics:
     org: str = DEV
     host: str = HOST
     database: str = DATA_BASE
+    queue_size: int = METRICS_QUEUE_SIZE
+    batch_size: int = METRICS_BATCH_SIZE
+    flush_interval: float = METRICS_FLUSH_INTERVAL
+    dropped: int = field(default=0, init=False) # Records lost to a full queue or failed retries
 
     def __post_init__(self) -> None:
-        self.client = InfluxDBClient3(host=self.host, token=self.token, org=self.org, database=self.database)
+        # One long lived client (created by the writer thread), so requests never wait on the dashboard
+        self.client = None
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
     """
             Example:
             .. code-block:: python
@@ -57,53 +91,195 @@ class Metrics:
     def post_records(self, data, application):
         record = {}
         record['fields'] = {}
-        with InfluxDBClient(HOST, TOKEN) as client:
-            time = data['request_info'].pop('time_stamp')
-            files = data['request_info']['files']
-            for file in files:
-                record['fields'].update(file)
-            record['time'] = int(time)
-            record['measurement'] = application
-            record['tags'] = data['request_info']
-            if application == DASHBOARD_MONITOR:
-                record['fields'].update(data['prediction']['probabilities'])
-             # use the client to access the necessary APIs
-            # for example, write data using the write_api
-            with client.write_api() as writer:
-                writer.write(bucket=self.database, org=self.org, record=record, write_precision='ms')
+        tags = dict(data['request_info']) # Leave the response itself untouched
+        time = tags.pop('time_stamp')
+        for file in tags['files']:
+            record['fields'].update(file)
+        for count in ('suppressed', 'queue_depth'): # Counts, so fields rather than tags
+            if count in tags:
+                record['fields'][count] = tags.pop(count)
+        record['time'] = int(time)
+        record['measurement'] = application
+        record['tags'] = tags
+        if application == DASHBOARD_MONITOR:
+            record['fields'].update(data['prediction']['probabilities'])
+        self.enqueue(record)
 
     def post_data_point(self, data, application):
+        from influxdb_client_3 import Point
         point = Point(application)
         for key, value in data.items():
             point.field(key, value)
-        self.client.write(record=point, write_precision="ms", timeout=5)
+        self.enqueue(point)
+
+    def enqueue(self, record):
+        """Queue a record for the writer thread, dropping the oldest record if the queue is full."""
+        if not self.token:
+            return
+        with self.lock:
+            if len(self.queue) >= self.queue_size:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(record)
+            if len(self.queue) >= self.batch_size:
+                self.wake.set()
+
+    def start(self):
+        if not self.token:
+            logger.warning("INFLUX_DB is not set, dashboard metrics are not written")
+            return
+        self.writer.start()
+
+    def stop(self):
+        """Stop the writer thread after a last flush of whatever is queued."""
+        self.stopped.set()
+        self.wake.set()
+        if self.writer.is_alive():
+            self.writer.join(timeout=METRICS_BACKOFF_CAP)
+
+    def _run(self):
+        from influxdb_client_3 import InfluxDBClient3 # Pulls in pyarrow, so not at import time
+        self.client = InfluxDBClient3(host=self.host, token=self.token, org=self.org, database=self.database)
+        while not self.stopped.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        while True:
+            with self.lock:
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            if not batch:
+                return
+            self._write(batch)
+
+    def _write(self, batch):
+        for attempt in range(METRICS_RETRIES):
+            try:
+                with tracing.stage("influx_write"):
+                    self.client.write(record=batch, write_precision="ms")
+                return
+            except Exception as err:
+                # Full jitter, so a fleet of machines does not retry against InfluxDB in lockstep
+                delay = random.uniform(0, min(METRICS_BACKOFF_CAP, METRICS_BACKOFF * 2**attempt))
+                logger.warning(f"Writing {len(batch)} records to InfluxDB failed ({err}), retrying in {delay:0.1f}s")
+                if self.stopped.wait(delay) and attempt > 0:
+                    break # Shutting down, do not hold it up with more retries
+        logger.error(f"Dropping {len(batch)} records after failing to write them to InfluxDB")
+        with self.lock:
+            self.dropped += len(batch)
+
+    def stats(self) -> dict:
+        return {"queued": len(self.queue), "dropped": self.dropped}
     
 
 
-app = FastAPI()
 metrics = Metrics()
+inference = InferenceExecutor()
+uploader = Uploader()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    metrics.start()
+    uploader.resume()
+    app.state.models = asyncio.create_task(asyncio.to_thread(load_models))
+    warm_up_task = asyncio.create_task(warm_up(app))
+    yield
+    warm_up_task.cancel()
+    ear = loaded_models()
+    if ear is not None:
+        ear.brains.stop_revalidation.set()
+        ear.brains.save_traffic()
+        ear.embeddings.save()
+    inference.shutdown()
+    uploader.shutdown()
+    metrics.stop()
+
+def load_models():
+    """Import labear_api.ear (torch, speechbrain and the pretrained classifier) and start its caches."""
+    start = time.perf_counter()
+    import labear_api.ear as ear
+    ear.embeddings.load()
+    ear.brains.start_revalidation()
+    logger.info(f"Models loaded in {time.perf_counter() - start:0.1f}s")
+    return ear
+
+async def models():
+    """labear_api.ear, waiting for it to load if the server has just started."""
+    return await asyncio.shield(app.state.models) # A client giving up does not cancel the load
+
+def loaded_models():
+    """labear_api.ear if it has loaded, otherwise None."""
+    task = app.state.models
+    if not task.done() or task.cancelled() or task.exception() is not None:
+        return None
+    return task.result()
+
+async def warm_up(app: FastAPI):
+    """Wait for the models, preload the busiest users' models and warm every classifier, then report ready."""
+    try:
+        ear = await app.state.models
+    except Exception as err:
+        logger.error(f"Loading models failed: {err}")
+        return
+    users = ear.brains.preload_users()
+    logger.info(f"Warming up with users: {users}")
+    try:
+        await inference.run(ear.warm_up, users)
+    except Exception as err:
+        logger.error(f"Warm-up failed, serving cold: {err}")
+    app.state.ready = True
+
+app = FastAPI(lifespan=lifespan)
+
+async def trace_requests(request: Request, call_next):
+    """Time the whole request and, with SERVER_TIMING, report its stages in a Server-Timing header."""
+    timings = {}
+    token = tracing.request_timings.set(timings if tracing.SERVER_TIMING else None)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        tracing.request_timings.reset(token)
+    total = time.perf_counter() - start
+    if tracing.tracer.enabled:
+        tracing.tracer.observe("request", (("endpoint", traced_endpoint(request.url.path)),), total)
+    if tracing.SERVER_TIMING:
+        response.headers["Server-Timing"] = tracing.server_timing(timings, total)
+    return response
+
+def traced_endpoint(path: str) -> str:
+    """The endpoint a path belongs to, so job ids and unknown paths don't each get a histogram."""
+    if path in (LEARN, MONITOR, EMBED, SCORE, STATS, READY, METRICS):
+        return path
+    return LEARN_STATUS if path.startswith(LEARN + "/") else "other"
+
+if tracing.TRACING or tracing.SERVER_TIMING:
+    app.middleware("http")(trace_requests) # Not installed at all otherwise
 
 def log_fileinfo(files: list[UploadFile]):
     logger.info("Files received:")
     for file in files:
         logger.info(f"{file.filename} ({file.size/1000:0.2f} KB)")
         
-def gc_upload_files(user_id, files):
-    # just do single (first) file for now
-    # TODO handle multiple files
-    file = files[0].file
-    file_name = files[0].filename
+async def gc_upload_files(user_id, files):
+    """Spool the files for a background upload to the user's folder and return the upload job."""
     destination_folder = f'{GC_USERS}/{user_id}/{USER_DATA}/' 
-    upload_blob(BUCKET, file, destination_folder, file_name)
-    logger.info(f"File {file_name} uploaded to {destination_folder}.")
+    job = await uploader.spool(BUCKET, destination_folder, files)
+    logger.info(f"{len(files)} files queued for upload to {destination_folder} (job {job.job_id}).")
+    return job
 
 
-@app.post(LEARN)
+@app.post(LEARN, status_code=202)
 async def submit(
     user_id: str = Form(...),
     class_id: str = Form(...),
     time_stamp: int = Form(...),
     files: List[UploadFile] = File(...),
+    suppressed: int = Form(0), # Silent recordings the client skipped since its last upload
+    queue_depth: int = Form(0), # Recordings still waiting on the client after this request
 ):
 
     log_fileinfo(files)
@@ -113,22 +289,35 @@ async def submit(
             "user_id": user_id,
             "class_id": class_id,
             "time_stamp": time_stamp,
+            "suppressed": suppressed,
+            "queue_depth": queue_depth,
             "files": [
                 {"size": file.size, "name": file.filename} for file in files
             ]
         }
     }
-    gc_upload_files(user_id=user_id, files=files)
+    job = await gc_upload_files(user_id=user_id, files=files)
     metrics.post_records(response, DASHBOARD_LEARN)
+    response["job_id"] = job.job_id
     return response
 
 
+@app.get(LEARN_STATUS)
+async def learn_status(job_id: str):
+    status = uploader.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"No upload job {job_id}")
+    return status
+
+
 @app.post(MONITOR)
 async def monitor(
     user_id: str = Form(...),
     class_id: str = Form(...),
     time_stamp: int = Form(...),
     files: List[UploadFile] = File(...),
+    suppressed: int = Form(0), # Silent recordings the client skipped since its last upload
+    queue_depth: int = Form(0), # Recordings still waiting on the client after this request
 ):
     log_fileinfo(files)
 
@@ -137,29 +326,180 @@ async def monitor(
             "user_id": user_id,
             "class_id": class_id,
             "time_stamp": time_stamp,
+            "suppressed": suppressed,
+            "queue_depth": queue_depth,
             "files": [
                 {"size": file.size, "name": file.filename} for file in files
             ]
         }
     }
-    # just do single (first) file for now
-    # TODO handle multiple files
-
-    file = files[0].file
-    format = files[0].filename.split(".")[-1] 
-    probabilities, prediction, score  = ear.predict(user_id, file, format)
+    # All files are classified in one batch, the aggregate prediction averages over the ones that are not silent
+    ear = await models()
+    ear.brains.count_request(user_id)
+    in_files = [(file.file, file.filename.split(".")[-1]) for file in files]
+    results = await run_inference(ear.predict_many, user_id, in_files)
+    probabilities, prediction, score = ear.aggregate(results)
     response["prediction"] = {
         "probabilities": probabilities,
         "prediction": prediction,
-        "score": score.item()
+        "score": score.item(),
+        "files": [
+            {"name": file.filename, "probabilities": file_probabilities, "prediction": file_prediction, "score": file_score.item()}
+            for file, (file_probabilities, file_prediction, file_score) in zip(files, results)
+        ]
     }
     if user_id == "debug":
-        gc_upload_files(user_id=user_id, files=files)
+        await gc_upload_files(user_id=user_id, files=files)
 
     metrics.post_records(response, DASHBOARD_MONITOR)
 
     return response
 
+@app.post(EMBED)
+async def embed(
+    user_id: str = Form(...),
+    files: List[UploadFile] = File(...),
+):
+    """
+    The embedding of each file from the encoder the user's predictions use. `encoder` says 
+    which heads can score them (see SCORE).
+    """
+    ear = await models()
+    in_files = [(file.file, file.filename.split(".")[-1]) for file in files]
+    encoder, embeddings = await run_inference(ear.embed_files, user_id, in_files)
+    return {
+        "encoder": encoder,
+        "embeddings": [{"name": file.filename, "embedding": embedding.tolist()} for file, embedding in zip(files, embeddings)],
+    }
+
+
+class ScoreRequest(BaseModel):
+    embedding: List[float]
+    encoder: str
+    users: List[str]
+
+
+@app.post(SCORE)
+async def score(request: ScoreRequest):
+    """
+    Score one embedding from EMBED with the heads of several users (users without a 
+    fine-tuned model use the pretrained urbansound8k head). Users whose model has a 
+    different encoder than the embedding get an error instead of a prediction.
+    """
+    ear = await models()
+    if len(request.embedding) != ear.EMBEDDING_SIZE:
+        raise HTTPException(status_code=422, detail=f"embedding has {len(request.embedding)} values, the heads take {ear.EMBEDDING_SIZE}")
+    results = await run_inference(ear.score_embedding, request.users, request.embedding, request.encoder)
+    scores = {}
+    for user, result in results.items():
+        if result is None:
+            scores[user] = {"error": f"{user}'s model uses a different encoder, embed the audio with user_id={user}"}
+            continue
+        probabilities, prediction, score = result
+        scores[user] = {"probabilities": probabilities, "prediction": prediction, "score": score.item()}
+    return {"encoder": request.encoder, "scores": scores}
+
+
+async def run_inference(func, *args):
+    """Run func on the inference pool, answering 503 if too many requests are waiting already."""
+    try:
+        return await inference.run(func, *args)
+    except QueueFull:
+        raise HTTPException(status_code=503, detail="Inference queue is full, try again later",
+                            headers={"Retry-After": str(INFERENCE_RETRY_AFTER)})
+
+@app.websocket(MONITOR_STREAM)
+async def monitor_stream(
+    websocket: WebSocket,
+    user_id: str,
+    class_id: str = "stream",
+    sample_rate: int = 48000,
+    channels: int = 1,
+    window: float = None, # Seconds, STREAM_WINDOW by default
+    hop: float = None, # Seconds, STREAM_HOP by default
+):
+    """
+    Continuous monitoring: the client sends raw 16 bit PCM frames as binary messages and gets 
+    a prediction (as JSON) back for every `window` seconds of audio, once every `hop` seconds.
+    """
+    await websocket.accept()
+    error = stream_parameter_error(sample_rate, channels, window, hop)
+    if error:
+        logger.warning(f"Rejecting stream for {user_id}: {error}")
+        await websocket.close(code=POLICY_VIOLATION, reason=error)
+        return
+    ear = await models()
+    from labear_api.stream import SlidingWindow, STREAM_WINDOW, STREAM_HOP, SAMPLE_WIDTH # Needs torch, loaded by now
+    window = STREAM_WINDOW if window is None else window
+    hop = STREAM_HOP if hop is None else hop
+    stream = SlidingWindow(window=int(window * sample_rate), hop=max(1, int(hop * sample_rate)), channels=channels)
+    logger.info(f"Streaming for {user_id}: {window}s windows every {hop}s at {sample_rate} Hz")
+    try:
+        while True:
+            for signal in stream.push(await websocket.receive_bytes()):
+                end = stream.seconds(sample_rate)
+                ear.brains.count_request(user_id)
+                try:
+                    results = await inference.run(ear.predict_signals, user_id, [(signal, sample_rate)])
+                except QueueFull:
+                    logger.warning(f"Inference queue full, skipping stream window ending at {end:0.1f}s for {user_id}")
+                    continue
+                probabilities, prediction, score = results[0]
+                response = {
+                    "request_info": {
+                        "user_id": user_id,
+                        "class_id": class_id,
+                        "time_stamp": round(time.time() * 1000),
+                        "files": [{"size": len(signal) * channels * SAMPLE_WIDTH, "name": MONITOR_STREAM}]
+                    },
+                    "prediction": {
+                        "probabilities": probabilities,
+                        "prediction": prediction,
+                        "score": score.item(),
+                        "start": end - len(signal) / sample_rate,
+                        "end": end,
+                    }
+                }
+                metrics.post_records(response, DASHBOARD_MONITOR)
+                await websocket.send_json(response)
+    except WebSocketDisconnect:
+        logger.info(f"Stream for {user_id} closed after {stream.seconds(sample_rate):0.1f}s")
+
+def stream_parameter_error(sample_rate: int, channels: int, window: float, hop: float):
+    """
+    What is wrong with the query parameters of a stream, or None if they can be used. The 
+    comparisons are written so that a NaN window or hop fails them.
+    """
+    if sample_rate <= 0:
+        return f"sample_rate must be positive, got {sample_rate}"
+    if not 0 < channels <= STREAM_MAX_CHANNELS:
+        return f"channels must be between 1 and {STREAM_MAX_CHANNELS}, got {channels}"
+    if window is not None and not (0 < window <= STREAM_MAX_WINDOW and window * sample_rate >= 1):
+        return f"window must be at least one frame and at most {STREAM_MAX_WINDOW}s, got {window}"
+    if hop is not None and not 0 < hop <= STREAM_MAX_WINDOW:
+        return f"hop must be positive and at most {STREAM_MAX_WINDOW}s, got {hop}"
+    return None
+
+@app.get(STATS)
+async def stats():
+    ear = loaded_models()
+    if ear is None:
+        return {"models": "loading", "metrics": metrics.stats()}
+    return {"model_cache": ear.brains.fine_tuned_classifiers.stats(), "embedding_cache": ear.embeddings.stats(),
+            "metrics": metrics.stats()}
+
+# Prometheus scrape target, empty unless TRACING=1
+@app.get(METRICS, response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(tracing.tracer.render(), media_type="text/plain; version=0.0.4")
+
+# fly.io health check, only passes once the models are warm
+@app.get(READY)
+async def ready():
+    if not app.state.ready:
+        return JSONResponse(status_code=503, content={"ready": False})
+    return {"ready": True}
+
 # Redirect root url to docs
 @app.get("/")
 async def docs_redirect():
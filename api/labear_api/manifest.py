@@ -0,0 +1,65 @@
+"""
+Per-user model manifests. Each user folder in the bucket holds a small manifest.json that
+names the current classifier and classes files together with their GCS generation numbers
+and checksums, so the API can find a user's model with a single GET instead of listing the
+folder and stat'ing every file in it.
+
+Publish a newly trained model (and update the manifest) with:
+
+    poetry run python -m labear_api.manifest <user> <classifier.pt> <cats.json>
+"""
+
+import argparse
+import io
+import json
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from labear_api.storage import Storage, get_storage
+
+# Constants
+GC_BUCKET_NAME = "data_labear"
+GC_USERS = "users"
+MANIFEST_NAME = "manifest.json"
+
+
+def manifest_blob_name(user: str) -> str:
+    return f"{GC_USERS}/{user}/{MANIFEST_NAME}"
+
+
+def read_manifest(user: str, bucket_name: str = GC_BUCKET_NAME, storage: Storage = None):
+    """Return the user's manifest, or None if the user does not have one."""
+    try:
+        return json.loads((storage or get_storage()).read(bucket_name, manifest_blob_name(user)))
+    except FileNotFoundError:
+        return None
+
+
+def publish_model(user: str, classifier_file, classes_file, bucket_name: str = GC_BUCKET_NAME, storage: Storage = None):
+    """Upload a fine-tuned classifier and its classes for a user and point the manifest at them."""
+    storage = storage or get_storage()
+    manifest = {"updated": round(time.time() * 1000)}
+    for file_type, path in [("classifier", Path(classifier_file)), ("classes", Path(classes_file))]:
+        with open(path, "rb") as file:
+            blob = storage.write(bucket_name, f"{GC_USERS}/{user}/{path.name}", file)
+        manifest[file_type] = {"name": path.name, "generation": blob.generation, "md5": blob.md5}
+        logger.info(f"Uploaded {file_type} {path.name} for {user} (generation {blob.generation})")
+    # Written last, so the API never sees a manifest pointing at files that are not there yet
+    storage.write(bucket_name, manifest_blob_name(user), io.BytesIO(json.dumps(manifest, indent=2).encode()))
+    logger.info(f"Manifest updated for {user}")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish a fine-tuned model for a user")
+    parser.add_argument("user", type=str, help="User the model belongs to")
+    parser.add_argument("classifier", type=Path, help="Fine-tuned classifier (.pt)")
+    parser.add_argument("classes", type=Path, help="Classes for the classifier (.json)")
+    args = parser.parse_args()
+    print(json.dumps(publish_model(args.user, args.classifier, args.classes), indent=2))
+
+
+if __name__ == "__main__":
+    main()
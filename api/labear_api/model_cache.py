@@ -0,0 +1,144 @@
+"""
+A bounded LRU cache for user models. Entries are sized by the parameters and buffers they
+hold, and the least recently used models are dropped once the byte budget is exceeded.
+Pinned users are never evicted.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from loguru import logger
+
+from labear_api.storage import write_atomic
+
+# Constants
+MODEL_CACHE_BYTES = int(os.environ.get("MODEL_CACHE_MB", 400)) * 2**20 # The fly.io VM has 1 GB in total
+PINNED_USERS = [user for user in os.environ.get("PINNED_USERS", "").split(",") if user]
+
+
+def model_size(model) -> int:
+    """
+    Bytes held by a model's parameters and buffers (shared tensors are counted once). The 
+    state dict is used rather than parameters(), as it includes the weights of int8 layers.
+    """
+    seen = set()
+    size = 0
+    for tensor in model.state_dict().values():
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        size += tensor.numel() * tensor.element_size()
+    return size
+
+
+def share_weights(model, path: Path):
+    """
+    Replace the parameters and buffers of a model with tensors memory-mapped from a copy of its
+    state dict at path, written on first use (or again if it no longer matches the model).
+    Nothing writes to the weights during inference, so every process mapping the file reads
+    the same pages of the page cache instead of holding a private copy.
+    """
+    import torch # Only loaded by the processes that run models
+    path = Path(path)
+    state = model.state_dict()
+    try:
+        mapped = torch.load(path, mmap=True, weights_only=True)
+    except (FileNotFoundError, RuntimeError, EOFError):
+        mapped = None
+    if mapped is None or mapped.keys() != state.keys() or not all(torch.equal(mapped[key], state[key]) for key in state):
+        # Workers starting together may each write it, the last rename wins and all copies are equal
+        write_atomic(path, lambda file: torch.save(state, file))
+        mapped = torch.load(path, mmap=True, weights_only=True)
+        logger.info(f"Wrote {model_size(model)/2**20:0.1f} MB of weights to {path}")
+    model.load_state_dict(mapped, assign=True)
+    return model
+
+
+@dataclass
+class ModelCache:
+    budget: int = MODEL_CACHE_BYTES
+    pinned: set = field(default_factory=lambda: set(PINNED_USERS))
+    entries: OrderedDict = field(default_factory=OrderedDict, init=False) # Least recently used first
+    sizes: dict = field(default_factory=dict, init=False)
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    evictions: int = field(default=0, init=False)
+    lock: threading.RLock = field(default_factory=threading.RLock, init=False)
+
+    def get(self, key):
+        """Return the cached entry for key (marking it recently used), or None."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def peek(self, key):
+        """Return the cached entry for key without touching recency or counters."""
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, value, size: int):
+        """Add an entry of `size` bytes and evict others until the cache fits its budget."""
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.sizes[key] = size
+            self._evict()
+
+    def pin(self, key):
+        with self.lock:
+            self.pinned.add(key)
+
+    def unpin(self, key):
+        with self.lock:
+            self.pinned.discard(key)
+            self._evict()
+
+    def keys(self) -> list:
+        with self.lock:
+            return list(self.entries)
+
+    def size(self) -> int:
+        return sum(self.sizes.values())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size(),
+                "budget": self.budget,
+                "pinned": sorted(self.pinned),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _evict(self):
+        # The newest entry always stays, even if it alone is over budget, so it can be used at least once
+        for key in list(self.entries)[:-1]:
+            if self.size() <= self.budget:
+                break
+            if key in self.pinned:
+                continue
+            del self.entries[key]
+            size = self.sizes.pop(key)
+            self.evictions += 1
+            logger.info(f"Evicted model for {key} ({size/2**20:0.1f} MB) from cache")
+        if self.size() > self.budget:
+            logger.warning(f"Model cache over budget: {self.size()/2**20:0.1f} MB in use, {self.budget/2**20:0.1f} MB allowed")
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+if __name__ == "__main__":
+    print("Running main")
@@ -0,0 +1,42 @@
+"""
+Predictions as the API returns them: (probabilities, [prediction], score) per file, and their
+aggregate over the files of a request. Kept apart from labear_api.ear so they can be used
+without loading the models.
+"""
+
+import os
+
+import torch
+
+SILENCE = "silence"
+SILENCE_RMS = float(os.environ.get("SILENCE_RMS", 1e-4)) # Signals quieter than this skip the model, 0 disables
+
+
+def labelled(probs, cats: list):
+    score, index = torch.max(probs, dim=-1)
+    # Build a dictionary like {classname: probability} from tensor of probabilities
+    probabilities = {cats[i]: prob for i, prob in enumerate(probs.tolist())}
+    return probabilities, [cats[index]], score
+
+def is_silent(signal) -> bool:
+    return signal.numel() == 0 or signal.square().mean().sqrt().item() < SILENCE_RMS
+
+def silence_result():
+    return {SILENCE: 1.0}, [SILENCE], torch.tensor(1.0)
+
+def is_silence_result(result) -> bool:
+    probabilities, _, _ = result
+    return probabilities.keys() == {SILENCE}
+
+def aggregate(results: list):
+    """
+    Average per-file probabilities into one (probabilities, prediction, score) for the whole request.
+    Silent files were never classified, so they are left out; the request is silent only if every file is.
+    """
+    results = [result for result in results if not is_silence_result(result)]
+    if not results:
+        return silence_result()
+    labels = list(dict.fromkeys(label for probabilities, _, _ in results for label in probabilities))
+    probs = torch.tensor([[probabilities.get(label, 0.0) for label in labels] for probabilities, _, _ in results]).mean(dim=0)
+    score, index = torch.max(probs, dim=-1)
+    return dict(zip(labels, probs.tolist())), [labels[index]], score
@@ -0,0 +1,81 @@
+"""
+Production server: gunicorn with uvicorn workers. Only the app and its light imports are
+loaded in the master, so every worker answers / and /ready as soon as it is forked, like a
+single uvicorn process does. Each worker then loads torch and the models on its background
+task (see labear_api.main). The pretrained weights are memory-mapped from one file (see
+MMAP_WEIGHTS in labear_api.ear), so the workers share a single copy of them in the page
+cache instead of each holding its own.
+Each worker runs torch on its share of the CPUs so the workers don't fight over cores.
+
+    poetry run python -m labear_api.server
+    WEB_CONCURRENCY=4 poetry run serve
+"""
+
+import gc
+import os
+
+from gunicorn.app.base import BaseApplication
+from loguru import logger
+
+# Constants
+CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", CPUS)) # Worker processes
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0)) # Per worker, 0 splits the CPUs evenly between the workers
+BIND = os.environ.get("BIND", "0.0.0.0:8000")
+WORKER_TIMEOUT = int(os.environ.get("WORKER_TIMEOUT", 120)) # Seconds before a silent worker is restarted
+
+
+def freeze_heap(server):
+    """
+    gunicorn when_ready hook, run in the master once the listening sockets are bound and before
+    any worker is forked. Objects that survive until the fork are never collected, so the
+    workers' garbage collector does not write to (and so copy) every page holding them.
+    Nothing heavy is imported here: a model load in the master would hold up every worker.
+    """
+    gc.collect()
+    gc.freeze()
+    logger.info(f"Forking {server.cfg.workers} workers")
+
+
+def partition_threads(server, worker):
+    """
+    gunicorn post_fork hook: give every worker its share of the CPUs for torch. torch is not
+    imported yet, labear_api.ear applies TORCH_THREADS when the worker loads it.
+    """
+    threads = TORCH_THREADS or max(1, CPUS // server.cfg.workers)
+    os.environ["TORCH_THREADS"] = str(threads)
+    logger.info(f"Worker {worker.pid} runs torch on {threads} threads")
+
+
+class Server(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from labear_api.main import app
+        return app
+
+
+def options(workers: int = WEB_CONCURRENCY, bind: str = BIND) -> dict:
+    return {
+        "bind": bind,
+        "workers": workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": True, # Import the (light) app once in the master rather than in every worker
+        "timeout": WORKER_TIMEOUT,
+        "when_ready": freeze_heap,
+        "post_fork": partition_threads,
+    }
+
+
+def run():
+    Server(options()).run()
+
+
+if __name__ == "__main__":
+    run()
@@ -2,4 +2,9 @@ import uvicorn
 
 def start():
     """Launched with `poetry run start` at root level"""
-    uvicorn.run("labear_api.main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run("labear_api.main:app", host="0.0.0.0", port=8000, reload=True)
+
+def serve():
+    """Production server with several workers sharing the models, launched with `poetry run serve` (see labear_api.server)"""
+    from labear_api.server import run
+    run()
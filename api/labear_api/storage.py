@@ -0,0 +1,364 @@
+"""
+Object storage for user models, manifests and uploaded recordings. STORAGE_BACKEND picks
+where blobs live:
+
+- "gcs": Google Cloud Storage (the default). The client is only created on first use, so
+  importing the API needs no credentials.
+- "local": a directory tree (STORAGE_ROOT/<bucket>/<blob name>), for edge deployments and
+  for running and benchmarking the API offline.
+- "memory": a dict in the process, for experiments and scripts.
+
+With STORAGE_CACHE set (e.g. data/storage_cache on the fly.io volume), reads go through a
+local copy that is checked against the blob's generation at most every STORAGE_CACHE_TTL
+seconds, in the background once the copy has been checked before, and served stale if the
+backend cannot be reached.
+"""
+
+import abc
+import base64
+import functools
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from loguru import logger
+
+# Constants
+BACKENDS = ("gcs", "local", "memory")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "gcs")
+STORAGE_ROOT = Path(os.environ.get("STORAGE_ROOT", "data/storage")) # Where the local backend keeps its buckets
+STORAGE_CACHE = os.environ.get("STORAGE_CACHE", "") # Read-through cache directory, empty disables
+STORAGE_CACHE_TTL = float(os.environ.get("STORAGE_CACHE_TTL", 60)) # Seconds a cached copy is used before it is checked again
+GENERATION_SUFFIX = ".generation" # Next to each cached file, the generation it was fetched at
+CHUNK_SIZE = 2**20
+
+if STORAGE_BACKEND not in BACKENDS:
+    raise ValueError(f"STORAGE_BACKEND must be one of {BACKENDS}, got {STORAGE_BACKEND!r}")
+
+# generation changes whenever the blob is written, md5 is base64 encoded like GCS's md5_hash
+BlobInfo = namedtuple("BlobInfo", ["name", "size", "updated", "generation", "md5"])
+
+
+class Storage(abc.ABC):
+    """
+    Blob operations every backend provides. Missing blobs raise FileNotFoundError (or give
+    None from info). Uploads take the files as objects with .filename and .file, like the
+    API's UploadFiles.
+    """
+    @abc.abstractmethod
+    def read(self, bucket: str, name: str) -> bytes:
+        ...
+
+    @abc.abstractmethod
+    def write(self, bucket: str, name: str, file_obj) -> BlobInfo:
+        ...
+
+    @abc.abstractmethod
+    def info(self, bucket: str, name: str):
+        ...
+
+    @abc.abstractmethod
+    def list(self, bucket: str, prefix: str = "", recursive: bool = True) -> list:
+        """
+        Blobs whose name starts with prefix, without those in subfolders below the prefix
+        unless recursive. md5 may be None here, info() always has it.
+        """
+
+    def download(self, bucket: str, name: str, path: Path, md5: str = None):
+        """
+        Write the blob to a local file. The file only appears once it is complete. Callers
+        that know which version they want (e.g. from a manifest) pass its md5, so that a
+        cache does not hand them an older copy.
+        """
+        write_atomic(path, lambda file: file.write(self.read(bucket, name)))
+
+    def upload_many(self, bucket: str, files: list, blob_name_prefix: str = "", workers: int = 8) -> list:
+        """Upload files in parallel, returning None or the exception for each file, in order."""
+        def upload(file):
+            try:
+                self.write(bucket, blob_name_prefix + file.filename, file.file)
+            except Exception as err:
+                return err
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(upload, files))
+
+
+@dataclass
+class GCSStorage(Storage):
+    _client: object = field(default=None, init=False)
+    _pid: int = field(default=None, init=False) # Process the client was created in
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    @property
+    def client(self):
+        """
+        The google.cloud.storage client, created on first use. A forked worker creates its own
+        rather than sharing the connections of the process it was forked from.
+        """
+        with self.lock:
+            if self._client is None or self._pid != os.getpid():
+                from labear_api.cloud_connect import storage_client_gc
+                self._client = storage_client_gc()
+                self._pid = os.getpid()
+            return self._client
+
+    def read(self, bucket: str, name: str) -> bytes:
+        from google.api_core.exceptions import NotFound
+        try:
+            return self.client.bucket(bucket).blob(name).download_as_bytes()
+        except NotFound:
+            raise FileNotFoundError(f"gs://{bucket}/{name}") from None
+
+    def write(self, bucket: str, name: str, file_obj) -> BlobInfo:
+        blob = self.client.bucket(bucket).blob(name)
+        blob.upload_from_file(file_obj, rewind=True) # The upload response fills in generation and md5_hash
+        return gcs_info(blob)
+
+    def info(self, bucket: str, name: str):
+        blob = self.client.bucket(bucket).get_blob(name)
+        return gcs_info(blob) if blob else None
+
+    def list(self, bucket: str, prefix: str = "", recursive: bool = True) -> list:
+        blobs = self.client.list_blobs(bucket, prefix=prefix, delimiter=None if recursive else "/")
+        return [gcs_info(blob) for blob in blobs]
+
+    def download(self, bucket: str, name: str, path: Path, md5: str = None):
+        from google.api_core.exceptions import NotFound
+        blob = self.client.bucket(bucket).blob(name)
+        try:
+            write_atomic(path, blob.download_to_file)
+        except NotFound:
+            raise FileNotFoundError(f"gs://{bucket}/{name}") from None
+
+    def upload_many(self, bucket: str, files: list, blob_name_prefix: str = "", workers: int = 8) -> list:
+        from labear_api.cloud_connect import upload_many_from_files
+        return upload_many_from_files(self.client.bucket(bucket), files, blob_name_prefix=blob_name_prefix, max_workers=workers)
+
+
+@dataclass
+class LocalStorage(Storage):
+    root: Path = STORAGE_ROOT
+
+    def path(self, bucket: str, name: str) -> Path:
+        path = (self.root / bucket / name).resolve()
+        if not path.is_relative_to((self.root / bucket).resolve()):
+            raise ValueError(f"Blob name {name!r} points outside the bucket")
+        return path
+
+    def read(self, bucket: str, name: str) -> bytes:
+        return self.path(bucket, name).read_bytes()
+
+    def write(self, bucket: str, name: str, file_obj) -> BlobInfo:
+        file_obj.seek(0)
+        path = self.path(bucket, name)
+        write_atomic(path, lambda file: shutil.copyfileobj(file_obj, file, CHUNK_SIZE))
+        return self.info(bucket, name)
+
+    def info(self, bucket: str, name: str):
+        path = self.path(bucket, name)
+        if not path.is_file():
+            return None
+        return self._info(path, name)
+
+    def list(self, bucket: str, prefix: str = "", recursive: bool = True) -> list:
+        bucket_path = self.root / bucket
+        folder = self.path(bucket, prefix.rpartition("/")[0]) # Only walk the folder the prefix is in
+        if not folder.is_dir():
+            return []
+        blobs = []
+        for path in sorted(folder.rglob("*") if recursive else folder.glob("*")):
+            name = path.relative_to(bucket_path.resolve()).as_posix()
+            if path.is_file() and name.startswith(prefix) and not name.endswith(".partial"):
+                blobs.append(self._info(path, name, md5=False)) # Hashing every file would make listings slow
+        return blobs
+
+    def download(self, bucket: str, name: str, path: Path, md5: str = None):
+        with open(self.path(bucket, name), "rb") as source: # A missing blob raises before anything is written
+            write_atomic(path, lambda file: shutil.copyfileobj(source, file, CHUNK_SIZE))
+
+    def _info(self, path: Path, name: str, md5: bool = True) -> BlobInfo:
+        stat = path.stat()
+        return BlobInfo(name, stat.st_size, stat.st_mtime, stat.st_mtime_ns, file_md5(path) if md5 else None)
+
+
+@dataclass
+class MemoryStorage(Storage):
+    blobs: dict = field(default_factory=dict, init=False) # (bucket, name) -> (content, BlobInfo)
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def read(self, bucket: str, name: str) -> bytes:
+        with self.lock:
+            if (bucket, name) not in self.blobs:
+                raise FileNotFoundError(f"{bucket}/{name}")
+            return self.blobs[(bucket, name)][0]
+
+    def write(self, bucket: str, name: str, file_obj) -> BlobInfo:
+        file_obj.seek(0)
+        content = file_obj.read()
+        with self.lock:
+            info = BlobInfo(name, len(content), time.time(), time.time_ns(), md5_base64(content))
+            self.blobs[(bucket, name)] = (content, info)
+        return info
+
+    def info(self, bucket: str, name: str):
+        with self.lock:
+            _, info = self.blobs.get((bucket, name), (None, None))
+            return info
+
+    def list(self, bucket: str, prefix: str = "", recursive: bool = True) -> list:
+        with self.lock:
+            return [info for (blob_bucket, name), (_, info) in sorted(self.blobs.items())
+                    if blob_bucket == bucket and name.startswith(prefix) and (recursive or "/" not in name[len(prefix):])]
+
+
+@dataclass
+class CachedStorage(Storage):
+    """
+    Read-through cache of another backend's blobs in a local directory. A copy checked against
+    the blob's generation within the last `ttl` seconds is used as it is. An older one is
+    used while it is checked again in the background, so reads only wait for the backend
+    when the blob was not checked since the process started or does not match a given md5.
+    """
+    backend: Storage
+    root: Path
+    ttl: float = STORAGE_CACHE_TTL
+    checked: dict = field(default_factory=dict, init=False) # (bucket, name) -> time.monotonic() of the last check
+    refreshing: set = field(default_factory=set, init=False) # (bucket, name) being checked in the background
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+    pool: ThreadPoolExecutor = field(default_factory=lambda: ThreadPoolExecutor(1, thread_name_prefix="storage-cache"),
+                                     init=False)
+
+    def read(self, bucket: str, name: str) -> bytes:
+        return self.cached(bucket, name).read_bytes()
+
+    def download(self, bucket: str, name: str, path: Path, md5: str = None):
+        with open(self.cached(bucket, name, md5), "rb") as source:
+            write_atomic(path, lambda file: shutil.copyfileobj(source, file, CHUNK_SIZE))
+
+    def write(self, bucket: str, name: str, file_obj) -> BlobInfo:
+        info = self.backend.write(bucket, name, file_obj)
+        generation_path(self.cache_path(bucket, name)).unlink(missing_ok=True) # Fetched again on the next read
+        return info
+
+    def info(self, bucket: str, name: str):
+        return self.backend.info(bucket, name)
+
+    def list(self, bucket: str, prefix: str = "", recursive: bool = True) -> list:
+        return self.backend.list(bucket, prefix, recursive)
+
+    def upload_many(self, bucket: str, files: list, blob_name_prefix: str = "", workers: int = 8) -> list:
+        return self.backend.upload_many(bucket, files, blob_name_prefix, workers) # Recordings are never read back
+
+    def cache_path(self, bucket: str, name: str) -> Path:
+        return LocalStorage(self.root).path(bucket, name)
+
+    def cached(self, bucket: str, name: str, md5: str = None) -> Path:
+        """The local copy of a blob, fetched first if it is missing, never checked or not the md5 asked for."""
+        path = self.cache_path(bucket, name)
+        with self.lock:
+            checked = self.checked.get((bucket, name))
+        if checked is None or not generation_path(path).exists() or not path.exists() or (md5 and file_md5(path) != md5):
+            return self.refresh(bucket, name)
+        if time.monotonic() - checked > self.ttl:
+            with self.lock:
+                if (bucket, name) not in self.refreshing:
+                    self.refreshing.add((bucket, name))
+                    self.pool.submit(self._refresh_in_background, bucket, name)
+        return path
+
+    def refresh(self, bucket: str, name: str) -> Path:
+        """Check the local copy of a blob against its generation and fetch it again if it changed."""
+        path = self.cache_path(bucket, name)
+        generation_file = generation_path(path)
+        try:
+            info = self.backend.info(bucket, name)
+        except Exception as err:
+            if path.exists():
+                logger.warning(f"Storage unreachable ({err}), using cached copy of {bucket}/{name}")
+                self._checked(bucket, name) # Tried again after the TTL rather than on every read
+                return path
+            raise
+        if info is None:
+            generation_file.unlink(missing_ok=True)
+            raise FileNotFoundError(f"{bucket}/{name}")
+        if not (path.exists() and generation_file.exists() and generation_file.read_text() == str(info.generation)):
+            self.backend.download(bucket, name, path)
+            generation_file.write_text(str(info.generation))
+        self._checked(bucket, name)
+        return path
+
+    def _checked(self, bucket: str, name: str):
+        with self.lock:
+            self.checked[(bucket, name)] = time.monotonic()
+
+    def _refresh_in_background(self, bucket: str, name: str):
+        try:
+            self.refresh(bucket, name)
+        except Exception as err:
+            logger.warning(f"Checking cached copy of {bucket}/{name} failed: {err}")
+        finally:
+            with self.lock:
+                self.refreshing.discard((bucket, name))
+
+
+@functools.cache
+def get_storage() -> Storage:
+    """The configured storage, created on first use and shared by the whole process."""
+    storage = create_storage(STORAGE_BACKEND)
+    if STORAGE_CACHE:
+        storage = CachedStorage(storage, Path(STORAGE_CACHE))
+    logger.info(f"Storage: {STORAGE_BACKEND}" + (f", cached in {STORAGE_CACHE}" if STORAGE_CACHE else ""))
+    return storage
+
+
+def create_storage(backend: str, root: Path = STORAGE_ROOT) -> Storage:
+    if backend == "gcs":
+        return GCSStorage()
+    if backend == "local":
+        return LocalStorage(Path(root))
+    return MemoryStorage()
+
+
+def generation_path(path: Path) -> Path:
+    return path.with_name(path.name + GENERATION_SUFFIX)
+
+
+def gcs_info(blob) -> BlobInfo:
+    updated = blob.updated.timestamp() if blob.updated else None
+    return BlobInfo(blob.name, blob.size, updated, blob.generation, blob.md5_hash)
+
+
+def write_atomic(path: Path, write):
+    """Create path by calling write(file) on a partial file that is renamed once complete."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.partial") # Concurrent writers don't share it
+    try:
+        with open(partial, "wb") as file:
+            write(file)
+        os.replace(partial, path)
+    finally:
+        partial.unlink(missing_ok=True)
+
+
+def md5_base64(data: bytes) -> str:
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+def file_md5(path: Path) -> str:
+    """Base64 encoded MD5 of a local file, as GCS reports it in md5_hash."""
+    digest = hashlib.md5()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode()
+
+
+if __name__ == "__main__":
+    print("Running main")
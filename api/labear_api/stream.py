@@ -0,0 +1,77 @@
+"""
+Sliding-window classification of continuous audio. Raw PCM frames arriving over a stream are
+written into a fixed-size ring buffer, and a copy of the latest window is handed out every
+`hop` frames for classification.
+"""
+
+from dataclasses import dataclass, field
+
+import torch
+
+from labear_api.audio import decode_pcm
+
+# Constants
+STREAM_WINDOW = 5.0 # Seconds of audio classified at a time
+STREAM_HOP = 1.0 # Seconds between the starts of consecutive windows
+SAMPLE_WIDTH = 2 # Streams are 16 bit PCM
+
+
+@dataclass
+class SlidingWindow:
+    window: int # Frames per window
+    hop: int # Frames between windows
+    channels: int = 1
+    frames: int = field(default=0, init=False) # Frames received in total
+    position: int = field(default=0, init=False) # Next write index in the ring buffer
+    countdown: int = field(init=False) # Frames until the next window is complete
+    partial: bytes = field(default=b"", init=False) # Bytes of a frame split across messages
+
+    def __post_init__(self) -> None:
+        self.buffer = torch.zeros((self.window, self.channels))
+        self.countdown = self.window
+
+    def push(self, data: bytes) -> list:
+        """Add raw int16 PCM bytes to the buffer and return every window completed by them."""
+        frame_bytes = SAMPLE_WIDTH * self.channels
+        data = self.partial + data if self.partial else data
+        usable = len(data) - len(data) % frame_bytes
+        self.partial = bytes(data[usable:])
+        samples = decode_pcm(memoryview(data)[:usable], self.channels)
+
+        windows = []
+        while len(samples):
+            step = min(len(samples), self.countdown)
+            self._write(samples[:step])
+            samples = samples[step:]
+            self.countdown -= step
+            if self.countdown == 0:
+                windows.append(self.latest())
+                self.countdown = self.hop
+        return windows
+
+    def latest(self):
+        """A copy of the buffer, oldest frame first."""
+        return torch.cat((self.buffer[self.position:], self.buffer[:self.position]))
+
+    def seconds(self, sample_rate: int) -> float:
+        return self.frames / sample_rate
+
+    def _write(self, samples):
+        count = len(samples)
+        self.frames += count
+        if count >= self.window:
+            self.buffer[:] = samples[-self.window:]
+            self.position = 0
+            return
+        end = self.position + count
+        if end <= self.window:
+            self.buffer[self.position:end] = samples
+        else:
+            split = self.window - self.position
+            self.buffer[self.position:] = samples[:split]
+            self.buffer[:count - split] = samples[split:]
+        self.position = end % self.window
+
+
+if __name__ == "__main__":
+    print("Running main")
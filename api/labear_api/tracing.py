@@ -0,0 +1,111 @@
+"""
+Per-stage latency tracing. The expensive stages of a request (audio decoding, manifest reads,
+model downloads and loads, the encoder, storage transfers, dashboard writes) are timed with
+`stage()` and recorded in histograms labelled by stage and, where known, the model in use
+and the audio format. GET /metrics serves them in the Prometheus text format.
+
+With SERVER_TIMING=1 every HTTP response also gets a Server-Timing header with the time its
+request spent in each stage, so clients can log it next to their own timings. With both
+switched off `stage()` hands back one shared no-op context manager.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+
+# Constants
+TRACING = os.environ.get("TRACING", "0") == "1" # Record stage histograms for /metrics
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1" # Add a Server-Timing header to every response
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # Seconds
+METRIC_NAME = "labear_stage_seconds"
+NOOP = nullcontext()
+
+# Stage durations of the current request, set by the Server-Timing middleware
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+@dataclass
+class Histogram:
+    counts: list = field(default_factory=lambda: [0] * (len(BUCKETS) + 1)) # Last one is +Inf
+    total: float = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+
+
+@dataclass
+class Tracer:
+    enabled: bool = TRACING
+    histograms: dict = field(default_factory=dict, init=False) # (stage, labels) -> Histogram
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram()
+            histogram.observe(seconds)
+
+    def render(self) -> str:
+        """All histograms in the Prometheus text exposition format."""
+        lines = [f"# HELP {METRIC_NAME} Time spent in each stage of a request", f"# TYPE {METRIC_NAME} histogram"]
+        with self.lock:
+            histograms = [(key, list(histogram.counts), histogram.total) for key, histogram in self.histograms.items()]
+        for (name, labels), counts, total in sorted(histograms):
+            series = ",".join([f'stage="{name}"'] + [f'{key}="{value}"' for key, value in labels])
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{METRIC_NAME}_bucket{{{series},le="{bound}"}} {cumulative}')
+            lines.append(f"{METRIC_NAME}_sum{{{series}}} {total}")
+            lines.append(f"{METRIC_NAME}_count{{{series}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class Stage:
+    """Times the block it wraps and records it under its name and labels."""
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name: str, labels: tuple):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        if tracer.enabled:
+            tracer.observe(self.name, self.labels, seconds)
+        timings = request_timings.get()
+        if timings is not None:
+            timings[self.name] = timings.get(self.name, 0.0) + seconds
+        return False
+
+
+tracer = Tracer()
+
+
+def stage(name: str, **labels):
+    """
+    Context manager timing a stage, e.g. `with stage("decode", format="wav"):`. Keep label
+    values to a small fixed set, every combination is its own histogram.
+    """
+    if not tracer.enabled and request_timings.get() is None:
+        return NOOP
+    return Stage(name, tuple(sorted(labels.items())))
+
+
+def server_timing(timings: dict, total: float) -> str:
+    """Server-Timing header value for stage durations in seconds, e.g. "decode;dur=3.1, total;dur=48.0"."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in [*timings.items(), ("total", total)])
+
+
+if __name__ == "__main__":
+    print("Running main")
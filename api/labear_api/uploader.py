@@ -0,0 +1,195 @@
+"""
+Background uploads to storage (see labear_api.storage). Files received by the API are first
+written to a spool directory on the local volume and uploaded by a small pool of threads, so
+requests return as soon as the files are on disk. Jobs left in the spool by a restart are
+picked up again on startup.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+
+import aiofiles
+from fastapi import UploadFile
+from loguru import logger
+
+from labear_api.cloud_connect import upload_many
+
+# Constants
+SPOOL_DIR = Path(os.environ.get("SPOOL_DIR", "data/spool")) # data/ is the fly.io volume mount
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 4)) # Jobs uploading at the same time
+UPLOAD_THREADS = int(os.environ.get("UPLOAD_THREADS", 8)) # Files uploading at the same time within a job
+UPLOAD_RETRIES = 5
+UPLOAD_BACKOFF = 2 # Seconds, doubled for every retry
+JOB_HISTORY = 1000 # Finished jobs kept around for status requests
+CHUNK_SIZE = 2**20
+JOB_FILE = "job.json"
+FILES_DIR = "files" # Spooled files, kept apart from the job file and lock whatever the client named them
+LOCK_FILE = ".lock" # Held while a job uploads (in the job's folder) or while jobs are resumed (in the spool)
+
+SpooledFile = namedtuple("SpooledFile", ["filename", "file"]) # What cloud_connect.upload_many expects
+
+
+@dataclass
+class UploadJob:
+    job_id: str
+    bucket: str
+    destination_folder: str
+    files: list # File names as the client sent them, the blob names in destination_folder
+    uploaded: list = field(default_factory=list) # Indices into files
+    state: str = "queued" # queued, uploading, done or failed
+    attempts: int = 0
+    error: str = None
+    created: int = field(default_factory=lambda: round(time.time() * 1000))
+
+    def path(self, spool_dir: Path) -> Path:
+        return spool_dir / self.job_id
+
+    def file_path(self, spool_dir: Path, index: int) -> Path:
+        """Where files[index] is spooled. The index keeps files with the same name apart."""
+        return self.path(spool_dir) / FILES_DIR / f"{index}_{self.files[index]}"
+
+    def save(self, spool_dir: Path):
+        with open(self.path(spool_dir) / JOB_FILE, 'w') as file:
+            json.dump(asdict(self), file)
+
+    def status(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "state": self.state,
+            "files": len(self.files),
+            "uploaded": len(self.uploaded),
+            "attempts": self.attempts,
+            "error": self.error,
+        }
+
+
+@dataclass
+class Uploader:
+    spool_dir: Path = SPOOL_DIR
+    workers: int = UPLOAD_WORKERS
+    jobs: OrderedDict = field(default_factory=OrderedDict, init=False)
+
+    def __post_init__(self) -> None:
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upload")
+
+    async def spool(self, bucket: str, destination_folder: str, files: list[UploadFile]) -> UploadJob:
+        """Write the uploaded files to the spool directory and queue them for upload."""
+        # Only keep the base name, the file name comes from the client
+        job = UploadJob(job_id=uuid.uuid4().hex, bucket=bucket, destination_folder=destination_folder,
+                        files=[Path(file.filename).name for file in files])
+        (job.path(self.spool_dir) / FILES_DIR).mkdir(parents=True)
+        for index, file in enumerate(files):
+            await file.seek(0) # /monitor has already read the file for inference
+            async with aiofiles.open(job.file_path(self.spool_dir, index), 'wb') as out:
+                while chunk := await file.read(CHUNK_SIZE):
+                    await out.write(chunk)
+        job.save(self.spool_dir)
+        self.submit(job)
+        return job
+
+    def submit(self, job: UploadJob):
+        self.jobs[job.job_id] = job
+        while len(self.jobs) > JOB_HISTORY:
+            self.jobs.popitem(last=False)
+        self.pool.submit(self._upload, job)
+
+    def resume(self):
+        """
+        Queue the jobs an earlier run left unfinished in the spool directory. With several
+        worker processes sharing the spool only the first one to start resumes jobs.
+        """
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.resume_lock = open(self.spool_dir / LOCK_FILE, 'w') # Held until the process exits
+        try:
+            fcntl.flock(self.resume_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Another worker resumes the spooled upload jobs")
+            return
+        for job_file in sorted(self.spool_dir.glob(f"*/{JOB_FILE}")):
+            try:
+                with open(job_file, 'r') as file:
+                    job = UploadJob(**json.load(file))
+            except (ValueError, TypeError) as err:
+                logger.error(f"Skipping unreadable upload job {job_file}: {err}")
+                continue
+            if job.state == "done":
+                shutil.rmtree(job_file.parent, ignore_errors=True)
+                continue
+            logger.info(f"Resuming upload job {job.job_id} ({len(job.uploaded)}/{len(job.files)} files uploaded)")
+            job.state = "queued"
+            job.attempts = 0
+            self.submit(job)
+
+    def status(self, job_id: str):
+        """Status of a job, read from the spool if another worker process received it."""
+        job = self.jobs.get(job_id)
+        if job is None and job_id.isalnum():
+            try:
+                with open(self.spool_dir / job_id / JOB_FILE, 'r') as file:
+                    job = UploadJob(**json.load(file))
+            except (FileNotFoundError, ValueError, TypeError):
+                return None
+        return job.status() if job else None
+
+    def shutdown(self):
+        # Jobs still in the spool are resumed on the next start
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _upload(self, job: UploadJob):
+        """Upload a job unless another worker process is uploading it already."""
+        try:
+            lock = open(job.path(self.spool_dir) / LOCK_FILE, 'w')
+        except FileNotFoundError:
+            return # Uploaded and removed by another worker meanwhile
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(f"Upload job {job.job_id} is being uploaded by another worker")
+                return
+            self._upload_job(job)
+
+    def _upload_job(self, job: UploadJob):
+        job_dir = job.path(self.spool_dir)
+        job.state = "uploading"
+        while job.attempts < UPLOAD_RETRIES:
+            job.attempts += 1
+            remaining = [index for index in range(len(job.files)) if index not in job.uploaded]
+            try:
+                with ExitStack() as stack:
+                    files = [SpooledFile(job.files[index], stack.enter_context(open(job.file_path(self.spool_dir, index), 'rb')))
+                             for index in remaining]
+                    results = upload_many(job.bucket, files, blob_name_prefix=job.destination_folder, workers=UPLOAD_THREADS)
+            except Exception as err:
+                results = [err] * len(remaining)
+            for index, result in zip(remaining, results):
+                name = job.files[index]
+                if isinstance(result, Exception):
+                    job.error = f"{name}: {result}"
+                    logger.warning(f"Upload of {name} for job {job.job_id} failed (attempt {job.attempts}): {result}")
+                else:
+                    job.uploaded.append(index)
+            job.save(self.spool_dir)
+            if len(job.uploaded) == len(job.files):
+                job.state = "done"
+                job.error = None
+                shutil.rmtree(job_dir, ignore_errors=True)
+                logger.info(f"Upload job {job.job_id} done ({len(job.files)} files)")
+                return
+            time.sleep(UPLOAD_BACKOFF * 2**(job.attempts - 1))
+        job.state = "failed"
+        job.save(self.spool_dir)
+        logger.error(f"Upload job {job.job_id} failed after {job.attempts} attempts, files kept in {job_dir}")
+
+
+if __name__ == "__main__":
+    print("Running main")
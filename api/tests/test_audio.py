@@ -0,0 +1,110 @@
+import io
+import struct
+
+import numpy as np
+import pytest
+import soundfile
+
+pytest.importorskip("torchaudio")
+
+from labear_api import audio
+
+
+def chunk(chunk_id: bytes, body: bytes) -> bytes:
+    """A RIFF chunk, padded to an even length like a writer would."""
+    return chunk_id + struct.pack("<I", len(body)) + body + (b"\0" if len(body) % 2 else b"")
+
+
+def fmt_chunk(tag=audio.WAVE_FORMAT_PCM, channels=1, rate=16000, bits=16, extensible=False) -> bytes:
+    block_align = channels * bits // 8
+    body = struct.pack("<HHIIHH", audio.WAVE_FORMAT_EXTENSIBLE if extensible else tag, channels, rate,
+                       rate * block_align, block_align, bits)
+    if extensible:
+        # cbSize, valid bits, channel mask, then the sub format GUID starting with the real tag
+        body += struct.pack("<HHI", 22, bits, 0) + struct.pack("<H", tag) + b"\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71"
+    return chunk(b"fmt ", body)
+
+
+def wav(*chunks: bytes) -> bytes:
+    body = b"WAVE" + b"".join(chunks)
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+def reference(subtype: str, samples, rate=16000):
+    """The same samples written by libsndfile and read back as float, for comparison."""
+    buffer = io.BytesIO()
+    soundfile.write(buffer, samples, rate, format="WAV", subtype=subtype)
+    data = buffer.getvalue()
+    return data, soundfile.read(io.BytesIO(data), dtype="float32", always_2d=True)[0]
+
+
+@pytest.mark.parametrize("subtype, samples", [
+    ("PCM_U8", np.array([-1.0, -0.5, 0.0, 0.5, 0.99], dtype=np.float32)),
+    ("PCM_16", np.array([-1.0, -0.25, 0.0, 0.25, 0.999], dtype=np.float32)),
+    ("PCM_24", np.array([-1.0, -1e-6, 0.0, 1e-6, 0.999999], dtype=np.float32)),
+    ("PCM_32", np.array([-1.0, -0.5, 0.0, 0.5, 0.999], dtype=np.float32)),
+    ("FLOAT", np.array([-1.0, -0.5, 0.0, 0.5, 1.0], dtype=np.float32)),
+])
+def test_decode_wav_matches_libsndfile(subtype, samples):
+    data, expected = reference(subtype, samples)
+    signal, rate = audio.decode_wav(data)
+    assert rate == 16000
+    assert signal.shape == expected.shape
+    np.testing.assert_allclose(signal.numpy(), expected, atol=1e-6)
+
+
+def test_decode_wav_24_bit_sign_extension():
+    values = [-2**23, -1, 0, 1, 2**23 - 1]
+    data = wav(fmt_chunk(bits=24), chunk(b"data", b"".join(struct.pack("<i", value)[:3] for value in values)))
+    signal, _ = audio.decode_wav(data)
+    np.testing.assert_array_equal(signal[:, 0].numpy(), np.array(values, dtype=np.float32) / 2**23)
+
+
+def test_decode_wav_extensible_stereo():
+    frames = np.array([[1000, -1000], [2000, -2000], [3000, -3000]], dtype=np.int16)
+    data = wav(fmt_chunk(channels=2, extensible=True), chunk(b"data", frames.tobytes()))
+    signal, rate = audio.decode_wav(data)
+    assert rate == 16000
+    np.testing.assert_allclose(signal.numpy(), frames / 2**15)
+
+
+def test_decode_wav_skips_odd_sized_chunks():
+    samples = np.array([1, 2, 3], dtype=np.int16)
+    data = wav(chunk(b"LIST", b"abc"), fmt_chunk(), chunk(b"junk", b"x"), chunk(b"data", samples.tobytes()))
+    signal, _ = audio.decode_wav(data)
+    np.testing.assert_allclose(signal[:, 0].numpy(), samples / 2**15)
+
+
+@pytest.mark.parametrize("size", [0, 0xFFFFFFFF, 1000])
+def test_decode_wav_reads_truncated_and_unsized_data(size):
+    samples = np.array([1, 2, 3, 4], dtype=np.int16)
+    # A streaming writer's placeholder size, or a size claiming more than the upload holds
+    data = wav(fmt_chunk(), b"data" + struct.pack("<I", size) + samples.tobytes() + b"\x05") # Half a frame at the end
+    signal, _ = audio.decode_wav(data)
+    np.testing.assert_allclose(signal[:, 0].numpy(), samples / 2**15)
+
+
+def test_decode_wav_errors():
+    with pytest.raises(ValueError, match="RIFF"):
+        audio.decode_wav(b"OggS" + b"\0" * 40)
+    with pytest.raises(ValueError, match="no data chunk"):
+        audio.decode_wav(wav(fmt_chunk()))
+    with pytest.raises(ValueError, match="before fmt"):
+        audio.decode_wav(wav(chunk(b"data", b"\0\0"), fmt_chunk()))
+    with pytest.raises(ValueError, match="Unsupported"):
+        audio.decode_wav(wav(fmt_chunk(bits=12), chunk(b"data", b"\0\0")))
+
+
+def test_decode_pcm_drops_incomplete_frame():
+    frames = np.array([[1, 2], [3, 4]], dtype=np.int16)
+    signal = audio.decode_pcm(frames.tobytes() + b"\x01\x00", channels=2)
+    assert signal.shape == (2, 2)
+    np.testing.assert_allclose(signal.numpy(), frames / 2**15)
+
+
+def test_decode_trims_and_resamples():
+    samples = np.zeros(16000, dtype=np.float32)
+    data, _ = reference("PCM_16", samples)
+    signal, rate = audio.decode(data, "wav", sample_rate=8000, trim=0.5)
+    assert rate == 8000
+    assert signal.shape == (4000, 1)
@@ -0,0 +1,74 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("speechbrain")
+
+from speechbrain.inference.classifiers import EncoderClassifier
+from speechbrain.lobes.features import Fbank
+from speechbrain.lobes.models.ECAPA_TDNN import ECAPA_TDNN, Classifier
+from speechbrain.processing.features import InputNormalization
+
+from labear_api import backend
+from labear_api.brain import backbone_drift, backbone_state
+from labear_api.model_cache import model_size
+
+
+@pytest.fixture
+def classifier():
+    """An EncoderClassifier shaped like urbansound8k_ecapa, with narrower layers and untrained weights."""
+    torch.manual_seed(0)
+    modules = {
+        "compute_features": Fbank(n_mels=80),
+        "mean_var_norm": InputNormalization(norm_type="sentence", std_norm=False),
+        "embedding_model": ECAPA_TDNN(80, channels=[128, 128, 128, 128, 384], lin_neurons=32),
+        "classifier": Classifier(input_size=32, out_neurons=5),
+    }
+    return EncoderClassifier(modules=modules, hparams={"sample_rate": 16000}, freeze_params=True).eval()
+
+
+def test_float_leaves_the_model_alone(classifier):
+    before = copy.deepcopy(classifier.state_dict())
+    assert backend.prepare(classifier, "float") is classifier
+    assert all(torch.equal(before[key], value) for key, value in classifier.state_dict().items())
+
+
+def test_int8_quantizes_every_conv(classifier):
+    size = model_size(classifier)
+    backend.prepare(classifier, "int8")
+    modules = list(classifier.mods.embedding_model.modules())
+    assert not any(type(module) is torch.nn.Conv1d for module in modules)
+    assert sum(isinstance(module, torch.ao.nn.quantized.Conv1d) for module in modules) == 38
+    assert model_size(classifier) < size / 3 # int8 weights take a quarter of the space
+
+
+def test_int8_matches_float(classifier):
+    torch.manual_seed(1)
+    reference = copy.deepcopy(classifier)
+    backend.prepare(classifier, "int8")
+    # A padded batch of different lengths, like the batcher sends
+    waveforms = 0.1 * torch.randn(3, 32000)
+    lengths = torch.tensor([1.0, 0.8, 0.5])
+    with torch.no_grad():
+        expected = reference.encode_batch(waveforms, lengths).squeeze(1)
+        embeddings = classifier.encode_batch(waveforms, lengths).squeeze(1)
+        probabilities = classifier.mods.classifier(embeddings.unsqueeze(1)).squeeze(1)
+        expected_probabilities = reference.mods.classifier(expected.unsqueeze(1)).squeeze(1)
+    assert torch.nn.functional.cosine_similarity(embeddings, expected).min() > 0.99
+    assert (probabilities - expected_probabilities).abs().max() < 0.05
+
+
+def test_backbone_state_keeps_the_float_weights(classifier):
+    user_model = copy.deepcopy(classifier)
+    state = backbone_state(classifier)
+    backend.prepare(classifier, "int8")
+    assert backbone_drift(user_model, state) == 0
+    with torch.no_grad():
+        user_model.mods.embedding_model.blocks[0].norm.norm.running_mean += 0.01
+    assert backbone_drift(user_model, state) == pytest.approx(0.01)
+
+
+def test_encoder_name():
+    assert backend.encoder_name("urbansound8k_ecapa", "float") == "urbansound8k_ecapa"
+    assert backend.encoder_name("urbansound8k_ecapa", "int8") == "urbansound8k_ecapa:int8"
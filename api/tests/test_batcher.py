@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from labear_api.batcher import Batcher
+
+
+class FakeEncoder:
+    """Stands in for an EncoderClassifier: each embedding is [sum of the padded row, its rel_length]."""
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def eval(self):
+        return self
+
+    def encode_batch(self, batch, rel_length):
+        self.batches.append((batch, rel_length))
+        if self.error:
+            raise self.error
+        return torch.stack([batch.sum(dim=1), rel_length], dim=1).unsqueeze(1) # [batch, 1, 2] like ECAPA
+
+
+def embed_concurrently(batcher, encoder, requests):
+    """Call batcher.embed from one thread per list of waveforms, returning each call's result or exception."""
+    results = [None] * len(requests)
+
+    def run(i, waveforms):
+        try:
+            results[i] = batcher.embed(encoder, waveforms)
+        except Exception as err:
+            results[i] = err
+
+    threads = [threading.Thread(target=run, args=item) for item in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_requests_within_the_window_share_a_batch():
+    batcher, encoder = Batcher(window=0.5, max_size=16), FakeEncoder()
+    results = embed_concurrently(batcher, encoder, [[torch.full((4,), float(i))] for i in range(3)])
+    assert len(encoder.batches) == 1
+    assert encoder.batches[0][0].shape == (3, 4)
+    assert [result[0][0].item() for result in results] == [0, 4, 8] # Everyone gets their own row
+
+
+def test_full_batch_runs_without_waiting_out_the_window():
+    batcher, encoder = Batcher(window=30, max_size=2), FakeEncoder()
+    start = time.monotonic()
+    embed_concurrently(batcher, encoder, [[torch.ones(4)], [torch.ones(4)]])
+    assert time.monotonic() - start < 10
+    assert [len(batch) for batch, _ in encoder.batches] == [2]
+
+
+def test_padding_and_relative_lengths():
+    batcher, encoder = Batcher(window=0), FakeEncoder()
+    first, second = batcher.embed(encoder, [torch.ones(4), torch.ones(2)])
+    batch, rel_length = encoder.batches[0]
+    assert torch.equal(batch, torch.tensor([[1.0, 1, 1, 1], [1, 1, 0, 0]]))
+    assert rel_length.tolist() == [1.0, 0.5]
+    assert first.tolist() == [4.0, 1.0] # One embedding per waveform, without the batch's middle dimension
+    assert second.tolist() == [2.0, 0.5]
+
+
+def test_different_classifiers_batch_separately():
+    batcher, first, second = Batcher(window=0.2), FakeEncoder(), FakeEncoder()
+    threads = [threading.Thread(target=batcher.embed, args=(encoder, [torch.ones(4)])) for encoder in (first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert (len(first.batches), len(second.batches)) == (1, 1)
+
+
+def test_errors_reach_every_caller():
+    batcher, encoder = Batcher(window=0.5), FakeEncoder(error=RuntimeError("out of memory"))
+    results = embed_concurrently(batcher, encoder, [[torch.ones(4)], [torch.ones(2), torch.ones(3)]])
+    assert len(encoder.batches) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert batcher.open_batches == {} # The next request starts a new batch
+    encoder.error = None
+    assert batcher.embed(encoder, [torch.ones(4)])[0].tolist() == [4.0, 1.0]
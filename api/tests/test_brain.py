@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from labear_api.brain import Brains
+from labear_api.manifest import publish_model
+from labear_api.storage import MemoryStorage
+
+USER = "alice"
+
+
+class BlockingStorage(MemoryStorage):
+    """A memory backend whose classifier downloads wait until `released` is set."""
+    def __init__(self):
+        super().__init__()
+        self.downloading = threading.Event()
+        self.released = threading.Event()
+        self.released.set()
+        self.downloads = 0
+
+    def download(self, bucket, name, path, md5=None):
+        self.downloads += 1
+        if name.endswith(".pt"):
+            self.downloading.set()
+            assert self.released.wait(10)
+        super().download(bucket, name, path)
+
+
+@pytest.fixture
+def brains(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # User files are kept under data/
+    return Brains(storage=BlockingStorage())
+
+
+def publish(tmp_path, storage, version):
+    """Publish a head whose bias is `version`, so the loaded model tells which one it is."""
+    head = torch.nn.Linear(4, 2)
+    torch.nn.init.constant_(head.bias, version)
+    path = tmp_path / f"model_{version}.pt"
+    torch.save(head, path)
+    (tmp_path / "cats.json").write_text('{"cats": ["a", "b"]}')
+    publish_model(USER, path, tmp_path / "cats.json", storage=storage)
+
+
+def version(brains):
+    return brains.fine_tuned_classifiers.peek(USER)['head'].bias[0].item()
+
+
+def test_loads_a_user_once(brains, tmp_path):
+    publish(tmp_path, brains.storage, 1)
+    user_data = brains.user_data(USER)
+    assert user_data['classes'] == {"cats": ["a", "b"]}
+    assert brains.user_data(USER) is user_data
+    assert brains.storage.downloads == 2 # The classifier and the classes
+    assert brains.user_data("bob") is None
+
+
+def test_revalidation_reloads_a_new_model(brains, tmp_path):
+    publish(tmp_path, brains.storage, 1)
+    brains.user_data(USER)
+    brains.revalidate()
+    assert brains.storage.downloads == 2 # Unchanged, nothing downloaded again
+    publish(tmp_path, brains.storage, 2)
+    brains.revalidate()
+    assert version(brains) == 2
+
+
+def test_revalidation_loads_without_the_lock(brains, tmp_path):
+    publish(tmp_path, brains.storage, 1)
+    brains.user_data(USER)
+    publish(tmp_path, brains.storage, 2)
+    brains.storage.released.clear()
+    reload = threading.Thread(target=brains.revalidate_user, args=(USER,))
+    reload.start()
+    assert brains.storage.downloading.wait(10)
+    # While the new model downloads, requests can load other users and keep using the old model
+    assert brains.load_lock.acquire(timeout=1)
+    brains.load_lock.release()
+    assert brains.user_data(USER)['head'].bias[0].item() == 1
+    brains.storage.released.set()
+    reload.join()
+    assert version(brains) == 2
+
+
+def test_revalidation_keeps_an_entry_replaced_meanwhile(brains, tmp_path):
+    publish(tmp_path, brains.storage, 1)
+    brains.user_data(USER)
+    publish(tmp_path, brains.storage, 2)
+    brains.storage.released.clear()
+    reload = threading.Thread(target=brains.revalidate_user, args=(USER,))
+    reload.start()
+    assert brains.storage.downloading.wait(10)
+    # Loaded again by a request while the reload downloads, e.g. after an eviction
+    replaced = {'classifier': None, 'head': torch.nn.Linear(4, 2), 'classes': {}, 'manifest': {'classifier': {'name': 'newer.pt'}}}
+    brains.cache_user(USER, replaced)
+    brains.storage.released.set()
+    reload.join()
+    assert brains.fine_tuned_classifiers.peek(USER) is replaced
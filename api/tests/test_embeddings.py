@@ -0,0 +1,39 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from labear_api.embeddings import EmbeddingCache
+
+
+def test_save_and_load(tmp_path):
+    path = tmp_path / "cache" / "embeddings.pt"
+    cache = EmbeddingCache(budget=2**20, path=str(path))
+    cache.put("a", torch.ones(4))
+    cache.put("b", torch.zeros(4))
+    cache.get("a") # Now the most recently used
+    cache.save()
+    loaded = EmbeddingCache(budget=2**20, path=str(path))
+    loaded.load()
+    assert list(loaded.entries) == ["b", "a"]
+    assert torch.equal(loaded.get("a"), torch.ones(4))
+
+
+def test_failed_save_keeps_the_previous_file(tmp_path, monkeypatch):
+    path = tmp_path / "embeddings.pt"
+    cache = EmbeddingCache(budget=2**20, path=str(path))
+    cache.put("a", torch.ones(4))
+    cache.save()
+    cache.put("b", torch.zeros(4))
+
+    def interrupted(obj, file):
+        file.write(b"partial")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(torch, "save", interrupted)
+    with pytest.raises(OSError):
+        cache.save()
+    monkeypatch.undo()
+    assert list(path.parent.iterdir()) == [path] # No partial file left behind
+    loaded = EmbeddingCache(budget=2**20, path=str(path))
+    loaded.load()
+    assert list(loaded.entries) == ["a"]
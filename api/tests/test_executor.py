@@ -0,0 +1,58 @@
+import asyncio
+import contextvars
+import threading
+
+import pytest
+
+from labear_api.executor import InferenceExecutor, QueueFull
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+@pytest.fixture
+def executor():
+    executor = InferenceExecutor(workers=1, queue_depth=1)
+    yield executor
+    executor.shutdown()
+
+
+def test_runs_on_the_pool_with_the_callers_context(executor):
+    async def main():
+        request_id.set("abc")
+        return await executor.run(lambda x: (x * 2, threading.current_thread().name, request_id.get()), 21)
+
+    result, thread, seen = asyncio.run(main())
+    assert result == 42
+    assert thread.startswith("inference")
+    assert seen == "abc"
+
+
+def test_rejects_jobs_beyond_the_queue(executor):
+    release = threading.Event()
+
+    async def main():
+        running = asyncio.ensure_future(executor.run(release.wait, 10))
+        waiting = asyncio.ensure_future(executor.run(lambda: "queued"))
+        await asyncio.sleep(0) # Both submitted: one running, one queued
+        assert executor.pending == 2
+        with pytest.raises(QueueFull):
+            await executor.run(lambda: "rejected")
+        release.set()
+        return await running, await waiting
+
+    assert asyncio.run(main()) == (True, "queued")
+    assert executor.pending == 0
+
+
+def test_failed_jobs_free_their_slot(executor):
+    def fail():
+        raise ValueError("undecodable audio")
+
+    async def main():
+        for _ in range(3):
+            with pytest.raises(ValueError):
+                await executor.run(fail)
+        return await executor.run(lambda: "ok")
+
+    assert asyncio.run(main()) == "ok"
+    assert executor.pending == 0
@@ -0,0 +1,110 @@
+import pytest
+
+from labear_api.model_cache import ModelCache, model_size, share_weights
+
+
+def test_evicts_least_recently_used():
+    cache = ModelCache(budget=30, pinned=set())
+    cache.put("a", "A", 10)
+    cache.put("b", "B", 10)
+    cache.put("c", "C", 10)
+    assert cache.get("a") == "A" # "b" is now the least recently used
+    cache.put("d", "D", 10)
+    assert cache.keys() == ["c", "a", "d"]
+    assert cache.size() == 30
+    assert cache.evictions == 1
+
+
+def test_pinned_users_are_never_evicted():
+    cache = ModelCache(budget=20, pinned={"a"})
+    cache.put("a", "A", 10)
+    cache.put("b", "B", 10)
+    cache.put("c", "C", 10)
+    assert cache.keys() == ["a", "c"]
+    cache.put("d", "D", 15)
+    assert cache.keys() == ["a", "d"] # Over budget, but the pinned and newest entries stay
+
+
+def test_unpin_evicts_once_over_budget():
+    cache = ModelCache(budget=20, pinned={"a", "b"})
+    for key in "abc":
+        cache.put(key, key.upper(), 10)
+    assert cache.keys() == ["a", "b", "c"]
+    cache.unpin("a")
+    assert cache.keys() == ["b", "c"]
+
+
+def test_newest_entry_stays_over_budget():
+    cache = ModelCache(budget=10, pinned=set())
+    cache.put("a", "A", 5)
+    cache.put("b", "B", 50)
+    assert cache.keys() == ["b"]
+    assert cache.peek("b") == "B"
+
+
+def test_replacing_an_entry_updates_its_size():
+    cache = ModelCache(budget=30, pinned=set())
+    cache.put("a", "A", 10)
+    cache.put("a", "A2", 20)
+    assert len(cache) == 1
+    assert cache.size() == 20
+    assert cache.get("a") == "A2"
+
+
+def test_hits_and_misses():
+    cache = ModelCache(budget=30, pinned=set())
+    cache.put("a", "A", 10)
+    assert cache.get("a") == "A"
+    assert cache.get("b") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"], stats["bytes"]) == (1, 1, 1, 10)
+
+
+def test_peek_leaves_recency_and_counters_alone():
+    cache = ModelCache(budget=20, pinned=set())
+    cache.put("a", "A", 10)
+    cache.put("b", "B", 10)
+    assert cache.peek("a") == "A"
+    assert cache.peek("c") is None
+    assert (cache.hits, cache.misses) == (0, 0)
+    cache.put("c", "C", 10)
+    assert "a" not in cache # Still the least recently used
+
+
+def test_model_size_counts_shared_tensors_once():
+    torch = pytest.importorskip("torch")
+    linear = torch.nn.Linear(4, 2) # 8 weights and 2 biases
+    assert model_size(linear) == 10 * 4
+    model = torch.nn.Sequential(linear, torch.nn.BatchNorm1d(2))
+    # BatchNorm1d adds weight, bias, running mean and variance, and an int64 batch count
+    assert model_size(model) == 10 * 4 + 4 * 2 * 4 + 8
+    tied = torch.nn.Sequential(linear, linear)
+    assert model_size(tied) == 10 * 4
+
+
+def test_share_weights_maps_the_weights_from_a_file(tmp_path):
+    torch = pytest.importorskip("torch")
+    model = torch.nn.Sequential(torch.nn.Linear(4, 2), torch.nn.BatchNorm1d(2)).eval()
+    inputs = torch.randn(3, 4)
+    with torch.no_grad():
+        expected = model(inputs)
+    path = tmp_path / "weights.pt"
+    share_weights(model, path)
+    assert path.exists()
+    with open("/proc/self/maps") as maps:
+        assert str(path) in maps.read()
+    with torch.no_grad():
+        assert torch.equal(model(inputs), expected)
+
+    # Another worker loading the same weights maps the file as it is
+    mtime = path.stat().st_mtime_ns
+    other = torch.nn.Sequential(torch.nn.Linear(4, 2), torch.nn.BatchNorm1d(2)).eval()
+    other.load_state_dict(model.state_dict())
+    share_weights(other, path)
+    assert path.stat().st_mtime_ns == mtime
+
+    # A file that no longer matches the model is written again
+    changed = torch.nn.Sequential(torch.nn.Linear(4, 2), torch.nn.BatchNorm1d(2)).eval()
+    share_weights(changed, path)
+    assert not torch.equal(changed[0].weight, model[0].weight)
+    assert torch.equal(torch.load(path, weights_only=True)["0.weight"], changed[0].weight)
@@ -0,0 +1,42 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from labear_api.predictions import SILENCE, aggregate, is_silent, labelled, silence_result
+
+CATS = ["a", "b", "c"]
+
+
+def test_labelled():
+    probabilities, prediction, score = labelled(torch.tensor([0.1, 0.2, 0.7]), CATS)
+    assert probabilities == pytest.approx({"a": 0.1, "b": 0.2, "c": 0.7})
+    assert prediction == ["c"]
+    assert score.item() == pytest.approx(0.7)
+
+
+def test_is_silent():
+    assert is_silent(torch.zeros(16000))
+    assert is_silent(torch.zeros(0))
+    assert not is_silent(0.1 * torch.ones(16000))
+
+
+def test_aggregate_averages_the_files():
+    results = [labelled(torch.tensor([0.6, 0.4, 0.0]), CATS), labelled(torch.tensor([0.0, 0.6, 0.4]), CATS)]
+    probabilities, prediction, score = aggregate(results)
+    assert probabilities == pytest.approx({"a": 0.3, "b": 0.5, "c": 0.2})
+    assert prediction == ["b"]
+    assert score.item() == pytest.approx(0.5)
+
+
+def test_aggregate_leaves_out_silent_files():
+    results = [silence_result(), labelled(torch.tensor([0.1, 0.1, 0.8]), CATS), labelled(torch.tensor([0.2, 0.2, 0.6]), CATS)]
+    probabilities, prediction, score = aggregate(results)
+    assert SILENCE not in probabilities
+    assert probabilities == pytest.approx({"a": 0.15, "b": 0.15, "c": 0.7})
+    assert prediction == ["c"]
+    assert score.item() == pytest.approx(0.7)
+
+
+def test_aggregate_of_silent_files_is_silence():
+    probabilities, prediction, score = aggregate([silence_result(), silence_result()])
+    assert (probabilities, prediction, score.item()) == ({SILENCE: 1.0}, [SILENCE], 1.0)
@@ -0,0 +1,184 @@
+import io
+from types import SimpleNamespace
+
+import pytest
+
+from labear_api.storage import CachedStorage, LocalStorage, MemoryStorage, Storage, file_md5, md5_base64
+
+BUCKET = "bucket"
+
+
+@pytest.fixture(params=["local", "memory"])
+def storage(request, tmp_path) -> Storage:
+    return LocalStorage(tmp_path / "storage") if request.param == "local" else MemoryStorage()
+
+
+def write(storage: Storage, name: str, content: bytes):
+    return storage.write(BUCKET, name, io.BytesIO(content))
+
+
+def test_write_read_and_info(storage):
+    written = write(storage, "users/a/model.pt", b"weights")
+    assert storage.read(BUCKET, "users/a/model.pt") == b"weights"
+    info = storage.info(BUCKET, "users/a/model.pt")
+    assert info == written
+    assert (info.name, info.size, info.md5) == ("users/a/model.pt", 7, md5_base64(b"weights"))
+
+
+def test_overwrite(storage):
+    first = write(storage, "users/a/model.pt", b"old")
+    second = write(storage, "users/a/model.pt", b"newer")
+    assert storage.read(BUCKET, "users/a/model.pt") == b"newer"
+    assert second.size == 5
+    assert second.md5 != first.md5
+
+
+def test_missing_blob(storage, tmp_path):
+    assert storage.info(BUCKET, "users/a/missing.pt") is None
+    with pytest.raises(FileNotFoundError):
+        storage.read(BUCKET, "users/a/missing.pt")
+    with pytest.raises(FileNotFoundError):
+        storage.download(BUCKET, "users/a/missing.pt", tmp_path / "missing.pt")
+    assert not (tmp_path / "missing.pt").exists()
+
+
+def test_download(storage, tmp_path):
+    write(storage, "users/a/cats.json", b"{}")
+    storage.download(BUCKET, "users/a/cats.json", tmp_path / "copy" / "cats.json")
+    assert (tmp_path / "copy" / "cats.json").read_bytes() == b"{}"
+
+
+def test_list(storage):
+    for name in ["users/a/model.pt", "users/a/cats.json", "users/a/recordings/1.wav", "users/ab/model.pt", "other.txt"]:
+        write(storage, name, b"x")
+    write(storage, "users/b/model.pt", b"x")
+    names = lambda blobs: sorted(blob.name for blob in blobs)
+    assert names(storage.list(BUCKET, "users/a/")) == ["users/a/cats.json", "users/a/model.pt", "users/a/recordings/1.wav"]
+    assert names(storage.list(BUCKET, "users/a/", recursive=False)) == ["users/a/cats.json", "users/a/model.pt"]
+    assert names(storage.list(BUCKET, "users/a")) == ["users/a/cats.json", "users/a/model.pt", "users/a/recordings/1.wav",
+                                                      "users/ab/model.pt"]
+    assert storage.list(BUCKET, "users/c/") == []
+    assert storage.list("empty", "") == []
+
+
+def test_upload_many(storage):
+    files = [SimpleNamespace(filename=f"{i}.wav", file=io.BytesIO(bytes([i]) * 3)) for i in range(5)]
+    assert storage.upload_many(BUCKET, files, blob_name_prefix="users/a/recordings/") == [None] * 5
+    assert [storage.read(BUCKET, f"users/a/recordings/{i}.wav") for i in range(5)] == [bytes([i]) * 3 for i in range(5)]
+
+
+def test_local_storage_stays_inside_the_bucket(tmp_path):
+    storage = LocalStorage(tmp_path)
+    (tmp_path / "secret").write_bytes(b"secret")
+    with pytest.raises(ValueError):
+        storage.read(BUCKET, "../secret")
+    with pytest.raises(ValueError):
+        write(storage, "users/../../secret", b"overwritten")
+    assert (tmp_path / "secret").read_bytes() == b"secret"
+
+
+def test_local_storage_lists_without_partial_files(tmp_path):
+    storage = LocalStorage(tmp_path)
+    write(storage, "users/a/model.pt", b"x")
+    (tmp_path / BUCKET / "users/a/cats.json.123.1.partial").write_bytes(b"x")
+    assert [blob.name for blob in storage.list(BUCKET, "users/a/")] == ["users/a/model.pt"]
+    assert storage.info(BUCKET, "users/a/model.pt").md5 == file_md5(tmp_path / BUCKET / "users/a/model.pt")
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+
+class CountingStorage(MemoryStorage):
+    """A memory backend that counts checks and downloads and can be made unreachable."""
+    def __init__(self):
+        super().__init__()
+        self.checks = 0
+        self.downloads = 0
+        self.reachable = True
+
+    def info(self, bucket, name):
+        self.checks += 1
+        if not self.reachable:
+            raise ConnectionError("backend unreachable")
+        return super().info(bucket, name)
+
+    def download(self, bucket, name, path, md5=None):
+        self.downloads += 1
+        super().download(bucket, name, path)
+
+
+@pytest.fixture
+def cached(tmp_path):
+    return CachedStorage(CountingStorage(), tmp_path / "cache", ttl=60)
+
+
+def settle(cached):
+    """Wait for the background checks queued so far."""
+    cached.pool.submit(lambda: None).result()
+
+
+def test_cache_trusts_a_copy_within_the_ttl(cached):
+    write(cached.backend, "users/a/model.pt", b"v1")
+    assert cached.read(BUCKET, "users/a/model.pt") == b"v1"
+    write(cached.backend, "users/a/model.pt", b"v2") # Written elsewhere, so only the generation tells
+    assert cached.read(BUCKET, "users/a/model.pt") == b"v1"
+    assert (cached.backend.checks, cached.backend.downloads) == (1, 1)
+
+
+def test_cache_checks_again_in_the_background(cached):
+    cached.ttl = 0
+    write(cached.backend, "users/a/model.pt", b"v1")
+    assert cached.read(BUCKET, "users/a/model.pt") == b"v1"
+    write(cached.backend, "users/a/model.pt", b"v2")
+    assert cached.read(BUCKET, "users/a/model.pt") == b"v1" # Served while it is checked
+    settle(cached)
+    assert cached.read(BUCKET, "users/a/model.pt") == b"v2"
+    settle(cached)
+    assert cached.backend.downloads == 2 # Unchanged since, so not downloaded again
+
+
+def test_cache_fetches_a_copy_not_checked_by_this_process(cached, tmp_path):
+    write(cached.backend, "users/a/model.pt", b"v1")
+    cached.read(BUCKET, "users/a/model.pt")
+    write(cached.backend, "users/a/model.pt", b"v2")
+    restarted = CachedStorage(cached.backend, tmp_path / "cache", ttl=60)
+    assert restarted.read(BUCKET, "users/a/model.pt") == b"v2"
+
+
+def test_cache_download_with_another_md5_fetches_it(cached, tmp_path):
+    write(cached.backend, "users/a/model.pt", b"v1")
+    cached.read(BUCKET, "users/a/model.pt")
+    info = write(cached.backend, "users/a/model.pt", b"v2")
+    cached.download(BUCKET, "users/a/model.pt", tmp_path / "model.pt", md5=info.md5)
+    assert (tmp_path / "model.pt").read_bytes() == b"v2"
+    cached.download(BUCKET, "users/a/model.pt", tmp_path / "model.pt", md5=info.md5)
+    assert cached.backend.downloads == 2
+
+
+def test_cache_serves_stale_copy_when_backend_fails(cached, tmp_path):
+    write(cached.backend, "users/a/model.pt", b"v1")
+    cached.read(BUCKET, "users/a/model.pt")
+    cached.backend.reachable = False
+    cached.ttl = 0
+    assert cached.read(BUCKET, "users/a/model.pt") == b"v1"
+    settle(cached)
+    restarted = CachedStorage(cached.backend, tmp_path / "cache")
+    restarted.download(BUCKET, "users/a/model.pt", tmp_path / "model.pt")
+    assert (tmp_path / "model.pt").read_bytes() == b"v1"
+    with pytest.raises(ConnectionError): # Nothing cached to fall back on
+        cached.read(BUCKET, "users/b/model.pt")
+
+
+def test_cache_write_invalidates(cached):
+    write(cached.backend, "users/a/model.pt", b"v1")
+    cached.read(BUCKET, "users/a/model.pt")
+    write(cached, "users/a/model.pt", b"v2")
+    assert cached.read(BUCKET, "users/a/model.pt") == b"v2"
+    assert cached.backend.downloads == 2
+
+
+def test_cache_missing_blob(cached):
+    with pytest.raises(FileNotFoundError):
+        cached.read(BUCKET, "users/a/model.pt")
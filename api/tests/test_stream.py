@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from labear_api.stream import SlidingWindow
+
+
+def pcm(frames: np.ndarray) -> bytes:
+    return frames.astype(np.int16).tobytes()
+
+
+def expected_windows(stream: np.ndarray, window: int, hop: int) -> list:
+    """Every window that ends at window, window + hop, ... frames into the stream."""
+    return [stream[end - window:end] / 2**15 for end in range(window, len(stream) + 1, hop)]
+
+
+def push_all(sliding: SlidingWindow, data: bytes, message_bytes: int) -> list:
+    windows = []
+    for start in range(0, len(data), message_bytes):
+        windows += sliding.push(data[start:start + message_bytes])
+    return windows
+
+
+@pytest.mark.parametrize("window, hop, message_bytes", [
+    (8, 3, 10), # Messages shorter than the hop
+    (8, 3, 7), # Frames split across messages
+    (8, 8, 16), # Windows back to back
+    (5, 2, 64), # Messages longer than the window
+    (6, 4, 2), # One frame at a time, wrapping the ring many times
+])
+def test_windows_match_the_stream(window, hop, message_bytes):
+    stream = np.arange(1, 50).reshape(-1, 1)
+    sliding = SlidingWindow(window, hop)
+    windows = push_all(sliding, pcm(stream), message_bytes)
+    expected = expected_windows(stream, window, hop)
+    assert len(windows) == len(expected)
+    for got, want in zip(windows, expected):
+        np.testing.assert_allclose(got.numpy(), want)
+    assert sliding.frames == len(stream)
+    assert sliding.seconds(7) == len(stream) / 7
+
+
+def test_windows_are_copies():
+    sliding = SlidingWindow(4, 2)
+    first, = sliding.push(pcm(np.arange(4).reshape(-1, 1)))
+    sliding.push(pcm(np.full((4, 1), 100)))
+    np.testing.assert_allclose(first.numpy()[:, 0], np.arange(4) / 2**15)
+
+
+def test_stereo_frames_split_across_messages():
+    stream = np.stack([np.arange(20), -np.arange(20)], axis=1)
+    sliding = SlidingWindow(6, 5, channels=2)
+    windows = push_all(sliding, pcm(stream), 6) # One and a half frames per message
+    expected = expected_windows(stream, 6, 5)
+    assert len(windows) == len(expected) == 3
+    for got, want in zip(windows, expected):
+        assert got.shape == (6, 2)
+        np.testing.assert_allclose(got.numpy(), want)
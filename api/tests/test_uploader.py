@@ -0,0 +1,92 @@
+import asyncio
+import io
+from collections import Counter
+
+import pytest
+from fastapi import UploadFile
+
+from labear_api import cloud_connect, uploader
+from labear_api.storage import MemoryStorage
+from labear_api.uploader import Uploader
+
+BUCKET = "bucket"
+
+
+class FlakyStorage(MemoryStorage):
+    """A memory backend that fails the uploads of `failing` files and counts the attempts per name."""
+    def __init__(self):
+        super().__init__()
+        self.failing = set()
+        self.attempts = Counter()
+
+    def write(self, bucket, name, file_obj):
+        self.attempts[name] += 1
+        if name in self.failing:
+            raise ConnectionError("connection reset")
+        return super().write(bucket, name, file_obj)
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = FlakyStorage()
+    monkeypatch.setattr(cloud_connect, "get_storage", lambda: storage)
+    monkeypatch.setattr(uploader, "UPLOAD_BACKOFF", 0)
+    return storage
+
+
+def spool(upload, files, folder="users/a/recordings/"):
+    files = [UploadFile(io.BytesIO(content), filename=name) for name, content in files]
+    return asyncio.run(upload.spool(BUCKET, folder, files))
+
+
+def settle(upload):
+    """Wait for the jobs queued so far, the uploader runs them one at a time."""
+    upload.pool.submit(lambda: None).result()
+
+
+def test_uploads_every_file_and_clears_the_spool(storage, tmp_path):
+    upload = Uploader(spool_dir=tmp_path, workers=1)
+    job = spool(upload, [("1.wav", b"one"), ("../2.wav", b"two")])
+    settle(upload)
+    assert storage.read(BUCKET, "users/a/recordings/1.wav") == b"one"
+    assert storage.read(BUCKET, "users/a/recordings/2.wav") == b"two" # Only the base name of what the client sent
+    assert upload.status(job.job_id)["state"] == "done"
+    assert not job.path(tmp_path).exists()
+
+
+def test_retries_only_the_failed_files(storage, tmp_path):
+    upload = Uploader(spool_dir=tmp_path, workers=1)
+    storage.failing.add("users/a/recordings/2.wav")
+    job = spool(upload, [("1.wav", b"one"), ("2.wav", b"two")])
+    settle(upload)
+    status = upload.status(job.job_id)
+    assert (status["state"], status["uploaded"], status["attempts"]) == ("failed", 1, uploader.UPLOAD_RETRIES)
+    assert "connection reset" in status["error"]
+    assert storage.attempts["users/a/recordings/1.wav"] == 1
+    assert storage.attempts["users/a/recordings/2.wav"] == uploader.UPLOAD_RETRIES
+    assert job.file_path(tmp_path, 1).read_bytes() == b"two" # Kept for the next start
+
+
+def test_unfinished_jobs_are_resumed(storage, tmp_path):
+    upload = Uploader(spool_dir=tmp_path, workers=1)
+    storage.failing.add("users/a/recordings/2.wav")
+    job = spool(upload, [("1.wav", b"one"), ("2.wav", b"two")])
+    settle(upload)
+    upload.shutdown()
+
+    storage.failing.clear()
+    restarted = Uploader(spool_dir=tmp_path, workers=1)
+    assert restarted.status(job.job_id)["state"] == "failed" # Read from the spool
+    restarted.resume()
+    settle(restarted)
+    assert restarted.status(job.job_id)["state"] == "done"
+    assert storage.read(BUCKET, "users/a/recordings/2.wav") == b"two"
+    assert storage.attempts["users/a/recordings/1.wav"] == 1 # Not uploaded again
+
+
+def test_files_with_the_same_name_are_spooled_apart(storage, tmp_path):
+    upload = Uploader(spool_dir=tmp_path, workers=1)
+    storage.failing.add("users/a/recordings/rec.wav") # Keep the spooled files around
+    job = spool(upload, [("rec.wav", b"first"), ("rec.wav", b"second")])
+    settle(upload)
+    assert [job.file_path(tmp_path, i).read_bytes() for i in range(2)] == [b"first", b"second"]
@@ -0,0 +1,152 @@
+"""
+Client for the labear API, shared by the Kivy app (application/) and the Raspberry Pi recorder
+(rpi/, whose image copies this file next to recorder.py).
+"""
+
+import email.utils
+import os
+import statistics
+import time
+import uuid
+from collections import deque, namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CONNECT_TIMEOUT = 5 # Seconds to set up a connection
+READ_TIMEOUT = 30 # Seconds to wait for the server between bytes of the response
+POOL_SIZE = 2 # Connections kept open per host, one uploader thread only ever needs one
+TIMINGS_KEPT = 100 # Requests the summary statistics are taken over
+SUMMARY_EVERY = 20 # Requests between summary log lines
+
+# total: whole request including the upload, headers: until the response headers arrived,
+# server: what the API reported in its Server-Timing header (None unless it runs with SERVER_TIMING=1)
+RequestTiming = namedtuple("RequestTiming", ["url", "status", "sent", "total", "headers", "server"])
+
+
+def content_size(content):
+    """Bytes in an upload given as bytes or as an open file"""
+    if isinstance(content, (bytes, bytearray)):
+        return len(content)
+    return os.fstat(content.fileno()).st_size
+
+
+class ApiClient:
+    """
+    One requests session for all calls to the API, so uploads reuse a kept-alive connection
+    instead of doing a DNS lookup and TCP/TLS handshake each time. Every request gets connect
+    and read timeouts, and its timing is kept for statistics.
+    The logger is passed in since the app logs through java.util.logging on android and the
+    Pi to its rotating log file.
+    """
+    def __init__(self, logger, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, pool_size=POOL_SIZE,
+                 summary_every=SUMMARY_EVERY):
+        self.logger = logger
+        self.timeout = (connect_timeout, read_timeout)
+        self.summary_every = summary_every
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.timings = deque(maxlen=TIMINGS_KEPT)
+        self.requests = 0
+        self.failures = 0
+
+    def post(self, url, files=None, data=None):
+        """POST to the API. Raises the requests exceptions, including Timeout"""
+        sent = sum(content_size(file[1] if isinstance(file, tuple) else file) for _, file in files or [])
+        return self._send(url, lambda: sent, files=files, data=data)
+
+    def post_stream(self, url, data, slices):
+        """
+        POST form fields and a sequence of WavSlices (see audio_capture.Recording.split) as
+        multipart/form-data without building the body in memory. The body is a generator sent
+        with chunked transfer encoding, and every slice goes out as views into the recording.
+        """
+        boundary = uuid.uuid4().hex
+        sent = 0
+
+        def body():
+            nonlocal sent
+            for part in multipart_body(boundary, data, slices):
+                sent += len(part)
+                yield part
+
+        return self._send(url, lambda: sent, data=body(),
+                          headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+
+    def _send(self, url, sent, **kwargs):
+        start = time.perf_counter()
+        self.requests += 1
+        try:
+            response = self.session.post(url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self.failures += 1
+            raise
+        server = server_timing(response)
+        timing = RequestTiming(url, response.status_code, sent(), time.perf_counter() - start, response.elapsed.total_seconds(),
+                               server.get("total"))
+        self.timings.append(timing)
+        self.logger.info(f"POST {url} {response.status_code}: {timing.sent} bytes in {timing.total * 1000:.0f} ms "
+                         f"({timing.headers * 1000:.0f} ms to response headers)"
+                         + "".join(f", {name} {seconds * 1000:.0f} ms" for name, seconds in server.items()))
+        if self.summary_every and self.requests % self.summary_every == 0:
+            self.logger.info(f"API requests: {self.stats()}")
+        return response
+
+    def stats(self):
+        totals = sorted(timing.total for timing in self.timings)
+        if not totals:
+            return {"requests": self.requests, "failures": self.failures}
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "median_ms": round(statistics.median(totals) * 1000),
+            "p95_ms": round(totals[int(0.95 * (len(totals) - 1))] * 1000),
+            "kbytes_per_s": round(sum(timing.sent for timing in self.timings) / sum(totals) / 1000, 1),
+        }
+
+    def close(self):
+        self.session.close()
+
+
+def multipart_body(boundary, fields, slices):
+    """multipart/form-data for the API's form fields and `files` list, one piece at a time"""
+    for name, value in fields.items():
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n').encode()
+    for wav_slice in slices:
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{wav_slice.name}"\r\n'
+               f'Content-Type: audio/wav\r\n\r\n').encode()
+        yield from wav_slice.chunks()
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+def retry_after(response, default):
+    """Seconds to wait before retrying as asked by a Retry-After header (in seconds or as an HTTP date), else default"""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+def server_timing(response):
+    """Stage durations in seconds from a Server-Timing header, e.g. {"decode": 0.003, "total": 0.048}"""
+    stages = {}
+    for entry in response.headers.get("Server-Timing", "").split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if name and key == "dur":
+                try:
+                    stages[name] = float(value) / 1000
+                except ValueError:
+                    pass
+    return stages
@@ -18,6 +18,9 @@ MONITOR = '/monitor'
 URL_LEARN = URL + LEARN
 URL_MON = URL + MONITOR
 TEST_ID = 99
+LEARN_SLICE_SECONDS = 5 # WAV recordings are sent to /learn as clips of this length...
+LEARN_SLICE_OVERLAP = 1 # ...overlapping by this many seconds
+UPLOAD_RETRY = 3 # Seconds before retrying a failed upload, unless the API asks for longer with Retry-After
 
 has_recording = False
 
@@ -37,6 +40,10 @@ else:
     REC_FILE_EXT = '.wav'
     REC_DEFAULT_FILE_NAME = '../rec' + REC_FILE_EXT
 
+from api_client import ApiClient, retry_after # client/api_client.py, shared with the Raspberry Pi recorder
+
+# Shared by all uploads, keeps the connection to the API alive between recordings
+api = ApiClient(logger)
 
 
 
@@ -55,19 +62,43 @@ def upload_file(recording, url, rename=True, **kwargs):
     files.append(('files', open(new_name, 'rb')))
 
     payload = recording.get_rec_details()
-    
+    return send(recording, lambda: api.post(url, files=files, data=payload))
+
+def upload_slices(recording, url, length=LEARN_SLICE_SECONDS, overlap=LEARN_SLICE_OVERLAP):
+    """
+    Upload a WAV recording as overlapping clips of `length` seconds, streamed straight from
+    the recording without writing the clips to disk (see Recording.split).
+    """
+    recording.rename_rec()
+    try:
+        slices = recording.split(length, overlap)
+    except ValueError as err:
+        logger.info(f"Recording {recording.get_file_path()} cannot be split: {err}")
+        return err, False
+    return send(recording, lambda: api.post_stream(url, recording.get_rec_details(), slices))
+
+def send(recording, post):
+    """Send a recording with post(), returning (response, file_uploaded). The recording is removed once uploaded."""
     try:
     
-        resp = requests.post(url=url, files=files, data=payload)
+        resp = post()
 
-        response, file_uploaded = resp.json(), True
-        recording.clean_up()
+        if resp.ok:
+            response, file_uploaded = resp.json(), True
+            recording.clean_up()
+        else:
+            # e.g. 503 {"detail": ...} while the API is busy or warming up; the response is kept for its Retry-After
+            logger.info(f"API answered {resp.status_code}: {resp.text[:200]}")
+            response, file_uploaded = resp, False
     except ValueError as err:
         print(f"Response from API missing: {err}")
         response, file_uploaded =  err, False
     except requests.exceptions.ConnectionError as con_err:
         logger.info(f"Connection error encountered")
         response, file_uploaded = con_err, False
+    except requests.exceptions.Timeout as timeout_err:
+        logger.info(f"Request to API timed out")
+        response, file_uploaded = timeout_err, False
     return response, file_uploaded
 
 def rec_counter(start_time):
@@ -184,7 +215,10 @@ class Rec(Screen):
             logger.info(f"Recording is ready to be uploaded")
 
             logger.info(f"Record details: {self.recording.get_rec_details()}")
-            response, file_uploaded = upload_file(self.recording, URL_LEARN, app_name=self.ids['text_app'].text, test='test')
+            if self.recording.file_type == '.wav': # Sent as training clips, the m4a files from android are sent whole
+                response, file_uploaded = upload_slices(self.recording, URL_LEARN)
+            else:
+                response, file_uploaded = upload_file(self.recording, URL_LEARN, app_name=self.ids['text_app'].text, test='test')
 
             if file_uploaded:
                 logger.info(f"Uploaded: {self.recording.get_rec_details()}")
@@ -287,6 +321,7 @@ class Monitor(Screen):
         self.prediction = "" 
         self.score = 0
         self.upload_state = ""
+        self.retry_at = 0 # time.monotonic() before which the API asked not to be sent anything
 
     
     def on_enter(self, *args):
@@ -304,6 +339,13 @@ class Monitor(Screen):
             logger.info("Recording stopping")
             self.recorder.stop()
 
+        if self.upload_tries == 0 and time.monotonic() < self.retry_at:
+            logger.info(f"API busy, dropping this recording ({self.retry_at - time.monotonic():.0f}s to wait)")
+            self.upload_state = 'upload_fail'
+            self.clean_up()
+            self.update_labels()
+            return
+
         if self.upload_tries == 0:    
             self.recording = Recording(audio_file=self.recorder, user_id=self.menu_screen.ids["text_user"].text, class_id='test_mon', file_type=REC_FILE_EXT)
             self.has_recording = True
@@ -314,10 +356,15 @@ class Monitor(Screen):
 
         
         
+        delay = UPLOAD_RETRY
+        if isinstance(response, requests.Response):
+            delay = max(retry_after(response, UPLOAD_RETRY), UPLOAD_RETRY)
+            self.retry_at = time.monotonic() + delay
+
         if not file_uploaded and self.upload_tries < 1:
             logger.info(f"Recording not uploaded. Response from server: {response}")
-            logger.info(f'Retrying once')
-            self.event_upload = Clock.schedule_once(partial(self.callback_upload), 3)
+            logger.info(f'Retrying once in {delay:.0f}s')
+            self.event_upload = Clock.schedule_once(partial(self.callback_upload), delay)
             self.upload_tries += 1
             self.upload_state = 'upload_fail'
             
@@ -326,8 +373,10 @@ class Monitor(Screen):
             self.upload_state = 'upload_complete'
             self.clean_up()
             logger.info(f"Response: {response}")
-            self.prediction = response['prediction']['prediction'][0]
-            self.score = float(response['prediction']['score'])
+            prediction = response.get('prediction') if isinstance(response, dict) else None
+            if prediction:
+                self.prediction = prediction['prediction'][0]
+                self.score = float(prediction['score'])
         else:
             logger.info(f"Recording not uploaded. Response from server: {response}")
             self.upload_tries += 1
@@ -365,6 +414,7 @@ class Monitor(Screen):
 
     def stop_monitor(self):
         logger.info("Stopping monitoring")
+        logger.info(f"API requests: {api.stats()}")
         if self.monitoring:
             self.monitor_state = 'Not Monitoring'
         if self.recorder.get_state() == "recording":
@@ -452,5 +502,8 @@ class LabearApp(MDApp):
 
         return screen
 
+    def on_stop(self):
+        api.close()
+
 if __name__ == '__main__':
     LabearApp().run()
\ No newline at end of file
@@ -1,13 +1,14 @@
 from dataclasses import dataclass, field
 from jnius import autoclass
 from kivy.utils import platform
-import numpy as np
+import mmap
 import os
 from os import rename
-import PyWave
-from PyWave import WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT
+import struct
 from time import time
 
+CHUNK_SIZE = 64 * 1024 # Bytes handed to the socket at a time when streaming a slice
+
 
 if platform == 'android':
     Logger = autoclass('java.util.logging.Logger')
@@ -159,36 +160,101 @@ class Recording:
         except FileNotFoundError as e:
             logger.info(f"Recording not found at: {self.file_path}")
 
-    def split(self, length, path):
-        logger.info(f"Splitting recoridng in {length} second slices")
-        logger.info(f"Path to write output to: {path}")
-        files = []
-        logger.info(f"File to open: {self.file_path}")
-        with PyWave.open(self.file_path) as f:
-            logger.info(f"File opened...")
-            samples = f.samples
-            sr = f.frequency
-            bytes_smpl = f.bytes_per_sample
-            bits_smpl = f.bits_per_sample
-            chnls = f.channels
-            data = f.read()
-            
-            no_sections = int(np.ceil((samples / sr) / length))
-
-            for i in range(no_sections):
-                temp = data[i*sr*chnls*bytes_smpl*length:i*sr*chnls*bytes_smpl*length + sr*length*chnls*bytes_smpl]
-                filename = f'{path}/rec_{i}.wav'
-
-                with PyWave.open(filename,
-                    mode = "w", 
-                    channels = chnls, 
-                    frequency = sr, 
-                    bits_per_sample = bits_smpl, 
-                    format = WAVE_FORMAT_IEEE_FLOAT) as nf:
-
-                    nf.write(temp)
-                    files.append(('files', open(filename, 'rb')))
-        return files
+    def split(self, length, overlap=0):
+        """
+        Cut a WAV recording into slices of `length` seconds, starting every `length - overlap`
+        seconds. The recording is memory mapped and every slice is a WavSlice holding a view
+        into the map, so nothing is copied or written to disk. Slices keep the recording's
+        own fmt chunk, so sample format, rate and channels are unchanged.
+
+        Each slice is only valid until the next one is requested, stream them straight into
+        a request: api.post_stream(URL_LEARN, recording.get_rec_details(), recording.split(5, overlap=1))
+
+        Raises ValueError straight away, before anything is sent, if the recording is not a
+        WAV file or if the length and overlap would start the slices less than a sample apart.
+        """
+        if not 0 <= overlap < length:
+            raise ValueError(f"Overlap must be at least 0 and less than the slice length {length}, got {overlap}")
+        with open(self.file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                fmt_chunk, data = wav_chunks(view)
+                with fmt_chunk, data:
+                    rate, _ = wav_format(fmt_chunk)
+        if int((length - overlap) * rate) < 1:
+            raise ValueError(f"Slices of {length} s overlapping {overlap} s would start less than one sample apart at {rate} Hz")
+        logger.info(f"Splitting recording {self.file_path} in {length} second slices overlapping {overlap} seconds")
+        return self._slices(length, overlap)
+
+    def _slices(self, length, overlap):
+        with open(self.file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                fmt_chunk, data = wav_chunks(view)
+                try:
+                    rate, block_align = wav_format(fmt_chunk)
+                    slice_bytes = int(length * rate) * block_align
+                    hop_bytes = int((length - overlap) * rate) * block_align
+                    overlap_bytes = slice_bytes - hop_bytes
+                    # A last slice inside the overlap of the one before adds nothing
+                    for i, start in enumerate(range(0, max(len(data) - overlap_bytes, 1), hop_bytes)):
+                        wav_slice = WavSlice(f"{self.file_label}_{i}.wav", fmt_chunk, data[start:start + slice_bytes])
+                        try:
+                            yield wav_slice
+                        finally:
+                            wav_slice.data.release() # The map can only be closed once every view is released
+                finally:
+                    fmt_chunk.release()
+                    data.release()
+            finally:
+                view.release()
+
+
+@dataclass
+class WavSlice:
+    name: str
+    fmt_chunk: memoryview # Copied verbatim from the source recording
+    data: memoryview
+
+    def header(self) -> bytes:
+        riff_size = 4 + len(self.fmt_chunk) + 8 + len(self.data)
+        return (b"RIFF" + struct.pack("<I", riff_size) + b"WAVE" + self.fmt_chunk.tobytes()
+                + b"data" + struct.pack("<I", len(self.data)))
+
+    def __len__(self):
+        return 12 + len(self.fmt_chunk) + 8 + len(self.data)
+
+    def chunks(self, size=CHUNK_SIZE):
+        """The slice as a WAV file, in pieces that are views into the recording"""
+        yield self.header()
+        for start in range(0, len(self.data), size):
+            with self.data[start:start + size] as chunk:
+                yield chunk
+
 
+def wav_format(fmt_chunk):
+    """(sample rate, bytes per frame) from a WAV fmt chunk"""
+    return struct.unpack_from("<I", fmt_chunk, 12)[0], struct.unpack_from("<H", fmt_chunk, 20)[0]
 
 
+def wav_chunks(view):
+    """The fmt chunk (with its id and size, padded) and the sample data of a RIFF/WAVE buffer"""
+    if bytes(view[:4]) != b"RIFF" or bytes(view[8:12]) != b"WAVE":
+        raise ValueError("Only WAV recordings can be split")
+    fmt_chunk = None
+    offset = 12
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        size, = struct.unpack_from("<I", view, offset + 4)
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            fmt_chunk = view[offset:body + size + (size & 1)]
+        elif chunk_id == b"data":
+            if fmt_chunk is None:
+                raise ValueError("WAV data chunk found before fmt chunk")
+            block_align, = struct.unpack_from("<H", fmt_chunk, 20)
+            size = min(size, len(view) - body) # Recorders that were stopped early leave the size too large
+            return fmt_chunk, view[body:body + size - size % block_align]
+        offset = body + size + (size & 1)
+    if fmt_chunk is not None:
+        fmt_chunk.release()
+    raise ValueError("WAV recording has no data chunk")
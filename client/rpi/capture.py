@@ -0,0 +1,156 @@
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+import pyaudio
+
+logger = logging.getLogger("pi_logger")
+
+SLACK_SECONDS = 1 # Extra ring buffer space, so a window is not overwritten while it is copied out
+QUEUED_WINDOWS = 4 # Finished windows waiting for the uploader before the oldest is dropped
+
+
+class RingBuffer:
+    """
+    Fixed size buffer of int16 audio frames. Frames are addressed by their absolute index in
+    the stream, so readers can ask for any range still held in the buffer.
+    """
+    def __init__(self, frames, channels):
+        self.buffer = np.zeros((frames, channels), dtype=np.int16)
+        self.capacity = frames
+        self.total = 0 # Frames written since the start
+
+    def write(self, samples):
+        count = len(samples)
+        if count >= self.capacity:
+            samples = samples[-self.capacity:]
+        start = (self.total + count - len(samples)) % self.capacity
+        end = start + len(samples)
+        if end <= self.capacity:
+            self.buffer[start:end] = samples
+        else:
+            split = self.capacity - start
+            self.buffer[start:] = samples[:split]
+            self.buffer[:end - self.capacity] = samples[split:]
+        self.total += count
+
+    def read_into(self, first, out):
+        """Copy len(out) frames starting at absolute frame `first` into out"""
+        if first < self.total - self.capacity:
+            raise ValueError(f"Frames from {first} have already been overwritten")
+        start = first % self.capacity
+        end = start + len(out)
+        if end <= self.capacity:
+            out[:] = self.buffer[start:end]
+        else:
+            split = self.capacity - start
+            out[:split] = self.buffer[start:]
+            out[split:] = self.buffer[:end - self.capacity]
+
+
+class ContinuousRecorder:
+    """
+    Keeps one input stream open for the whole run. The PyAudio callback only copies frames
+    into a ring buffer; a separate thread cuts a window of `window_seconds` out of it every
+    `hop_seconds` into one of a few preallocated arrays and queues it for the uploader.
+    If the uploader falls behind the oldest queued window is dropped, so memory stays bounded.
+    With a gate (see gate.py) windows without any activity are not queued but counted, and the
+    count is passed on with the next window that is.
+    """
+    def __init__(self, rate, channels, chunk, audio_device_index, window_seconds, hop_seconds, gate=None):
+        self.rate = rate
+        self.channels = channels
+        self.chunk = chunk
+        self.audio_device_index = audio_device_index
+        self.window = int(window_seconds * rate)
+        self.hop = int(hop_seconds * rate)
+        self.ring = RingBuffer(self.window + SLACK_SECONDS * rate, channels)
+        # The arrays are the bound: one per queued window plus one for the window being uploaded
+        self.windows = queue.Queue()
+        self.free = queue.Queue()
+        for _ in range(QUEUED_WINDOWS + 1):
+            self.free.put(np.zeros((self.window, channels), dtype=np.int16))
+        self.frames_ready = threading.Condition()
+        self.stopped = threading.Event()
+        self.dropped = 0
+        self.gate = gate
+        self.suppressed = 0 # Windows held back by the gate since the last queued window
+
+    def start(self):
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format=pyaudio.paInt16, channels=self.channels,
+                                      rate=self.rate, input=True,
+                                      output=False,
+                                      frames_per_buffer=self.chunk,
+                                      input_device_index=self.audio_device_index,
+                                      stream_callback=self._callback)
+        self.start_time = time.time()
+        threading.Thread(target=self._cut_windows, name="windows", daemon=True).start()
+        logger.info(f"Recording continuously: {self.window / self.rate}s windows every {self.hop / self.rate}s")
+
+    def stop(self):
+        self.stopped.set()
+        with self.frames_ready:
+            self.frames_ready.notify_all()
+        self.stream.stop_stream()
+        self.stream.close()
+        self.audio.terminate()
+
+    def get(self, timeout=None):
+        """
+        Next finished window as (timestamp in ms, int16 array, windows suppressed before it).
+        Hand the array back with release()
+        """
+        return self.windows.get(timeout=timeout)
+
+    def release(self, window):
+        self.free.put(window)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        if status:
+            logger.warning(f"Audio input status flags: {status}")
+        samples = np.frombuffer(in_data, dtype=np.int16).reshape(-1, self.channels)
+        self.ring.write(samples)
+        if self.gate:
+            self.gate.update(samples, self.ring.total)
+        with self.frames_ready:
+            self.frames_ready.notify()
+        return (None, pyaudio.paContinue)
+
+    def _cut_windows(self):
+        next_end = self.window
+        while not self.stopped.is_set():
+            with self.frames_ready:
+                self.frames_ready.wait_for(lambda: self.ring.total >= next_end or self.stopped.is_set())
+            if self.stopped.is_set():
+                return
+            first = next_end - self.window
+            if self.gate and not self.gate.window_active(first, next_end):
+                self.suppressed += 1
+                logger.debug(f"Window at frame {first} is silent, not uploading ({self.suppressed} in a row)")
+                next_end += self.hop
+                continue
+            window = self._free_window()
+            try:
+                self.ring.read_into(first, window)
+            except ValueError as e:
+                logger.warning(f"Window lost: {str(e)}")
+                self.release(window)
+            else:
+                timestamp = round((self.start_time + first / self.rate) * 1000)
+                self.windows.put((timestamp, window, self.suppressed))
+                self.suppressed = 0
+            next_end += self.hop
+
+    def _free_window(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            # Uploader is behind: drop the oldest queued window and reuse its array
+            _, window, suppressed = self.windows.get()
+            self.suppressed += suppressed
+            self.dropped += 1
+            logger.warning(f"Upload queue full, dropped oldest window ({self.dropped} dropped so far)")
+            return window
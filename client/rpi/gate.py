@@ -0,0 +1,64 @@
+import logging
+import threading
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger("pi_logger")
+
+LEVEL_THRESHOLD_DB = 6.0 # How far above the noise floor a chunk has to be to count as active
+FLUX_THRESHOLD = 3.0 # How many times the usual spectral flux counts as a change in the sound
+MIN_ACTIVE = 0.1 # Fraction of active chunks needed for a window to be uploaded
+ADAPT_QUIET = 0.05 # How fast the floors follow quiet chunks
+ADAPT_ACTIVE = 0.002 # ...and active ones, so a new steady noise (a fan turning on) stops counting eventually
+EPSILON = 1e-10
+
+
+class EnergyGate:
+    """
+    Decides whether a window of audio is worth uploading. Every chunk from the microphone gets
+    an RMS level and a spectral flux value as it arrives. Both are compared with adaptive noise
+    floors (moving averages over the quiet chunks), and a window passes when enough of its
+    chunks were clearly louder than the floor or changed sharply in spectrum.
+    """
+    def __init__(self, chunks_kept, level_threshold_db=LEVEL_THRESHOLD_DB, flux_threshold=FLUX_THRESHOLD,
+                 min_active=MIN_ACTIVE):
+        self.level_ratio = 10 ** (level_threshold_db / 20)
+        self.flux_threshold = flux_threshold
+        self.min_active = min_active
+        self.level_floor = None
+        self.flux_floor = None
+        self.previous_spectrum = None
+        self.taper = None
+        self.chunks = deque(maxlen=chunks_kept) # (frame index the chunk ends at, active)
+        self.lock = threading.Lock()
+
+    def update(self, samples, end_frame):
+        """Score an int16 chunk [frames, channels] ending at absolute frame `end_frame`"""
+        mono = samples.mean(axis=1, dtype=np.float32) / 32768
+        level = float(np.sqrt(np.mean(mono ** 2))) + EPSILON
+        if self.taper is None or len(self.taper) != len(mono):
+            self.taper = np.hanning(len(mono)).astype(np.float32)
+        spectrum = np.abs(np.fft.rfft(mono * self.taper))
+        if self.previous_spectrum is None or len(self.previous_spectrum) != len(spectrum):
+            flux = 0.0
+        else:
+            # Half-wave rectified: only energy appearing in a band counts as change
+            flux = float(np.sum(np.maximum(spectrum - self.previous_spectrum, 0))) / (float(np.sum(self.previous_spectrum)) + EPSILON)
+        self.previous_spectrum = spectrum
+
+        if self.level_floor is None:
+            self.level_floor, self.flux_floor = level, flux + EPSILON
+        active = level > self.level_floor * self.level_ratio or flux > self.flux_floor * self.flux_threshold
+        rate = ADAPT_ACTIVE if active else ADAPT_QUIET
+        self.level_floor += rate * (level - self.level_floor)
+        self.flux_floor += rate * (flux - self.flux_floor)
+        with self.lock:
+            self.chunks.append((end_frame, active))
+        return active
+
+    def window_active(self, first, last):
+        """Whether enough chunks between absolute frames `first` and `last` were active"""
+        with self.lock:
+            flags = [active for end, active in self.chunks if first < end <= last]
+        return bool(flags) and sum(flags) / len(flags) >= self.min_active
@@ -1,21 +1,40 @@
 import pyaudio
 import wave
 import argparse
+import io
+import json
+import queue
 import requests
+import threading
 import time 
-import os
-from pathlib import Path
+from urllib.parse import urlencode
 import sys
 import sounddevice
+import soundfile
+import websocket
 import logging
 from logging.handlers import RotatingFileHandler
+from capture import ContinuousRecorder, SLACK_SECONDS
+from gate import EnergyGate, LEVEL_THRESHOLD_DB
+from store import UploadQueue, Backoff, QUEUE_MAX_MB, QUEUE_MAX_AGE_HOURS
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent)) # client/, for api_client.py when running from a checkout
+from api_client import ApiClient, CONNECT_TIMEOUT, READ_TIMEOUT # Shared with the app, copied next to this file in the image
 
 LOG_FILE = "pi.log"
 LOG_SIZE = 1048576
 LOG_BACKUP_COUNT = 3
 
 TEMP_SOUNDFILE_DIR = "/tmp"
+QUEUE_FILE = "labear_queue.sqlite"
+RETRY_STATUS = {408, 425, 429} # Client errors worth retrying, other 4xx responses will not change on a retry
 MIC_RATE = 48000 # Set by microphone used
+# Upload format -> (libsndfile container, subtype, file extension). Opus only takes 8/12/16/24/48 kHz
+UPLOAD_FORMATS = {
+    "wav": ("WAV", "PCM_16", "wav"),
+    "flac": ("FLAC", "PCM_16", "flac"),
+    "opus": ("OGG", "OPUS", "opus"),
+}
 
 def setup_size_based_logger(log_file, max_bytes, backup_count):
     """
@@ -61,55 +80,124 @@ class RunFunctionAndExit(argparse.Action):
 def list_audio_devices():
     print(sounddevice.query_devices())
 
-def record_audio(output_filename, record_seconds, channels, chunk, audio_device_index):
-    # Initialize pyaudio
-    audio = pyaudio.PyAudio()
-    # Open stream
-    stream = audio.open(format=pyaudio.paInt16, channels=channels,
-                        rate=MIC_RATE, input=True,
-                        output=False,
-                        frames_per_buffer=chunk,
-                        input_device_index=audio_device_index)
-
-    logger.info(f"Recording for {record_seconds} seconds...")
+def encode_wav(window, channels):
+    """Encode an int16 window as WAV in memory"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wave_file:
+        wave_file.setnchannels(channels)
+        wave_file.setsampwidth(2)
+        wave_file.setframerate(MIC_RATE)
+        wave_file.writeframes(window.tobytes())
+    return buffer.getvalue()
 
-    frames = []  # Store audio frames
+def encode(window, channels, upload_format):
+    """Encode an int16 window in memory in one of UPLOAD_FORMATS"""
+    if upload_format == "wav":
+        return encode_wav(window, channels)
+    container, subtype, _ = UPLOAD_FORMATS[upload_format]
+    buffer = io.BytesIO()
+    soundfile.write(buffer, window, MIC_RATE, format=container, subtype=subtype)
+    return buffer.getvalue()
 
-    # Record for the specified number of seconds
-    for _ in range(0, int(MIC_RATE / chunk * record_seconds)):
-        data = stream.read(chunk)
-        frames.append(data)
-
-    logger.info("Recording finished.")
+def upload_files(client, files, server_url, data):
+    """
+    Upload encoded recordings [(file name, content)] to the server in one request.
+    Returns False if the upload failed in a way worth retrying
+    """
+    names = ", ".join(name for name, _ in files)
+    try:
+        response = client.post(server_url, files=[('files', file) for file in files], data=data)
+        if response.ok: # /learn answers 202 once the files are queued for upload
+            logger.info(f"Files {names} uploaded successfully.")
+            return True
+        logger.warning(f"Failed to upload {names}. Status Code: {response.status_code}")
+        if 400 <= response.status_code < 500 and response.status_code not in RETRY_STATUS:
+            logger.error(f"Server rejected {names}, not retrying: {response.text[:200]}")
+            return True
+    except requests.exceptions.Timeout as e:
+        logger.error(f"Timed out uploading files: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error occurred while uploading files: {str(e)}")
+    return False
 
-    # Stop and close the stream
-    stream.stop_stream()
-    stream.close()
-    audio.terminate()
+def upload_backlog(client, backlog):
+    """Upload the oldest batch of queued recordings, returns False if it has to be retried later"""
+    server_url, data, rows = backlog.batch()
+    data["queue_depth"] = len(backlog) - len(rows)
+    if not upload_files(client, [(name, content) for _, name, content in rows], server_url, data):
+        return False
+    backlog.remove([row_id for row_id, _, _ in rows])
+    return True
 
-    # Save the recorded data as a WAV file
-    waveFile = wave.open(str(output_filename), 'wb')
-    waveFile.setnchannels(channels)
-    waveFile.setsampwidth(audio.get_sample_size(pyaudio.paInt16))
-    waveFile.setframerate(MIC_RATE)
-    waveFile.writeframes(b''.join(frames))
-    waveFile.close()
+def upload_windows(client, recorder, server_url, user, class_id, channels, upload_format, backlog):
+    """
+    Drain finished windows from the recorder: encode and upload them while capture continues.
+    Recordings that fail to upload go to the backlog, and while it holds anything new recordings
+    queue up behind it. The backlog is retried with backoff and sent in multi-file requests
+    """
+    extension = UPLOAD_FORMATS[upload_format][2]
+    backoff = Backoff()
+    while True:
+        try:
+            timestamp, window, suppressed = recorder.get(timeout=backoff.wait() if len(backlog) else None)
+        except queue.Empty:
+            pass
+        else:
+            try:
+                content = encode(window, channels, upload_format)
+            finally:
+                recorder.release(window)
+            file_name = f"{user}_{class_id}_{timestamp}.{extension}"
+            # Silent windows skipped since the last upload are only reported as a count
+            rec_data = {"user_id": user, "class_id": class_id, "time_stamp": timestamp, "suppressed": suppressed}
+            if len(backlog):
+                backlog.put(server_url, file_name, content, rec_data) # Keep the recordings in order
+            elif not upload_files(client, [(file_name, content)], server_url, {**rec_data, "queue_depth": 0}):
+                backlog.put(server_url, file_name, content, rec_data)
+                backoff.failed()
+        if len(backlog) and backoff.ready():
+            if upload_backlog(client, backlog):
+                backoff.succeeded()
+            else:
+                backoff.failed()
 
-    logger.info(f"Recording saved as {output_filename}")
+def stream_url(server, user, class_id, channels, window, hop):
+    """Websocket URL of the API's streaming monitor endpoint"""
+    base = server.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
+    query = urlencode({"user_id": user, "class_id": class_id, "sample_rate": MIC_RATE,
+                       "channels": channels, "window": window, "hop": hop})
+    return f"{base}/monitor/stream?{query}"
 
-def upload_file(file_path, server_url, data):
-    """Upload the .wav file to the server"""
-    files = []
-    with open(file_path, 'rb') as file:
-        files.append(('files', file))
+def log_predictions(ws):
+    """Log the predictions the server sends back until the connection closes"""
+    while True:
         try:
-            response = requests.post(server_url, files=files, data=data)
-            if response.status_code == 200:
-                logger.info(f"File {file_path} uploaded successfully.")
-            else:
-                logger.warning(f"Failed to upload {file_path}. Status Code: {response.status_code}")
-        except Exception as e:
-            logger.error(f"Error occurred while uploading file: {str(e)}")
+            message = ws.recv()
+        except (websocket.WebSocketException, OSError):
+            return
+        prediction = json.loads(message)["prediction"]
+        logger.info(f"Hearing {prediction['prediction'][0]} ({prediction['score']:0.2f}) "
+                    f"for {prediction['start']:0.1f}s - {prediction['end']:0.1f}s")
+
+def stream_audio(url, channels, chunk, audio_device_index):
+    """Send audio to the server continuously as raw 16 bit PCM frames"""
+    audio = pyaudio.PyAudio()
+    stream = audio.open(format=pyaudio.paInt16, channels=channels,
+                        rate=MIC_RATE, input=True,
+                        output=False,
+                        frames_per_buffer=chunk,
+                        input_device_index=audio_device_index)
+    ws = websocket.create_connection(url)
+    logger.info(f"Streaming audio to {url}")
+    threading.Thread(target=log_predictions, args=(ws,), daemon=True).start()
+    try:
+        while True:
+            ws.send_binary(stream.read(chunk, exception_on_overflow=False))
+    finally:
+        stream.stop_stream()
+        stream.close()
+        audio.terminate()
+        ws.close()
 
 def main():
     # Initialize argument parser
@@ -134,39 +222,63 @@ def main():
     parser.add_argument("-u", "--user", type=str, required=True,
                         help="User for the file to be associated with")
     parser.add_argument("-i", "--interval", type=int, default=10,
-                        help="Interval between recordings in seconds (default: 10 seconds)")
+                        help="Gap between uploaded recordings in seconds, 0 for back to back recordings (default: 10 seconds)")
     parser.add_argument("-l", "--learn", type=int, default=10,
                         help="Interval between recordings in seconds (default: 10 seconds)")
-    parser.add_argument("-m", "--mode", type=str, choices=["learn", "monitor"], required=True,
-                        help="Mode of operation: 'learn' or 'monitor'")
+    parser.add_argument("-m", "--mode", type=str, choices=["learn", "monitor", "stream"], required=True,
+                        help="Mode of operation: 'learn', 'monitor' or 'stream' (continuous monitoring)")
+    parser.add_argument("-f", "--format", type=str, choices=list(UPLOAD_FORMATS), default="flac",
+                        help="Upload format: lossless 'flac', lossy 'opus' or uncompressed 'wav' (default: flac)")
+    parser.add_argument("-g", "--gate", action="store_true",
+                        help="Only upload recordings with sound above the adaptive noise floor")
+    parser.add_argument("-gd", "--gatedb", type=float, default=LEVEL_THRESHOLD_DB,
+                        help=f"Gate threshold in dB above the noise floor (default: {LEVEL_THRESHOLD_DB})")
+    parser.add_argument("-q", "--queue", type=str, default=f"{TEMP_SOUNDFILE_DIR}/{QUEUE_FILE}",
+                        help=f"File holding recordings that could not be uploaded yet (default: {TEMP_SOUNDFILE_DIR}/{QUEUE_FILE})")
+    parser.add_argument("-qm", "--queuemb", type=int, default=QUEUE_MAX_MB,
+                        help=f"Size cap of the upload queue in MB, oldest recordings are dropped first (default: {QUEUE_MAX_MB})")
+    parser.add_argument("-qa", "--queueage", type=float, default=QUEUE_MAX_AGE_HOURS,
+                        help=f"Hours a recording is kept in the upload queue (default: {QUEUE_MAX_AGE_HOURS})")
+    parser.add_argument("-ct", "--connecttimeout", type=float, default=CONNECT_TIMEOUT,
+                        help=f"Seconds to wait for a connection to the server (default: {CONNECT_TIMEOUT})")
+    parser.add_argument("-rt", "--readtimeout", type=float, default=READ_TIMEOUT,
+                        help=f"Seconds to wait for the server's response (default: {READ_TIMEOUT})")
+    parser.add_argument("-w", "--window", type=float, default=5,
+                        help="Stream mode: seconds of audio per prediction (default: 5 seconds)")
+    parser.add_argument("-p", "--hop", type=float, default=1,
+                        help="Stream mode: seconds between predictions (default: 1 second)")
  
     
 
     # Parse arguments
     args = parser.parse_args()
+    if args.mode == "stream":
+        url = stream_url(args.server, args.user, args.output, args.channels, args.window, args.hop)
+        while True:
+            try:
+                stream_audio(url, args.channels, args.chunk, args.deviceindex)
+            except (websocket.WebSocketException, OSError) as e:
+                logger.error(f"Stream interrupted: {str(e)}. Reconnecting in {args.interval}s")
+                time.sleep(args.interval)
     print(f"Recording soundfiles for {args.duration}s at interval: {args.interval}s.")
-    while True:
-        # Generate a new output filename based on timestamp
-        timestamp = round(time.time() * 1000)
-        output_filename = Path(f"{TEMP_SOUNDFILE_DIR}/{args.user}_{args.output}_{timestamp}.wav")
-
-        # Record the audio
-        logger.info(f"Recording to {output_filename} for {args.duration}s at interval: {args.interval}s.")
-
-        record_audio(output_filename, args.duration, args.channels, args.chunk, args.deviceindex)
-
-        # Upload the file to the server
-        server_redir_mode = f"{args.server}/{args.mode}"
-        rec_data = {"user_id": args.user, "class_id": args.output, "time_stamp": timestamp}
-        upload_file(output_filename, server_redir_mode, rec_data)
-
-        # Optionally delete the file after upload
-        if os.path.exists(output_filename):
-            os.remove(output_filename)
-            logger.info(f"Deleted {output_filename} after upload.")
-
-        # Wait for the specified interval before the next recording
-        time.sleep(args.interval)
+    # Capture never stops: a window of --duration seconds is cut every --duration + --interval seconds
+    # and uploaded from another thread while the next one is being recorded
+    gate = None
+    if args.gate:
+        # Keep chunk scores for as long as the ring buffer keeps the audio itself
+        gate = EnergyGate(chunks_kept=(args.duration + SLACK_SECONDS) * MIC_RATE // args.chunk + 1, level_threshold_db=args.gatedb)
+    recorder = ContinuousRecorder(MIC_RATE, args.channels, args.chunk, args.deviceindex,
+                                  window_seconds=args.duration, hop_seconds=args.duration + args.interval, gate=gate)
+    server_redir_mode = f"{args.server}/{args.mode}"
+    backlog = UploadQueue(args.queue, max_bytes=args.queuemb * 2**20, max_age=args.queueage * 3600)
+    client = ApiClient(logger, connect_timeout=args.connecttimeout, read_timeout=args.readtimeout)
+    recorder.start()
+    try:
+        upload_windows(client, recorder, server_redir_mode, args.user, args.output, args.channels, args.format, backlog)
+    finally:
+        recorder.stop()
+        backlog.close()
+        client.close()
 
 
 
@@ -0,0 +1,108 @@
+import logging
+import random
+import sqlite3
+import time
+
+logger = logging.getLogger("pi_logger")
+
+QUEUE_MAX_MB = 200 # Oldest recordings are dropped beyond this
+QUEUE_MAX_AGE_HOURS = 24 # ...and once they are this old
+BATCH_FILES = 20 # Recordings per catch-up upload
+RETRY_FIRST = 5 # Seconds before the first retry, doubled after every failure
+RETRY_CAP = 300
+
+
+class UploadQueue:
+    """
+    Recordings that could not be uploaded, kept in a SQLite file so they survive network
+    outages and restarts. Recordings are sent oldest first, in batches of recordings for the
+    same endpoint, user and class. The queue is capped by size and age; the oldest
+    recordings are evicted first.
+    """
+    def __init__(self, path, max_bytes=QUEUE_MAX_MB * 2**20, max_age=QUEUE_MAX_AGE_HOURS * 3600):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.db = sqlite3.connect(path, isolation_level=None) # Autocommit, every statement is its own transaction
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS recordings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            class_id TEXT NOT NULL,
+            time_stamp INTEGER NOT NULL,
+            suppressed INTEGER NOT NULL DEFAULT 0,
+            file_name TEXT NOT NULL,
+            content BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL)""")
+        self.depth = self.db.execute("SELECT COUNT(*) FROM recordings").fetchone()[0]
+        if self.depth:
+            logger.info(f"{self.depth} recordings waiting in {path} from an earlier run")
+
+    def __len__(self):
+        return self.depth
+
+    def put(self, url, file_name, content, data):
+        self.db.execute("INSERT INTO recordings (url, user_id, class_id, time_stamp, suppressed, file_name, content, size, created) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (url, data["user_id"], data["class_id"], data["time_stamp"], data.get("suppressed", 0),
+                         file_name, content, len(content), time.time()))
+        self.depth += 1
+        self.evict()
+
+    def batch(self, max_files=BATCH_FILES):
+        """
+        The oldest recordings that can go in one request, as (url, data, [(id, file name, content)]).
+        The request's time stamp is the oldest recording's, and skipped silent windows are summed.
+        """
+        first = self.db.execute("SELECT url, user_id, class_id FROM recordings ORDER BY id LIMIT 1").fetchone()
+        if first is None:
+            return None
+        rows = self.db.execute("SELECT id, file_name, content, time_stamp, suppressed FROM recordings "
+                               "WHERE url = ? AND user_id = ? AND class_id = ? ORDER BY id LIMIT ?",
+                               (*first, max_files)).fetchall()
+        url, user_id, class_id = first
+        data = {"user_id": user_id, "class_id": class_id, "time_stamp": rows[0][3],
+                "suppressed": sum(row[4] for row in rows)}
+        return url, data, [row[:3] for row in rows]
+
+    def remove(self, ids):
+        self.depth -= self.db.execute(f"DELETE FROM recordings WHERE id IN ({','.join('?' * len(ids))})", ids).rowcount
+
+    def evict(self):
+        expired = self.db.execute("DELETE FROM recordings WHERE created < ?", (time.time() - self.max_age,)).rowcount
+        # Keep the newest recordings that fit in max_bytes
+        oversize = self.db.execute("""DELETE FROM recordings WHERE id IN (
+            SELECT id FROM (SELECT id, SUM(size) OVER (ORDER BY id DESC) AS kept FROM recordings) WHERE kept > ?)""",
+            (self.max_bytes,)).rowcount
+        if expired or oversize:
+            self.depth -= expired + oversize
+            logger.warning(f"Upload queue: dropped {expired} expired and {oversize} oldest recordings ({self.depth} left)")
+
+    def close(self):
+        self.db.close()
+
+
+class Backoff:
+    """Exponential backoff with jitter between retries of the upload queue"""
+    def __init__(self, first=RETRY_FIRST, cap=RETRY_CAP):
+        self.first = first
+        self.cap = cap
+        self.delay = first
+        self.retry_at = 0
+
+    def ready(self):
+        return time.monotonic() >= self.retry_at
+
+    def wait(self):
+        """Seconds until the next retry is due"""
+        return max(self.retry_at - time.monotonic(), 0)
+
+    def failed(self):
+        self.retry_at = time.monotonic() + random.uniform(0.5, 1) * self.delay
+        logger.info(f"Retrying uploads in {self.wait():.0f}s")
+        self.delay = min(self.delay * 2, self.cap)
+
+    def succeeded(self):
+        self.delay = self.first
+        self.retry_at = 0
@@ -0,0 +1,26 @@
+import email.utils
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from api_client import retry_after
+
+
+def response(**headers):
+    return SimpleNamespace(headers=headers)
+
+
+def test_retry_after_seconds():
+    assert retry_after(response(**{"Retry-After": "2"}), default=3) == 2
+    assert retry_after(response(**{"Retry-After": "-5"}), default=3) == 0
+
+
+def test_retry_after_http_date():
+    when = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert retry_after(response(**{"Retry-After": when}), default=3) == pytest.approx(60, abs=2)
+
+
+def test_retry_after_default():
+    assert retry_after(response(), default=3) == 3
+    assert retry_after(response(**{"Retry-After": "soon"}), default=3) == 3
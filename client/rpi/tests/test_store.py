@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from store import Backoff, UploadQueue
+
+URL = "https://api/monitor"
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = UploadQueue(tmp_path / "queue.db", max_bytes=100, max_age=3600)
+    yield queue
+    queue.close()
+
+
+def put(queue, name, size=10, url=URL, user_id="user", class_id="1", time_stamp=0, suppressed=0):
+    data = {"user_id": user_id, "class_id": class_id, "time_stamp": time_stamp, "suppressed": suppressed}
+    queue.put(url, name, bytes(size), data)
+
+
+def names(queue):
+    return [name for name, in queue.db.execute("SELECT file_name FROM recordings ORDER BY id")]
+
+
+def test_size_eviction_keeps_the_newest(queue):
+    for i in range(10):
+        put(queue, f"{i}.wav", size=10)
+    assert len(queue) == 10
+    put(queue, "10.wav", size=25)
+    assert names(queue) == [f"{i}.wav" for i in range(3, 11)] # 7 * 10 + 25 bytes fit
+    assert len(queue) == 8
+
+
+def test_recording_larger_than_the_queue_is_dropped(queue):
+    put(queue, "0.wav")
+    put(queue, "huge.wav", size=101)
+    assert names(queue) == []
+    assert len(queue) == 0
+
+
+def test_age_eviction(queue):
+    put(queue, "old.wav")
+    put(queue, "new.wav")
+    queue.db.execute("UPDATE recordings SET created = ? WHERE file_name = 'old.wav'", (time.time() - 3601,))
+    put(queue, "newer.wav")
+    assert names(queue) == ["new.wav", "newer.wav"]
+    assert len(queue) == 2
+
+
+def test_batches_group_endpoint_user_and_class(queue):
+    put(queue, "a1.wav", time_stamp=100, suppressed=2)
+    put(queue, "b1.wav", class_id="2", time_stamp=101)
+    put(queue, "a2.wav", time_stamp=102, suppressed=3)
+    put(queue, "c1.wav", url="https://api/train", time_stamp=103)
+    put(queue, "a3.wav", time_stamp=104)
+
+    url, data, files = queue.batch(max_files=2)
+    assert url == URL
+    assert data == {"user_id": "user", "class_id": "1", "time_stamp": 100, "suppressed": 5}
+    assert [name for _, name, _ in files] == ["a1.wav", "a2.wav"]
+    queue.remove([id for id, _, _ in files])
+
+    url, data, files = queue.batch(max_files=2)
+    assert (data["class_id"], data["time_stamp"]) == ("2", 101)
+    assert [name for _, name, _ in files] == ["b1.wav"]
+    queue.remove([id for id, _, _ in files])
+
+    url, data, files = queue.batch()
+    assert url == "https://api/train"
+    queue.remove([id for id, _, _ in files])
+    _, _, files = queue.batch()
+    assert [(name, content) for _, name, content in files] == [("a3.wav", bytes(10))]
+    queue.remove([id for id, _, _ in files])
+    assert queue.batch() is None
+    assert len(queue) == 0
+
+
+def test_queue_survives_reopening(tmp_path):
+    queue = UploadQueue(tmp_path / "queue.db")
+    for i in range(3):
+        put(queue, f"{i}.wav")
+    queue.close()
+    queue = UploadQueue(tmp_path / "queue.db")
+    assert len(queue) == 3
+    _, _, files = queue.batch()
+    assert [name for _, name, _ in files] == ["0.wav", "1.wav", "2.wav"]
+    queue.close()
+
+
+def test_backoff_doubles_up_to_the_cap():
+    backoff = Backoff(first=5, cap=15)
+    assert backoff.ready()
+    delays = []
+    for _ in range(4):
+        backoff.failed()
+        delays.append(backoff.wait())
+    assert not backoff.ready()
+    for delay, nominal in zip(delays, [5, 10, 15, 15]):
+        assert nominal / 2 - 0.1 <= delay <= nominal
+    backoff.succeeded()
+    assert backoff.ready()
+    assert backoff.delay == 5